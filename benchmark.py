@@ -0,0 +1,626 @@
+import argparse
+import contextlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from datetime import datetime, timedelta, timezone
+
+import cv2
+import numpy as np
+
+import listing
+import manifest
+import metrics
+import pipeline
+import query
+import redact
+import s3io
+from local_s3 import LocalS3Server
+
+BENCH_BUCKET = "screenlake-benchmark"
+
+# Bucket the pipeline benchmark uploads outputs to with --upload
+BENCH_OUTPUT_BUCKET = "screenlake-benchmark-output"
+
+# Columns of the synthetic CSVs, per consolidation prefix
+SYNTHETIC_COLUMNS = {
+    "screenshot_data": ["timestamp", "filename", "app", "session_id"],
+    "app_accessibility_data": ["timestamp", "app", "element", "text"],
+    "app_segment_data": ["timestamp", "app", "start_time", "end_time", "duration"],
+    "session_data": ["timestamp", "session_id", "start_time", "end_time", "duration"],
+}
+
+SYNTHETIC_APPS = ["com.instagram.android", "com.zhiliaoapp.musically", "com.google.android.youtube",
+                  "com.whatsapp", "com.android.chrome", "com.spotify.music"]
+
+
+def put_objects(endpoint_url, server, objects):
+    """
+    Stores {key: data} objects in the benchmark bucket, either directly in the local stand-in or
+    through the S3 API of an external endpoint (e.g. a moto server).
+    """
+    if server is not None:
+        for key, data in objects.items():
+            server.put(BENCH_BUCKET, key, data)
+        return
+
+    s3 = s3io.create_s3_client(endpoint_url=endpoint_url)
+    try:
+        s3.create_bucket(Bucket=BENCH_BUCKET)
+    except s3.exceptions.BucketAlreadyOwnedByYou:
+        pass
+    for key, data in objects.items():
+        s3.put_object(Bucket=BENCH_BUCKET, Key=key, Body=data)
+
+
+def list_benchmark_objects(endpoint_url, prefix):
+    """
+    Lists the benchmark bucket the way the pipeline does, returning S3Object entries.
+    """
+    s3 = s3io.create_s3_client(endpoint_url=endpoint_url)
+    return sorted(listing.list_s3_objects(s3, BENCH_BUCKET, prefix))
+
+
+def bench_download(args):
+    """
+    Compares the serial per-process download loop with the concurrent download engine.
+
+    Returns:
+        dict: Objects/sec and MB/sec of both approaches.
+    """
+    prefix = "academia/tenant/bench/panel/p/V_1/panelist/"
+    payload = os.urandom(args.object_kb * 1024)
+    objects = {f"{prefix}{i % args.panelists:04d}/{i:06d}.zip": payload for i in range(args.objects)}
+    large_payload = os.urandom(args.large_mb * 1024 * 1024)
+    for i in range(args.large_objects):
+        objects[f"{prefix}large/{i:04d}.zip"] = large_payload
+    total_bytes = sum(len(data) for data in objects.values())
+
+    with LocalS3Server(args.latency_ms) if not args.endpoint_url else contextlib.nullcontext() as server:
+        endpoint_url = args.endpoint_url or server.endpoint_url
+        put_objects(endpoint_url, server if not args.endpoint_url else None, objects)
+        listing = list_benchmark_objects(endpoint_url, prefix)
+
+        results = {"objects": len(listing), "bytes": total_bytes}
+        scratch = tempfile.mkdtemp(prefix="screenlake-bench-")
+        try:
+            # The loop download_batch used before the download engine: one client, one key at a time
+            s3 = s3io.create_s3_client(endpoint_url=endpoint_url)
+            started = time.monotonic()
+            for obj in listing:
+                file_path = os.path.join(scratch, "serial", *obj.key.split("/")[1:])
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                s3.download_file(BENCH_BUCKET, obj.key, file_path)
+            results["serial"] = _rates(len(listing), total_bytes, time.monotonic() - started)
+
+            s3io.init_download_worker({"concurrency": args.concurrency, "endpoint_url": endpoint_url,
+                                      "max_bandwidth": args.max_bandwidth_mb * 1024 * 1024 or None})
+            started = time.monotonic()
+            query.download_batch(listing, os.path.join(scratch, "engine"), BENCH_BUCKET)
+            results["engine"] = _rates(len(listing), total_bytes, time.monotonic() - started)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    results["speedup"] = results["engine"]["objects_per_sec"] / results["serial"]["objects_per_sec"]
+    return results
+
+
+def _serve_listing(scales, panelists, conn):
+    """
+    Runs a local stand-in holding scale empty zip objects under a prefix per scale, in its own process so
+    that its buckets don't count towards the memory measured. Sends the endpoint URL, then serves until
+    anything arrives on conn.
+    """
+    with LocalS3Server() as server:
+        for scale in scales:
+            prefix = f"academia/tenant/bench/panel/memory{scale}/V_1/panelist/"
+            for i in range(scale):
+                server.put(BENCH_BUCKET, f"{prefix}{i % panelists:04d}/{i:08d}.zip", b"")
+        conn.send(server.endpoint_url)
+        conn.recv()
+
+
+def _drain_batch(batch):
+    return None
+
+
+def _measure_listing_memory(endpoint_url, prefix, args, results):
+    workdir = tempfile.mkdtemp(prefix="screenlake-bench-")
+    os.chdir(workdir)
+    try:
+        started = time.monotonic()
+        s3 = s3io.create_s3_client(endpoint_url=endpoint_url)
+        objects = listing.query_s3_objects_in_date_range(s3, BENCH_BUCKET, prefix, None, None)
+        objects = manifest.manifest_pending("bench_memory", objects)
+        summary = pipeline.run_pipeline(
+            pipeline.batch_objects(objects, args.batch_size),
+            [{"name": "drain", "workers": args.processors, "target": _drain_batch}],
+            memory_limit=args.memory_limit_mb * 1024 * 1024 or None)
+        results.put({"seconds": time.monotonic() - started, "batches": summary["drain"]["processed"],
+                     # ru_maxrss is in KB on Linux
+                     "driver_peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                     "pipeline_peak_mb": summary.get("memory", {}).get("peak_rss_mb")})
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _measurement_result(process, results, timeout):
+    """
+    Waits for the result of a measurement process, failing if it dies or runs past timeout seconds
+    instead of waiting forever.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            result = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if not process.is_alive() or time.monotonic() > deadline:
+                process.terminate()
+                process.join()
+                raise RuntimeError(f"Measurement process produced no result (exit code {process.exitcode})")
+    process.join(timeout)
+    if process.exitcode != 0:
+        raise RuntimeError(f"Measurement process failed with exit code {process.exitcode}")
+    return result
+
+
+def bench_memory(args):
+    """
+    Checks that the driver's peak memory stays flat as the number of listed objects grows: each scale is
+    listed, filtered through the manifest and batched into the pipeline by a fresh process, against a
+    local stand-in running in another.
+
+    Returns:
+        dict: Peak memory per scale and whether the largest scale stayed within the tolerance of the
+        smallest.
+    """
+    parent_conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=_serve_listing, args=(args.scales, args.panelists, child_conn))
+    server.start()
+    try:
+        deadline = time.monotonic() + args.timeout
+        while not parent_conn.poll(1):
+            if not server.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError(f"Local stand-in didn't start (exit code {server.exitcode})")
+        endpoint_url = parent_conn.recv()
+        runs = []
+        for scale in args.scales:
+            results = multiprocessing.Queue()
+            prefix = f"academia/tenant/bench/panel/memory{scale}/V_1/panelist/"
+            process = multiprocessing.Process(target=_measure_listing_memory,
+                                              args=(endpoint_url, prefix, args, results))
+            process.start()
+            run = {"objects": scale, **_measurement_result(process, results, args.timeout)}
+            runs.append(run)
+            logging.warning(f"{scale} objects: driver peak {run['driver_peak_mb']:.1f} MB, "
+                            f"{run['seconds']:.1f}s")
+    finally:
+        if server.is_alive():
+            parent_conn.send(None)
+            server.join(args.timeout)
+        server.terminate()
+        server.join()
+
+    smallest, largest = min(runs, key=lambda run: run["objects"]), max(runs, key=lambda run: run["objects"])
+    growth = largest["driver_peak_mb"] / smallest["driver_peak_mb"] - 1
+    return {"runs": runs, "growth": growth, "flat": growth <= args.tolerance}
+
+
+def box_iou(a, b):
+    """
+    Intersection over union of two (x, y, w, h) boxes.
+    """
+    left, top = max(a[0], b[0]), max(a[1], b[1])
+    right, bottom = min(a[0] + a[2], b[0] + b[2]), min(a[1] + a[3], b[1] + b[3])
+    intersection = max(0, right - left) * max(0, bottom - top)
+    union = a[2] * a[3] + b[2] * b[3] - intersection
+    return intersection / union if union else 0.0
+
+
+def match_boxes(reference, detected, iou_threshold):
+    """
+    Greedily matches detected boxes to reference boxes.
+
+    Returns:
+        int: Number of reference boxes matched by a detection with at least iou_threshold overlap.
+    """
+    unmatched = list(detected)
+    matched = 0
+    for box in reference:
+        scores = [box_iou(box, other) for other in unmatched]
+        if scores and max(scores) >= iou_threshold:
+            unmatched.pop(scores.index(max(scores)))
+            matched += 1
+    return matched
+
+
+def bench_detection(args):
+    """
+    Measures the speed and recall of each detector backend, at full resolution and in fast (downscaled)
+    mode, on a local sample of screenshots. Images go through the detectors in batches of --batch-size.
+    Without labels, the full-resolution detections of the first backend are the reference.
+
+    Returns:
+        dict: Per-image time, images/sec, recall and precision of each backend and mode.
+    """
+    paths = sorted(os.path.join(root, name) for root, _, files in os.walk(args.images)
+                   for name in files if name.lower().endswith((".jpg", ".jpeg", ".png")))
+    if not paths:
+        raise SystemExit(f"No images found in {args.images}")
+    labels = None
+    if args.labels:
+        with open(args.labels) as f:
+            labels = {name: [tuple(box) for box in boxes] for name, boxes in json.load(f).items()}
+
+    base = {"scale_factor": args.scale_factor, "min_size": args.min_size, "min_neighbors": args.min_neighbors,
+            "confidence": args.confidence, "threads": args.threads}
+    models = {"ssd": {"model": args.ssd_model, "config": args.ssd_config}, "yunet": {"model": args.yunet_model}}
+    modes = {}
+    for backend in args.backends:
+        settings = dict(base, backend=backend, **models.get(backend, {}))
+        modes[f"{backend}:full"] = dict(settings, mode="full")
+        for scale in args.scales:
+            modes[f"{backend}:fast@{scale}"] = dict(settings, mode="fast", scale=scale)
+
+    images = [cv2.imread(path) for path in paths]
+    detections, elapsed = {}, {}
+    for name, settings in modes.items():
+        # Load the model outside the timed loop, as a worker does once
+        redact.get_detector(settings)
+        started = time.monotonic()
+        detections[name] = []
+        for start in range(0, len(images), args.batch_size):
+            detections[name] += redact.detect_faces_batch(images[start:start + args.batch_size], settings)
+        elapsed[name] = time.monotonic() - started
+
+    baseline = f"{args.backends[0]}:full"
+    if labels is not None:
+        reference = [labels.get(os.path.relpath(path, args.images), []) for path in paths]
+    else:
+        reference = detections[baseline]
+    num_reference = sum(len(boxes) for boxes in reference)
+
+    results = {"images": len(images), "reference_faces": num_reference,
+               "reference": "labels" if labels is not None else baseline}
+    for name in modes:
+        matched = sum(match_boxes(ref, found, args.iou) for ref, found in zip(reference, detections[name]))
+        num_detected = sum(len(boxes) for boxes in detections[name])
+        results[name] = {"seconds": elapsed[name], "ms_per_image": elapsed[name] / len(images) * 1000,
+                         "images_per_sec": len(images) / elapsed[name],
+                         "recall": matched / num_reference if num_reference else None,
+                         "precision": matched / num_detected if num_detected else None,
+                         "speedup": elapsed[baseline] / elapsed[name]}
+    return results
+
+
+def draw_face(image, rng, face_crops=None):
+    """
+    Draws a face at a random position: a crop from face_crops if given, otherwise a simple frontal face
+    (skin-toned oval, eyes, brows, nose and mouth) that the Haar cascade picks up at most sizes.
+    """
+    height, width = image.shape[:2]
+    size = rng.randint(width // 6, width // 3)
+    x, y = rng.randint(0, width - size), rng.randint(0, height - size)
+
+    if face_crops:
+        image[y:y + size, x:x + size] = cv2.resize(rng.choice(face_crops), (size, size))
+        return
+
+    center = (x + size // 2, y + size // 2)
+    skin = (rng.randint(90, 160), rng.randint(130, 190), rng.randint(170, 230))
+    cv2.ellipse(image, center, (size * 2 // 5, size // 2), 0, 0, 360, skin, -1)
+    for side in (-1, 1):
+        eye = (center[0] + side * size // 6, center[1] - size // 10)
+        cv2.ellipse(image, eye, (size // 12, size // 24), 0, 0, 360, (40, 30, 30), -1)
+        cv2.line(image, (eye[0] - size // 10, eye[1] - size // 10), (eye[0] + size // 10, eye[1] - size // 9),
+                 (30, 20, 20), max(1, size // 40))
+    cv2.line(image, (center[0], center[1] - size // 20), (center[0], center[1] + size // 10), (70, 90, 140),
+             max(1, size // 50))
+    cv2.ellipse(image, (center[0], center[1] + size // 5), (size // 7, size // 20), 0, 0, 180, (50, 50, 150),
+                max(1, size // 40))
+
+
+def make_screenshot(rng, width, height, with_face, face_crops=None):
+    """
+    Renders a JPEG screenshot of app-like content: cards, text lines and optionally a face.
+    """
+    image = np.full((height, width, 3), rng.randint(225, 255), dtype=np.uint8)
+    cv2.rectangle(image, (0, 0), (width, height // 14), (rng.randint(0, 255), rng.randint(0, 255), 120), -1)
+    y = height // 12
+    while y < height - 40:
+        card_height = rng.randint(height // 12, height // 4)
+        cv2.rectangle(image, (width // 20, y), (width - width // 20, min(height, y + card_height)),
+                      tuple(rng.randint(150, 245) for _ in range(3)), -1)
+        for line in range(y + 30, min(height, y + card_height) - 10, 28):
+            cv2.putText(image, "".join(rng.choice("abcdefghij klmnopq") for _ in range(rng.randint(8, 30))),
+                        (width // 12, line), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (40, 40, 40), 1)
+        y += card_height + height // 60
+
+    if with_face:
+        draw_face(image, rng, face_crops)
+    return cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+
+def make_panel_zip(rng, started, args, face_crops=None):
+    """
+    Builds a panelist zip like the ones the app uploads: screenshots plus one CSV per consolidation prefix.
+
+    Returns:
+        tuple: The zip as bytes and its number of screenshots with faces.
+    """
+    buffer = io.BytesIO()
+    faces = 0
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        timestamps = [int(started.timestamp() * 1000) + i * 5000 for i in range(args.images_per_zip)]
+        for timestamp in timestamps:
+            with_face = rng.random() < args.face_ratio
+            faces += with_face
+            archive.writestr(f"{timestamp}.jpg", make_screenshot(rng, args.width, args.height, with_face, face_crops),
+                             compress_type=zipfile.ZIP_STORED)
+
+        session_id = f"{rng.getrandbits(64):016x}"
+        for prefix, columns in SYNTHETIC_COLUMNS.items():
+            rows = [",".join(columns)]
+            for i in range(args.rows_per_csv):
+                timestamp = timestamps[0] + i * 1000
+                values = {"timestamp": timestamp, "filename": f"{timestamp}.jpg", "app": rng.choice(SYNTHETIC_APPS),
+                          "session_id": session_id, "element": f"android.widget.TextView#{rng.randint(0, 99)}",
+                          "text": f'"{rng.choice(["Like", "Share", "Reply, later", "Next"])}"',
+                          "start_time": timestamp, "end_time": timestamp + 900, "duration": 900}
+                rows.append(",".join(str(values[column]) for column in columns))
+            archive.writestr(f"{prefix}_{timestamps[0]}.csv", "\n".join(rows) + "\n")
+    return buffer.getvalue(), faces
+
+
+def git_revision():
+    """
+    Returns the commit the benchmarks run against, with '-dirty' appended if the tree has changes.
+    """
+    folder = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=folder, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=folder,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if dirty else "")
+
+
+def bench_pipeline(args):
+    """
+    Times every stage and the end-to-end run of the pipeline over synthetic panelist zips served by the
+    local S3 stand-in, at each of several scales and in each pipeline mode.
+
+    Returns:
+        dict: Per (scale, mode) run: seconds, zips/sec, images/sec, seconds per step, counters and stage
+        utilization.
+    """
+    rng = random.Random(args.seed)
+    face_crops = None
+    if args.face_images:
+        face_crops = [cv2.imread(os.path.join(args.face_images, name)) for name in sorted(os.listdir(args.face_images))]
+        face_crops = [crop for crop in face_crops if crop is not None]
+
+    # The largest scale is generated once; smaller scales reuse its first zips under their own prefix
+    started = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    generated = time.monotonic()
+    zips, expected_faces = [], []
+    for i in range(max(args.scales)):
+        data, faces = make_panel_zip(rng, started + timedelta(minutes=10 * i), args, face_crops)
+        zips.append(data)
+        expected_faces.append(faces)
+    results = {"generate_seconds": time.monotonic() - generated, "zip_mb": sum(map(len, zips)) / 1024 / 1024,
+               "runs": []}
+
+    with LocalS3Server(args.latency_ms) as server:
+        for scale in args.scales:
+            prefix = f"academia/tenant/bench/panel/scale{scale}/V_1/"
+            for i in range(scale):
+                server.put(BENCH_BUCKET, f"{prefix}panelist/{i % args.panelists:04d}/{i:06d}.zip", zips[i])
+
+            for mode in args.modes:
+                results["runs"].append(_run_pipeline_once(server, prefix, scale, mode, args,
+                                                          sum(expected_faces[:scale])))
+                run = results["runs"][-1]
+                logging.warning(f"scale={scale} mode={mode}: {run['seconds']:.1f}s, "
+                                f"{run['images_per_sec']:.1f} images/s")
+    return results
+
+
+def _run_pipeline_once(server, prefix, scale, mode, args, expected_faces):
+    endpoint_url = server.endpoint_url
+    workdir = tempfile.mkdtemp(prefix="screenlake-bench-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        query_id = f"bench_{mode}_{scale}"
+        metrics.init_metrics()
+        redact.configure_encoder({"format": args.image_format, "quality": args.image_quality,
+                                 "turbojpeg": args.turbojpeg, "passthrough": not args.no_passthrough})
+        output_prefix = f"{mode}{scale}/"
+        if args.upload:
+            s3io.configure_output_sink(f"s3://{BENCH_OUTPUT_BUCKET}/{output_prefix}",
+                                       {"endpoint_url": endpoint_url})
+        started = time.monotonic()
+        s3 = s3io.create_s3_client(endpoint_url=endpoint_url)
+        objects = listing.query_s3_objects_in_date_range(s3, BENCH_BUCKET, prefix, None, None)
+        summary = query.run_query_pipeline(
+            BENCH_BUCKET, objects, args.batch_size, args.processors, query_id, streaming=(mode == "streaming"),
+            download_settings={"endpoint_url": endpoint_url, "concurrency": args.concurrency}, incremental=False,
+            detection_settings={"mode": args.detection_mode, "backend": args.detector, "model": args.detector_model,
+                                "config": args.detector_config}, image_workers=args.image_workers)
+        s3io.upload_outputs(query_id)
+        elapsed = time.monotonic() - started
+        record = metrics.metrics_snapshot(query_id, summary, final=True)
+
+        if args.upload:
+            images_written = sum(1 for key in server.buckets.get(BENCH_OUTPUT_BUCKET, {})
+                                 if key.startswith(output_prefix) and "/images/" in key)
+        else:
+            images_written = sum(len(files) for root, _, files in os.walk(os.path.join(query_id, "combined"))
+                                 if os.path.basename(root) == "images")
+    finally:
+        s3io.configure_output_sink(None)
+        redact.configure_encoder()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    counters = record["counters"]
+    return {
+        "scale": scale,
+        "mode": mode,
+        "seconds": elapsed,
+        "zips_per_sec": scale / elapsed,
+        "images_per_sec": counters["images"] / elapsed,
+        "step_seconds": {name: span["seconds"] for name, span in record["spans"].items()},
+        "counters": counters,
+        "faces_drawn": expected_faces,
+        "images_written": images_written,
+        "stage_utilization": {name: figures["utilization"] for name, figures in record["stages"].items()
+                              if "utilization" in figures},
+        "failed": sum(figures.get("failed", 0) for figures in record["stages"].values()),
+    }
+
+
+def compare_results(args):
+    """
+    Prints end-to-end seconds and images/sec of recorded pipeline runs side by side, one column per commit.
+    """
+    rows, commits = {}, []
+    with open(args.results) as f:
+        for line in f:
+            result = json.loads(line)
+            if result.get("benchmark") != "pipeline":
+                continue
+            commit = (result.get("commit") or "unknown")[:12]
+            if commit not in commits:
+                commits.append(commit)
+            for run in result["runs"]:
+                rows.setdefault((run["scale"], run["mode"]), {})[commit] = run
+
+    print(f"{'scale':>6} {'mode':<10}" + "".join(f"{commit:>24}" for commit in commits))
+    for (scale, mode), runs in sorted(rows.items()):
+        cells = [f"{runs[commit]['seconds']:8.1f}s {runs[commit]['images_per_sec']:8.1f}/s" if commit in runs else ""
+                 for commit in commits]
+        print(f"{scale:>6} {mode:<10}" + "".join(f"{cell:>24}" for cell in cells))
+
+
+def _rates(count, num_bytes, elapsed):
+    return {"seconds": elapsed, "objects_per_sec": count / elapsed, "mb_per_sec": num_bytes / elapsed / 1024 / 1024}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the S3 redaction/consolidation pipeline.")
+    parser.add_argument("--output", help="Append results as a JSON line to this file.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    download = subparsers.add_parser("download", help="Serial download loop vs the concurrent download engine.")
+    download.add_argument("--objects", type=int, default=200, help="Number of small zip objects.")
+    download.add_argument("--object-kb", type=int, default=256, help="Size of each small object in KB.")
+    download.add_argument("--panelists", type=int, default=10, help="Number of panelist folders.")
+    download.add_argument("--large-objects", type=int, default=2, help="Number of large objects.")
+    download.add_argument("--large-mb", type=int, default=64, help="Size of each large object in MB.")
+    download.add_argument("--latency-ms", type=float, default=20, help="Simulated per-request latency.")
+    download.add_argument("--concurrency", type=int, default=s3io.DOWNLOAD_SETTINGS["concurrency"])
+    download.add_argument("--max-bandwidth-mb", type=float, default=0, help="Bandwidth cap in MB/s (0: none).")
+    download.add_argument("--endpoint-url", help="Use an external S3 stand-in (e.g. moto server) instead.")
+    download.set_defaults(run=bench_download)
+
+    settings = redact.DETECTION_SETTINGS
+    detection = subparsers.add_parser("detection", help="Speed and recall of face detector backends and modes.")
+    detection.add_argument("--images", required=True, help="Folder of sample screenshots.")
+    detection.add_argument("--labels", help="JSON file mapping image paths (relative to --images) to lists of "
+                                            "[x, y, w, h] face boxes. Default: the first backend's "
+                                            "full-resolution detections.")
+    detection.add_argument("--backends", nargs="+", choices=tuple(redact.DETECTOR_BACKENDS),
+                           default=["haar"])
+    detection.add_argument("--ssd-model", help="res10_300x300_ssd_iter_140000.caffemodel for the ssd backend.")
+    detection.add_argument("--ssd-config", help="deploy.prototxt for the ssd backend.")
+    detection.add_argument("--yunet-model", help="face_detection_yunet_*.onnx for the yunet backend.")
+    detection.add_argument("--batch-size", type=int, default=settings["batch_size"])
+    detection.add_argument("--threads", type=int, help="OpenCV threads (default: OpenCV's default).")
+    detection.add_argument("--confidence", type=float, default=settings["confidence"])
+    detection.add_argument("--scales", type=float, nargs="+", default=[0.5, 0.35, 0.25])
+    detection.add_argument("--scale-factor", type=float, default=settings["scale_factor"])
+    detection.add_argument("--min-size", type=int, default=settings["min_size"])
+    detection.add_argument("--min-neighbors", type=int, default=settings["min_neighbors"])
+    detection.add_argument("--iou", type=float, default=0.4, help="Overlap needed for a detection to count.")
+    detection.set_defaults(run=bench_detection)
+
+    pipeline = subparsers.add_parser("pipeline", help="Stage and end-to-end timings over synthetic panel zips.")
+    pipeline.add_argument("--scales", type=int, nargs="+", default=[10, 50, 200], help="Numbers of zips.")
+    pipeline.add_argument("--modes", nargs="+", choices=["disk", "streaming"], default=["disk", "streaming"])
+    pipeline.add_argument("--images-per-zip", type=int, default=20)
+    pipeline.add_argument("--face-ratio", type=float, default=0.3, help="Share of screenshots with a face.")
+    pipeline.add_argument("--face-images", help="Folder of face crops to paste instead of drawn faces.")
+    pipeline.add_argument("--rows-per-csv", type=int, default=50)
+    pipeline.add_argument("--panelists", type=int, default=8)
+    pipeline.add_argument("--width", type=int, default=720)
+    pipeline.add_argument("--height", type=int, default=1560)
+    pipeline.add_argument("--processors", type=int, default=4)
+    pipeline.add_argument("--batch-size", type=int, default=5)
+    pipeline.add_argument("--concurrency", type=int, default=s3io.DOWNLOAD_SETTINGS["concurrency"])
+    pipeline.add_argument("--image-workers", type=int, default=0)
+    pipeline.add_argument("--upload", action="store_true",
+                          help="Upload outputs to the local S3 stand-in instead of writing images to disk.")
+    pipeline.add_argument("--detection-mode", choices=["full", "fast"], default="full")
+    pipeline.add_argument("--detector", choices=tuple(redact.DETECTOR_BACKENDS), default="haar")
+    pipeline.add_argument("--detector-model", help="Model file of the ssd or yunet detector.")
+    pipeline.add_argument("--detector-config", help="deploy.prototxt of the ssd detector.")
+    pipeline.add_argument("--image-format", choices=("source",) + tuple(redact.FORMAT_EXTENSIONS),
+                          default="source")
+    pipeline.add_argument("--image-quality", type=int, default=redact.ENCODE_SETTINGS["quality"])
+    pipeline.add_argument("--turbojpeg", action="store_true", help="Encode JPEGs with PyTurboJPEG.")
+    pipeline.add_argument("--no-passthrough", action="store_true",
+                          help="Re-encode images without faces too, as before the passthrough.")
+    pipeline.add_argument("--latency-ms", type=float, default=5)
+    pipeline.add_argument("--seed", type=int, default=0)
+    pipeline.set_defaults(run=bench_pipeline)
+
+    memory = subparsers.add_parser("memory", help="Check that peak memory stays flat as the object count grows.")
+    memory.add_argument("--scales", type=int, nargs="+", default=[5000, 20000, 80000], help="Numbers of objects.")
+    memory.add_argument("--panelists", type=int, default=100)
+    memory.add_argument("--processors", type=int, default=2)
+    memory.add_argument("--batch-size", type=int, default=25)
+    memory.add_argument("--memory-limit-mb", type=float, default=0, help="Pipeline memory ceiling (0: none).")
+    memory.add_argument("--timeout", type=float, default=600, help="Seconds each scale may take.")
+    memory.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed growth of the peak from the smallest to the largest scale.")
+    memory.set_defaults(run=bench_memory)
+
+    compare = subparsers.add_parser("compare", help="Compare recorded pipeline results across commits.")
+    compare.add_argument("results", help="JSON-lines file written with --output.")
+
+    args = parser.parse_args()
+    if args.benchmark == "compare":
+        return compare_results(args)
+
+    results = {"benchmark": args.benchmark, "time": datetime.now(timezone.utc).isoformat(),
+               "commit": git_revision(), "python": platform.python_version(), "cpus": multiprocessing.cpu_count(),
+               "args": {key: value for key, value in vars(args).items() if key != "run"}, **args.run(args)}
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(results) + "\n")
+    if results.get("flat") is False:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -0,0 +1,440 @@
+import functools
+import json
+import logging
+import operator
+import os
+from datetime import datetime, timezone
+
+from listing import as_utc
+from outputs import (COLUMNAR_FORMATS, CSV_PREFIXES, csv_rows, load_csv_index, parse_csv_header, read_csv_header,
+                     row_timestamp, sort_column, time_range_rows)
+
+
+# Querying outputs
+# combined/catalog.json lists a run's consolidated outputs: per panelist and prefix, each file's format,
+# columns, size and, where the file is sorted, its row count and capture time range. Catalog opens it and
+# returns LazyFrames, chunked pandas frames that read nothing until they are iterated. Files outside the
+# requested panelists and time range are skipped; Parquet and Arrow files are read in preference to CSVs,
+# by column and with the filters pushed into the reader, so row groups that can't match are skipped too.
+# Sorted CSVs seek to the start of the time range through their sidecar index.
+
+# Catalog file of a run, in its combined folder
+CATALOG_FILE = "catalog.json"
+
+# Comparisons allowed in LazyFrame.where
+FRAME_OPERATORS = {"==": operator.eq, "!=": operator.ne, "<": operator.lt, "<=": operator.le,
+                   ">": operator.gt, ">=": operator.ge, "in": lambda cell, values: cell in values}
+
+# Default number of rows per frame chunk
+FRAME_CHUNK_ROWS = 100_000
+
+
+def _csv_time_bounds(csv_path, index):
+    """
+    Returns the earliest and latest capture time of a fully sorted CSV. The earliest is the first index
+    entry's; only the rows after the last entry are read for the latest.
+
+    Returns:
+        tuple: (start, end) as epoch seconds, or (None, None) for CSVs that aren't fully sorted.
+    """
+    if index is None or index["size"] != os.path.getsize(csv_path):
+        return None, None
+    entries = [entry for entry in index["index"] if entry[0] is not None]
+    if not entries:
+        return None, None
+
+    position = index["columns"].index(index["sortColumn"])
+    latest = entries[-1][0]
+    with open(csv_path, 'rb') as f:
+        f.seek(entries[-1][1])
+        # Rows without a capture time sort last
+        for row in csv_rows(f):
+            timestamp = row_timestamp(row[position]) if position < len(row) else None
+            if timestamp is None:
+                break
+            latest = timestamp
+    return entries[0][0], latest
+
+
+def write_catalog(query_id):
+    """
+    Writes the catalog of a query's consolidated outputs to combined/catalog.json. Columnar files older
+    than their CSV are left out, as they miss the rows appended since.
+
+    Args:
+        query_id: Unique identifier for the query/download session.
+
+    Returns:
+        dict: The catalog, whose 'files' holds one entry per output file with the keys panelist, prefix,
+        format, path (relative to the combined folder), bytes, columns, timeColumn, sorted, rows, start
+        and end (capture times as epoch seconds). rows, start and end are None where unknown.
+    """
+    combined_folder = os.path.join(query_id, "combined")
+    panelists_folder = os.path.join(combined_folder, "panelists")
+    panelists = sorted(os.listdir(panelists_folder)) if os.path.isdir(panelists_folder) else []
+
+    files = []
+    for panelist in panelists:
+        for prefix in CSV_PREFIXES:
+            csv_path = os.path.join(panelists_folder, panelist, "metadata", f"{prefix}-consolidated.csv")
+            if not os.path.exists(csv_path):
+                continue
+            columns = read_csv_header(csv_path)
+            index = load_csv_index(csv_path)
+            size = os.path.getsize(csv_path)
+            start, end = _csv_time_bounds(csv_path, index)
+            entry = {"panelist": panelist, "prefix": prefix, "format": "csv",
+                     "path": os.path.relpath(csv_path, combined_folder), "bytes": size, "columns": columns,
+                     "timeColumn": sort_column(columns), "sorted": index is not None,
+                     "rows": index["rows"] if index and index["size"] == size else None, "start": start, "end": end}
+            files.append(entry)
+
+            for output_format, extension in COLUMNAR_FORMATS.items():
+                columnar_path = os.path.splitext(csv_path)[0] + extension
+                if os.path.exists(columnar_path) and os.path.getmtime(columnar_path) >= os.path.getmtime(csv_path):
+                    files.append(dict(entry, format=output_format, path=os.path.relpath(columnar_path, combined_folder),
+                                      bytes=os.path.getsize(columnar_path)))
+
+    catalog = {"queryId": query_id, "created": datetime.now(timezone.utc).isoformat(), "files": files}
+    os.makedirs(combined_folder, exist_ok=True)
+    catalog_path = os.path.join(combined_folder, CATALOG_FILE)
+    with open(catalog_path + ".tmp", "w") as f:
+        json.dump(catalog, f, indent=2)
+    os.replace(catalog_path + ".tmp", catalog_path)
+    logging.info(f"Wrote the catalog of {len(files)} output files to {catalog_path}.")
+    return catalog
+
+
+def _coerce_cell(cell, value):
+    """
+    Converts a CSV cell to the type of the value it is compared with (the type of the first value for
+    'in'). Empty cells, like nulls in columnar files, match no comparison.
+
+    Raises:
+        ValueError: If the cell is empty or can't be converted.
+    """
+    if isinstance(value, (list, tuple, set, frozenset)):
+        value = next(iter(value), "")
+    if cell == "":
+        raise ValueError("empty cell")
+    if isinstance(value, bool):
+        return cell.lower() in ("true", "1")
+    if isinstance(value, (int, float)):
+        return float(cell)
+    return cell
+
+
+def _predicate_filter(column, arrow_type, op, value):
+    """
+    Builds the dataset filter of a frame predicate on a columnar file, comparing like _coerce_cell does
+    for CSVs: numbers with a numeric column as float64, strings with a string column, and empty
+    strings and nulls matching nothing.
+
+    Args:
+        column: Column name.
+        arrow_type: The column's type in the file.
+        op: One of FRAME_OPERATORS.
+        value: The value compared with, or the values for 'in'.
+
+    Returns:
+        pyarrow.dataset.Expression, or None if the value's type doesn't fit the column's type; the
+        predicate is then checked on the rows read, as for CSVs.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    values = list(value) if op == "in" else [value]
+    field = ds.field(column)
+    if (pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type)) and values and all(
+            isinstance(item, (int, float)) and not isinstance(item, bool) for item in values):
+        field, value_type = field.cast(pa.float64()), pa.float64()
+    elif pa.types.is_string(arrow_type) and values and all(isinstance(item, str) for item in values):
+        value_type = pa.string()
+    else:
+        return None
+
+    if op == "in":
+        condition = field.isin(pa.array(values, value_type))
+    else:
+        condition = FRAME_OPERATORS[op](field, pa.scalar(value, value_type))
+    return condition & (field != "") if value_type == pa.string() else condition
+
+
+class LazyFrame:
+    """
+    Lazily evaluated, chunked frame over one prefix of a run's consolidated outputs (see Catalog.frame).
+    select, where and between return narrowed frames; iterating a frame reads its files one panelist
+    at a time and yields pandas DataFrames of at most chunk_rows rows. Columns read from CSVs hold
+    strings; columns read from columnar files have the types of COLUMNAR_SCHEMAS.
+
+    Args:
+        entries: Catalog entries of the files to read, one per panelist, with absolute paths.
+        available: All columns of the prefix, including 'panelist'.
+        columns: Columns of the frame (default: all available).
+        predicates: (column, operator, value) filters that every row must pass (see FRAME_OPERATORS).
+        start: Earliest capture time as epoch seconds, or None.
+        end: Latest capture time as epoch seconds, or None.
+        chunk_rows: Most rows per chunk.
+    """
+
+    def __init__(self, entries, available, columns=None, predicates=(), start=None, end=None,
+                 chunk_rows=FRAME_CHUNK_ROWS):
+        self.entries = entries
+        self.available = available
+        self.columns = list(columns or available)
+        self.predicates = tuple(predicates)
+        self.start, self.end = start, end
+        self.chunk_rows = chunk_rows
+
+    def _narrow(self, **changes):
+        fields = {"entries": self.entries, "available": self.available, "columns": self.columns,
+                  "predicates": self.predicates, "start": self.start, "end": self.end, "chunk_rows": self.chunk_rows}
+        return LazyFrame(**{**fields, **changes})
+
+    def _check_columns(self, columns):
+        unknown = [column for column in columns if column not in self.available]
+        if unknown:
+            raise ValueError(f"Unknown columns: {', '.join(unknown)}")
+
+    def select(self, *columns):
+        """
+        Returns the frame projected to the given columns.
+        """
+        self._check_columns(columns)
+        return self._narrow(columns=list(columns))
+
+    def where(self, column, op, value):
+        """
+        Returns the frame with rows filtered by a comparison, e.g. where("app_name", "==", "Chrome") or
+        where("duration", ">", 30). The column doesn't need to be selected.
+        """
+        self._check_columns([column])
+        if op not in FRAME_OPERATORS:
+            raise ValueError(f"Unknown operator {op!r}; use one of {', '.join(FRAME_OPERATORS)}")
+        return self._narrow(predicates=self.predicates + ((column, op, value),))
+
+    def between(self, start=None, end=None):
+        """
+        Returns the frame restricted to rows captured between start and end (datetimes, inclusive).
+        Rows without a parseable capture time are left out.
+        """
+        start_ts = as_utc(start).timestamp() if start else None
+        end_ts = as_utc(end).timestamp() if end else None
+        if self.start is not None:
+            start_ts = self.start if start_ts is None else max(start_ts, self.start)
+        if self.end is not None:
+            end_ts = self.end if end_ts is None else min(end_ts, self.end)
+        return self._narrow(start=start_ts, end=end_ts)
+
+    def chunks(self):
+        """
+        Reads the frame.
+
+        Yields:
+            pandas.DataFrame: Up to chunk_rows matching rows, with the frame's columns.
+        """
+        for entry in self.entries:
+            # Files whose capture time range lies outside the frame's aren't opened
+            if self.start is not None and entry["end"] is not None and entry["end"] < self.start:
+                continue
+            if self.end is not None and entry["start"] is not None and entry["start"] > self.end:
+                continue
+            if entry["format"] == "csv":
+                yield from self._csv_chunks(entry)
+            else:
+                yield from self._columnar_chunks(entry)
+
+    __iter__ = chunks
+
+    def to_pandas(self):
+        """
+        Reads the whole frame into one pandas DataFrame.
+        """
+        import pandas as pd
+
+        chunks = list(self.chunks())
+        return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=self.columns)
+
+    def _csv_chunks(self, entry):
+        import pandas as pd
+
+        with open(entry["path"], 'rb') as f:
+            columns = parse_csv_header(f.readline())
+            if self.start is None and self.end is None:
+                rows = csv_rows(f)
+            else:
+                rows = time_range_rows(f, columns, load_csv_index(entry["path"]),
+                                       float('-inf') if self.start is None else self.start,
+                                       float('inf') if self.end is None else self.end)
+
+            # The panelist column of a CSV is its folder's
+            def getter(column):
+                if column not in columns:
+                    return (lambda row: entry["panelist"]) if column == "panelist" else (lambda row: None)
+                position = columns.index(column)
+                return lambda row: row[position] if position < len(row) else None
+
+            projection = [getter(column) for column in self.columns]
+            checks = [(getter(column), FRAME_OPERATORS[op], value) for column, op, value in self.predicates]
+
+            def matches(row):
+                for get, compare, value in checks:
+                    try:
+                        if not compare(_coerce_cell(get(row) or "", value), value):
+                            return False
+                    except (ValueError, TypeError):
+                        return False
+                return True
+
+            chunk = []
+            for row in rows:
+                if checks and not matches(row):
+                    continue
+                chunk.append([get(row) for get in projection])
+                if len(chunk) == self.chunk_rows:
+                    yield pd.DataFrame(chunk, columns=self.columns)
+                    chunk = []
+            if chunk:
+                yield pd.DataFrame(chunk, columns=self.columns)
+
+    def _columnar_chunks(self, entry):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.dataset as ds
+
+        dataset = ds.dataset(entry["path"], format="parquet" if entry["format"] == "parquet" else "ipc")
+        names = dataset.schema.names
+
+        conditions, checks = [], []
+        for column, op, value in self.predicates:
+            if column not in names:
+                # A column the file doesn't have is null, which matches no comparison
+                return
+            condition = _predicate_filter(column, dataset.schema.field(column).type, op, value)
+            if condition is None:
+                checks.append((column, FRAME_OPERATORS[op], value))
+            else:
+                conditions.append(condition)
+
+        time_column = entry["timeColumn"] if self.start is not None or self.end is not None else None
+        if time_column not in names:
+            time_column = None
+        if time_column and "date" in names:
+            # The date column lets the reader skip row groups by their statistics; the exact times are
+            # checked below
+            if self.start is not None:
+                conditions.append(ds.field("date") >= datetime.fromtimestamp(self.start, timezone.utc).date())
+            if self.end is not None:
+                conditions.append(ds.field("date") <= datetime.fromtimestamp(self.end, timezone.utc).date())
+        expression = functools.reduce(operator.and_, conditions) if conditions else None
+
+        read_columns = [column for column in self.columns if column in names]
+        for column in [time_column] + [column for column, _, _ in checks]:
+            if column and column not in read_columns:
+                read_columns.append(column)
+        start = float('-inf') if self.start is None else self.start
+        end = float('inf') if self.end is None else self.end
+
+        def in_range(value):
+            timestamp = row_timestamp(value) if value is not None else None
+            return timestamp is not None and start <= timestamp <= end
+
+        def matches(cells):
+            for cell, (_, compare, value) in zip(cells, checks):
+                try:
+                    if not compare(_coerce_cell(cell or "", value), value):
+                        return False
+                except (ValueError, TypeError):
+                    return False
+            return True
+
+        for batch in dataset.to_batches(columns=read_columns, filter=expression, batch_size=self.chunk_rows):
+            if time_column:
+                times = pc.cast(batch.column(time_column), pa.string()).to_pylist()
+                batch = batch.filter(pa.array([in_range(value) for value in times], pa.bool_()))
+            if checks and batch.num_rows:
+                # Predicates whose value doesn't fit the column's type compare the cells as text, as for CSVs
+                cells = zip(*(pc.cast(batch.column(column), pa.string()).to_pylist() for column, _, _ in checks))
+                batch = batch.filter(pa.array([matches(row) for row in cells], pa.bool_()))
+            if batch.num_rows:
+                yield batch.to_pandas().reindex(columns=self.columns)
+
+
+class Catalog:
+    """
+    Query interface over a run's consolidated outputs, backed by its combined/catalog.json. The catalog
+    is written if the run predates it.
+
+        catalog = Catalog("query_20240501_120000_1a2b3c4d")
+        frame = catalog.frame("session_data", start=datetime(2024, 5, 1), columns=["app_name", "duration"])
+        for chunk in frame.where("duration", ">", 30):
+            ...
+
+    Args:
+        query_id: Unique identifier for the query/download session.
+    """
+
+    def __init__(self, query_id):
+        self.query_id = query_id
+        try:
+            with open(os.path.join(query_id, "combined", CATALOG_FILE)) as f:
+                catalog = json.load(f)
+        except FileNotFoundError:
+            catalog = write_catalog(query_id)
+        self.files = catalog["files"]
+
+    def prefixes(self):
+        """
+        Returns the CSV prefixes the run has outputs for.
+        """
+        return [prefix for prefix in CSV_PREFIXES if any(entry["prefix"] == prefix for entry in self.files)]
+
+    def panelists(self, prefix=None):
+        """
+        Returns the panelists with outputs, of one prefix or of any.
+        """
+        return sorted({entry["panelist"] for entry in self.files if prefix in (None, entry["prefix"])})
+
+    def columns(self, prefix):
+        """
+        Returns the union of the columns of a prefix's outputs across panelists.
+        """
+        columns = []
+        for entry in self.files:
+            if entry["prefix"] == prefix:
+                columns.extend(column for column in entry["columns"] if column not in columns)
+        return columns
+
+    def frame(self, prefix, panelists=None, start=None, end=None, columns=None, chunk_rows=FRAME_CHUNK_ROWS):
+        """
+        Returns a lazy frame over a prefix's outputs.
+
+        Args:
+            prefix: One of CSV_PREFIXES.
+            panelists: Panelists to read, or None for all.
+            start: Earliest capture time as datetime, or None.
+            end: Latest capture time as datetime, or None.
+            columns: Columns to read, or None for all. Rows carry their panelist in the 'panelist' column.
+            chunk_rows: Most rows per chunk.
+
+        Returns:
+            LazyFrame: The frame; nothing is read until it is iterated.
+        """
+        if prefix not in self.prefixes():
+            raise ValueError(f"Query {self.query_id} has no {prefix} outputs")
+
+        # One file per panelist; a columnar file is read in preference to the CSV
+        entries = {}
+        for entry in self.files:
+            if entry["prefix"] != prefix or (panelists is not None and entry["panelist"] not in panelists):
+                continue
+            if entry["panelist"] not in entries or entries[entry["panelist"]]["format"] == "csv":
+                entries[entry["panelist"]] = dict(entry, path=os.path.join(self.query_id, "combined", entry["path"]))
+
+        available = self.columns(prefix)
+        if "panelist" not in available:
+            available.append("panelist")
+        frame = LazyFrame(list(entries.values()), available, chunk_rows=chunk_rows)
+        if columns is not None:
+            frame = frame.select(*columns)
+        return frame.between(start, end) if start or end else frame
@@ -1,622 +1,262 @@
-import multiprocessing
+import argparse
 import json
-import pathlib
-import shutil
-import uuid
-import zipfile
-import pandas as pd
-import pytz
-import boto3
-from tqdm import tqdm
 import logging
-import boto3
-from datetime import datetime, timedelta
-import os
-import cv2
-from PIL import Image
-import numpy as np
+import sys
+from datetime import datetime
 
-s3 = boto3.client('s3')
+from listing import (get_bucket_and_path, get_date_range_from_user, load_panel_tree, parse_date_range,
+                     select_panel_versions)
+from outputs import COLUMNAR_FORMATS
+from query import run_query
+from queryconfig import (QUERY_DEFAULTS, load_query_config, new_query_config, rerun_query_config,
+                         resume_query_from_user, set_batch_and_processors)
+from redact import DETECTOR_BACKENDS, FORMAT_EXTENSIONS
+from s3io import connect_to_s3, create_s3_client
+from workqueue import enqueue_query, work_query
 
-# Load the pre-trained face detection model
-face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
 
+# boto3, cv2/numpy and pyarrow are imported by the functions that use them, so that listing-only runs,
+# --help and worker processes of other stages don't pay for loading them
 
-# Step 1: Connect to AWS S3
-def connect_to_s3():
-    """
-    Connects to AWS S3 using existing credentials or prompts for new credentials.
-    Returns:
-        boto3 S3 client
-    """
-    credentials_path = os.path.expanduser("~/.aws/credentials")
-    config_path = os.path.expanduser("~/.aws/config")
-
-    # Check if AWS credentials and configuration files exist
-    if os.path.exists(credentials_path) and os.path.exists(config_path):
-        use_existing = input("AWS credentials are found. Use existing credentials? (y/n): ")
-        if use_existing.lower() == 'y' or not use_existing:
-            logging.info("Using existing AWS credentials.")
-        else:
-            aws_access_key = input("Enter AWS Access Key: ")
-            aws_secret_key = input("Enter AWS Secret Key: ")
-            return boto3.client('s3', aws_access_key_id=aws_access_key, aws_secret_access_key=aws_secret_key)
-    else:
-        aws_access_key = input("Enter AWS Access Key: ")
-        aws_secret_key = input("Enter AWS Secret Key: ")
-        return boto3.client('s3', aws_access_key_id=aws_access_key, aws_secret_access_key=aws_secret_key)
-
-    return boto3.client('s3')
-
-
-def get_date_range_from_user():
-    """
-    Prompts the user to input a date range and returns the start and end dates as datetime objects.
-    Returns:
-        tuple: start_date, end_date
-    """
-    start_date_str = input("Enter the start date (YYYY-MM-DD, or press Enter for 1 year ago): ")
-    end_date_str = input("Enter the end date (YYYY-MM-DD, or press Enter for today): ")
-
-    # Set default or specified start date
-    if not start_date_str:
-        start_date = datetime.now() - timedelta(days=365)
-    else:
-        start_date = datetime.strptime(start_date_str, "%Y-%m-%d")
-
-    # Set default or specified end date
-    if not end_date_str:
-        end_date = datetime.now()
-    else:
-        end_date = datetime.strptime(end_date_str, "%Y-%m-%d")
 
-    if start_date > end_date:
-        raise ValueError("Start date cannot be after end date.")
-    return start_date, end_date
+# Non-interactive runs
+# A run spec is a JSON (or YAML, if PyYAML is installed) file of query settings, using the keys of
+# query_config.json, plus a list of runs that each override them, e.g.
+#   {"bucketName": "screenlake-zip-prod", "startDate": "2024-01-01", "streaming": true,
+#    "runs": [{"path": "academia/tenant/a/panel/b/V_1/panelist/"}, {"path": "...", "batchSize": 50}]}
+# Instead of a path, a run can select panel versions from the cached panel tree by name or pattern:
+#   {"tenants": ["uni-*"], "panels": ["daily"], "versions": ["latest"]}
+# Every run (or selected version) becomes its own query, processed one after the other in the same process.
 
+# Run spec keys besides QUERY_DEFAULTS
+RUN_SPEC_KEYS = ("bucketName", "path", "startDate", "endDate")
 
-def list_folders_in_path(s3, bucket_name, path):
-    """
-    Lists folders in a specified path within an S3 bucket.
-    Args:
-        s3: Boto3 S3 client
-        bucket_name: Name of the S3 bucket
-        path: Path within the S3 bucket
-    Returns:
-        list: Folders under the specified path
-    """
-    response = s3.list_objects_v2(Bucket=bucket_name, Prefix=path, Delimiter='/')
-    common_prefixes = response.get('CommonPrefixes', [])
-    return [prefix.get('Prefix') for prefix in common_prefixes]
+# Run spec keys that select panel versions instead of a path
+RUN_SELECTION_KEYS = ("tenants", "panels", "versions")
 
 
-def get_bucket_and_path():
+def load_run_spec(spec_path):
     """
-    Interactively select a directory path within an AWS S3 bucket based on user input.
+    Loads a run spec file.
 
-    Returns:
-        Tuple containing the selected bucket name and directory path.
-    """
-    default_bucket_name = "screenlake-zip-prod"
-    s3 = boto3.client('s3')
-
-    # Prompt for the S3 bucket (default: screenlake-zip-prod)
-    bucket_name = input(f"Enter the S3 bucket name (default: {default_bucket_name}): ") or default_bucket_name
-
-    # Start with the base path and list folders
-    base_path = "academia/tenant/"
-    selected_path = base_path
-    selected_count = 0
-    header = 'tenant'
-    prevHeader = ''
-    seen_version = False
-    while True:
-        folders = list_folders_in_path(s3, bucket_name, selected_path)
-        if len(folders) >= 1:
-            if folders[len(folders) - 1].endswith("panel/"):
-                header = 'panel'
-                selected_path = folders[len(folders) - 1]
-                continue
-
-            if "V_" in folders[len(folders) - 1] and not seen_version:
-                seen_version = True
-                header = 'version'
-
-            # Ensure the selected path ends with 'panelist'
-            # if folders[len(folders) - 1].endswith("panelist/"):
-            #     selected_path = selected_path + "panelist"
-
-            if prevHeader == 'panelist':
-                header = 'Here is a list of panelist who will have CSVs created'
-
-        prevHeader = header
-        if not folders:
-            raise ValueError(f"No folders found at '{selected_path}'")
-
-        if folders[len(folders) - 1].endswith("panelist/"):
-            choice = '1'
-            selected_count = selected_count + 1
-            header = 'Here is a list of panelist who will have CSVs created'
-
-            return bucket_name, selected_path
-        else:
-            # Display folder options for user selection
-            logging.info(f'Select a {header}:')
-            for i, folder in enumerate(folders, start=1):
-                split_folders = folder.split('/')
-                folder_name = split_folders[len(split_folders) - 2]
-                print(f"{i}. {folder_name}")
-
-            choice = input("Enter the number corresponding to your choice (q to quit): ")
-            selected_count = selected_count + 1
-
-        if choice.lower() == 'q':
-            break
-
-        try:
-            if not choice:
-                choice = 1
-            choice = int(choice)
-            if 1 <= choice <= len(folders):
-                selected_folder = folders[choice - 1]
-                selected_path = selected_folder
-            else:
-                logging.info("Invalid choice. Please enter a valid number.")
-        except ValueError:
-            logging.info("Invalid input. Please enter a number or 'q' to quit.")
-
-    return bucket_name, selected_path
-
-
-# Step 3: Query by date range
-def query_by_date_range(s3, bucket_name, path, start_date, end_date):
-    """
-    Filters objects in an S3 bucket path by a date range.
     Args:
-        s3: Boto3 S3 client
-        bucket_name: Name of the S3 bucket
-        path: Path within the S3 bucket
-        start_date: Start of the date range as datetime
-        end_date: End of the date range as datetime
-    Returns:
-        list: Filtered S3 objects within the date range
-    """
-    objects = []
-    next_token = None
-
-    while True:
-        params = {
-            'Bucket': bucket_name,
-            'Prefix': path,
-            'ContinuationToken': next_token
-        }
-
-        response = s3.list_objects_v2(**params)
-        objects.extend(response.get('Contents', []))
-        next_token = response.get('NextContinuationToken')
-
-        if not next_token:
-            break
-
-    filtered_objects = []
-
-    for obj in objects:
-        last_modified = obj['LastModified']
-        if start_date <= last_modified <= end_date:
-            filtered_objects.append(obj)
-
-    return filtered_objects
-
-
-# Step 4: Set batch and processor parameters
-def set_batch_and_processors():
-    """
-    Sets up the batch size for zip file downloads and the number of processors to use.
-    Also prepares the directory structure for storing query results and configures a query ID.
+        spec_path: Path of a .json, .yaml or .yml file.
 
     Returns:
-        A tuple containing the batch size, number of processors, and the query ID.
-    """
-    # Prompt the user for batch size and number of processors with default values
-    try:
-        zip_batch_size = int(input("Enter the batch size for zip file downloads (default: 25): ") or 25)
-        num_processors = int(input("Enter the number of processors (default: 4): ") or 4)
-    except ValueError as e:
-        logging.error("Invalid input, please enter a number.")
-        raise e
-
-    # Generate a unique query ID for each session to avoid conflicts
-    query_id = f"query_1234"
-
-    # Configuration dictionary for the query
-    query_config = {
-        "queryId": query_id,
-        "batchSize": zip_batch_size,
-        "numFilesToDownload": 0,  # Initial setup, no files to download yet
-        "numFilesDownloaded": 0,  # Tracker for downloaded files
-        "lastBatchBeginId": ""    # Placeholder for tracking batches
-    }
-
-    # Prepare directories for zipped and unzipped files
-    directories = {
-        "base": query_id,
-        "zipped": os.path.join(query_id, "zipped"),
-        "unzipped": os.path.join(query_id, "unzipped")
-    }
-
-    # Create the directories if they don't exist
-    for directory in directories.values():
-        os.makedirs(directory, exist_ok=True)
-
-    # Save the query configuration to a JSON file
-    config_path = os.path.join(query_id, "query_config.json")
-    with open(config_path, "w") as config_file:
-        json.dump(query_config, config_file)
-
-    logging.info(f"Configuration saved to {config_path}.")
-    return zip_batch_size, num_processors, query_id
-
-
-
-# Step 5: Download zip files in batches
-def download_zip_files_in_batches(s3, bucket_name, path, start_date, end_date, zip_batch_size, num_processors,
-                                  query_id):
-    """
-     Downloads objects from S3 in batches, using multiple processes.
-
-     Args:
-         s3_client: Boto3 S3 client instance.
-         bucket_name: Name of the S3 bucket.
-         path: Path within the S3 bucket from which to download objects.
-         start_date: Start date for querying objects.
-         end_date: End date for querying objects.
-         zip_batch_size: Number of files to download in each batch.
-         num_processors: Number of parallel processes to use for downloading.
-         query_id: Unique identifier for the query/download session.
-     """
-    objects_to_download = query_s3_objects_in_date_range(s3, bucket_name, path, start_date, end_date)
-    num_objects = len(objects_to_download)
-
-    # Divide the objects into batches
-    object_batches = [objects_to_download[i:i + zip_batch_size] for i in range(0, num_objects, zip_batch_size)]
-
-    processes = []
-    downloaded_count = 0
-    with tqdm(total=len(object_batches), desc="Batches") as pbar_batch:
-        for batch in object_batches:
-            if len(processes) == num_processors or len(processes) == len(object_batches):
-                for process in processes:
-                    pbar_batch.update(1)
-                    process.join()
-
-                processes = []
-            else:
-                process = multiprocessing.Process(target=download_batch,
-                                                  args=(batch, query_id, bucket_name))
-                process.start()
-                processes.append(process)
-
-            if len(processes) == len(object_batches):
-                for process in processes:
-                    process.join()
-
-
-def download_batch(batch, query_id, bucket_name):
-    """
-    Downloads a batch of files from an S3 bucket.
-
-    Args:
-        s3_client: Boto3 S3 client instance.
-        batch: List of objects to download.
-        query_id: Unique identifier for the query/download session.
-        bucket_name: Name of the S3 bucket.
-    """
-    for obj in tqdm(batch, desc="Downloading files"):
-        file_path = os.path.join(f'{query_id}/zipped', *obj['Key'].split('/')[1:])  # Construct local file path
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)  # Ensure the directory exists
-
-        # Download file if it doesn't already exist
-        if not os.path.exists(file_path):
-            s3.download_file(bucket_name, obj['Key'], file_path)
-
-def query_s3_objects_in_date_range(s3, bucket_name, path, start_date, end_date):
-    objects = []
-
-    next_token = None
-
-    count = 0  # Initialize a count variable to track the number of files fetched
-
-    while True:
-        params = {
-            'Bucket': bucket_name,
-            'Prefix': path
-        }
-
-        if next_token:
-            params['ContinuationToken'] = next_token  # Include ContinuationToken if it exists
-
-        response = s3.list_objects_v2(**params)
-        objects.extend(response.get('Contents', []))
-
-        if 'NextContinuationToken' in response:
-            next_token = response['NextContinuationToken']
-        else:
-            break  # Exit the loop when there are no more objects to fetch
-
-    filtered_objects = []
-
-    for obj in objects:
-        start_date = start_date.replace(tzinfo=pytz.UTC)
-        end_date = end_date.replace(tzinfo=pytz.UTC)
-        last_modified = obj['LastModified']
-        last_modified = last_modified.replace(tzinfo=pytz.UTC)  # Make sure LastModified is timezone-aware
-        if start_date <= last_modified <= end_date:
-            filtered_objects.append(obj)
-            count += 1  # Increment the count for each file fetched
-            logging.info(f"Files fetched: {count}",
-                         end='\r')  # Print the count with carriage return to overwrite the line
-
-    # Print a newline to separate the progress count
-    logging.info("")
-
-    return filtered_objects
-
-
-def unzip_file(zip_file, destination_folder, image_folder):
-    """
-    Unzips a file to a specified destination folder, with additional processing for images.
-
-    Args:
-        zip_file: Path to the zip file.
-        destination_folder: Folder where files should be extracted to.
-        image_folder: Folder where images should be stored after processing.
-    """
-    try:
-        count_of_existing_files, count_of_non_existing_files = 0, 0
-
-        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-            for file_info in zip_ref.infolist():
-                # Determine the extraction path
-                extracted_file_path = os.path.join(destination_folder, file_info.filename)
-                is_image = file_info.filename.lower().endswith(('.jpg', '.jpeg'))
-
-                if file_info.filename.endswith('.csv') or is_image:
-                    # Check if the file already exists to avoid re-extraction
-                    if not os.path.exists(extracted_file_path):
-                        zip_ref.extract(file_info, destination_folder)
-                        logging.info(f"Extracted: {file_info.filename}")
-
-                        if is_image:
-                            # Additional processing for images
-                            processed_image_path = os.path.join(image_folder, file_info.filename)
-                            detect_and_redact_faces(extracted_file_path, processed_image_path)
-                            count_of_non_existing_files += 1
-                    else:
-                        count_of_existing_files += 1
-
-            logging.info(f"Existing files count: {count_of_existing_files}")
-            logging.info(f"Processed new files count: {count_of_non_existing_files}")
-
-        # Attempt to remove the original zip file after extraction
-        try:
-            # os.remove(zip_file)
-            logging.info(f"Removed zip file: {zip_file}")
-        except OSError as e:
-            logging.error(f"Error deleting zip file {zip_file}: {e}")
-
-    except Exception as e:
-        logging.error(f"Error unzipping {zip_file}: {e}")
-
-def process_child_folder_and_unzip_synchronous(parent, children, query_id):
+        dict: The spec's top-level settings, with the list of runs under 'runs'.
     """
-    Unzips child folders synchronously within a given parent directory.
-
-    Args:
-        parent: Parent directory containing child folders.
-        children: List of child folders to be unzipped.
-        query_id: Unique identifier for the operation, used in directory structuring.
-    """
-    for child in children:
-        child_path = os.path.join(parent, child)
-        destination_folder = f"{query_id}/unzipped/panelists/{os.path.basename(parent)}"
-        image_folder = f"{query_id}/combined/panelists/{os.path.basename(parent)}/images"
-
-        # Create destination and image folders
-        os.makedirs(destination_folder, exist_ok=True)
-        os.makedirs(image_folder, exist_ok=True)
-
-        unzip_file(child_path, destination_folder, image_folder)
-
-
-def process_child_folder_and_unzip_async(path):
-    """
-    Asynchronously unzips all child folders within a specified path.
-
-    Args:
-        path: Path containing child folders to be unzipped.
-    """
-    zipped_child_folders = []
-    result_dict = {}
-    # Get a list of child folders with their full paths
-    for root, dirs, files in os.walk(path):
-        for dir_name in dirs:
-            child_folder = os.path.join(root, dir_name)
-            zipped_child_folders.append(child_folder)
-
-            child_files = [file for file in os.listdir(child_folder) if file.endswith('.zip')]
-            result_dict[child_folder] = child_files
-
-    # Create a pool of worker processes
-    num_processes = multiprocessing.cpu_count()
-    processes = []
-
-    for key in result_dict:
-        if len(processes) == num_processes:
-            for process in processes:
-                process.join()
-
-            processes = []
+    with open(spec_path) as spec_file:
+        if spec_path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("YAML run specs need PyYAML; install it or use a JSON spec.")
+            spec = yaml.safe_load(spec_file)
         else:
-            process = multiprocessing.Process(target=process_child_folder_and_unzip_synchronous,
-                                              args=(key, list(result_dict[key]), path))
-            process.start()
-            processes.append(process)
+            spec = json.load(spec_file)
 
-        if len(processes) == len(zipped_child_folders):
-            for process in processes:
-                process.join()
+    if not isinstance(spec, dict):
+        raise ValueError(f"Run spec {spec_path} must be a mapping of settings")
+    return spec
 
 
-def process_child_folders_csvs(path):
+def query_config_from_run(run):
     """
-    Gathers CSV files from child folders within a given directory.
+    Creates the query described by a run spec entry.
 
     Args:
-        path (str): The path to the parent directory.
+        run: Run settings: bucketName, path, startDate and endDate (YYYY-MM-DD), and any QUERY_DEFAULTS.
 
     Returns:
-        dict: A mapping of child folder names to lists of their CSV files.
+        dict: The query configuration.
     """
-    result_dict = {}
-
-    for root, dirs, _ in os.walk(path):
-        for dir_name in dirs:
-            child_folder = os.path.join(root, dir_name)
-            child_files = [os.path.join(child_folder, file) for file in os.listdir(child_folder) if
-                           file.endswith('.csv')]
+    unknown = set(run) - set(RUN_SPEC_KEYS) - set(QUERY_DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown run spec keys: {', '.join(sorted(unknown))}")
+    if not run.get("path"):
+        raise ValueError("Every run needs a 'path'")
 
-            # Include folder only if it contains CSV files
-            if child_files:
-                result_dict[dir_name] = child_files
+    # YAML loads unquoted dates as date objects
+    start_date, end_date = parse_date_range(*(str(run[key]) if run.get(key) else None
+                                              for key in ("startDate", "endDate")))
+    settings = {key: value for key, value in run.items() if key in QUERY_DEFAULTS}
+    return new_query_config(run.get("bucketName") or "screenlake-zip-prod", run["path"], start_date, end_date,
+                            settings)
 
-    return result_dict
 
-
-def detect_and_redact_faces(input_image_path, output_image_path, redaction_type='redact'):
+def parse_args(argv=None):
     """
-    Detects faces in an image and applies redaction or blurring.
-
-    Args:
-        input_image_path (str): Path to the input image.
-        output_image_path (str): Path where the processed image will be saved.
-        redaction_type (str): The type of processing ('redact' or 'blur') to apply to detected faces.
+    Parses the command line. Without --spec, --path, a panel selection, --resume or --rerun the script
+    runs interactively.
     """
-    image = cv2.imread(input_image_path)
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
-
-    for (x, y, w, h) in faces:
-        if redaction_type == 'blur':
-            blur_face(image, x, y, w, h)
-        else:  # Default to 'redact' for any other input
-            redact_face(image, x, y, w, h)
-
-    cv2.imwrite(output_image_path, image)
-
-def blur_face(image, x, y, w, h):
+    parser = argparse.ArgumentParser(description="Download, redact and consolidate Screenlake panel data from S3.")
+    parser.add_argument("--spec", help="JSON/YAML run spec listing one or more runs.")
+    parser.add_argument("--resume", nargs="+", metavar="QUERY_ID", help="Resume these queries.")
+    parser.add_argument("--rerun", nargs="+", metavar="QUERY_ID",
+                        help="Rerun these queries up to --end-date (default: now), processing only the objects "
+                             "that are new or changed since their last run.")
+    parser.add_argument("--distributed", action="store_true",
+                        help="Queue the queries' shards for workers (see --work) instead of running them here.")
+    parser.add_argument("--shard-by", dest="shardBy", choices=("panelist", "hash"),
+                        help="Shard a distributed query per panelist (default) or by key hash.")
+    parser.add_argument("--shards", dest="numShards", metavar="N", type=int, help="Number of shards by key hash.")
+    parser.add_argument("--work", nargs="+", metavar="QUERY_ID",
+                        help="Work on these distributed queries until their queues are drained.")
+    parser.add_argument("--bucket", dest="bucketName", metavar="BUCKET", help="S3 bucket (default: screenlake-zip-prod).")
+    parser.add_argument("--path", nargs="+", dest="paths", metavar="PATH",
+                        help="Panelist folder paths; each becomes its own query.")
+    parser.add_argument("--tenant", nargs="+", dest="tenants", metavar="NAME",
+                        help="Select panel versions of these tenants (names or patterns).")
+    parser.add_argument("--panel", nargs="+", dest="panels", metavar="NAME", help="Select these panels.")
+    parser.add_argument("--version", nargs="+", dest="versions", metavar="NAME",
+                        help="Select these versions, or 'latest'.")
+    parser.add_argument("--refresh-tree", action="store_true", help="Crawl the panel tree even if cached.")
+    parser.add_argument("--start-date", dest="startDate", metavar="DATE", help="YYYY-MM-DD (default: one year ago).")
+    parser.add_argument("--end-date", dest="endDate", metavar="DATE", help="YYYY-MM-DD (default: today).")
+    parser.add_argument("--date-levels", dest="dateLevels", nargs="+", metavar="LEVEL", type=int,
+                        help="Folder levels below the path that are date partitions (YYYY-MM-DD, YYYYMMDD or "
+                             "date=YYYY-MM-DD); partitions after the end date are skipped. Default: none.")
+    parser.add_argument("--batch-size", dest="batchSize", metavar="N", type=int)
+    parser.add_argument("--processors", dest="numProcessors", metavar="N", type=int)
+    parser.add_argument("--download-concurrency", dest="downloadConcurrency", metavar="N", type=int)
+    parser.add_argument("--max-bandwidth", type=float, help="Total download bandwidth cap in MB/s.")
+    parser.add_argument("--memory-limit", type=float,
+                        help="Memory ceiling in MB; listing and downloads pause while the pipeline holds more.")
+    parser.add_argument("--streaming", action="store_true", default=None,
+                        help="Stream zips in memory without staging them on disk.")
+    parser.add_argument("--output-format", dest="outputFormat", choices=('csv',) + tuple(COLUMNAR_FORMATS))
+    parser.add_argument("--detection-mode", dest="detectionMode", choices=("full", "fast"))
+    parser.add_argument("--detection-scale", dest="detectionScale", metavar="SCALE", type=float)
+    parser.add_argument("--detector", choices=tuple(DETECTOR_BACKENDS), help="Face detector backend (default: haar).")
+    parser.add_argument("--detector-model", dest="detectorModel", metavar="PATH",
+                        help="Model file of the ssd (.caffemodel) or yunet (.onnx) detector.")
+    parser.add_argument("--detector-config", dest="detectorConfig", metavar="PATH",
+                        help="deploy.prototxt of the ssd detector.")
+    parser.add_argument("--detector-threads", dest="detectorThreads", metavar="N", type=int,
+                        help="OpenCV threads per worker process.")
+    parser.add_argument("--redaction-cache-size", dest="redactionCacheSize", metavar="N", type=int,
+                        help="Reuse face boxes for frames identical to one of a panelist's N most recent frames "
+                             "(default: 0, off).")
+    parser.add_argument("--image-format", dest="imageFormat", choices=("source",) + tuple(FORMAT_EXTENSIONS),
+                        help="Format of saved images (default: source, each image's own).")
+    parser.add_argument("--image-quality", dest="imageQuality", metavar="Q", type=int,
+                        help="JPEG/WebP quality of re-encoded images (default: 95).")
+    parser.add_argument("--turbojpeg", action="store_true", default=None,
+                        help="Encode JPEGs with PyTurboJPEG (libjpeg-turbo).")
+    parser.add_argument("--image-workers", dest="imageWorkers", metavar="N", type=int,
+                        help="Redact images in a separate pool of N processes, balanced per image.")
+    parser.add_argument("--output-uri", dest="outputUri", metavar="URI",
+                        help="Upload redacted images and consolidated outputs to s3://bucket/prefix.")
+    parser.add_argument("--members", metavar="EXPR",
+                        help="Process only matching zip members, e.g. 'type:csv prefix:session_data' or "
+                             "'type:image since:2024-05-01 until:2024-05-07'.")
+    parser.add_argument("--metadata-only", action="store_true", help="Skip image members (same as --members type:csv).")
+    parser.add_argument("--sort", dest="sortOutputs", action="store_true", default=None,
+                        help="Sort consolidated CSVs by capture time, drop duplicate rows and merge panelists.")
+    parser.add_argument("--dedupe-key", dest="dedupeKey", nargs="+", metavar="COLUMN",
+                        help="Columns identifying duplicate rows besides the capture time (default: whole rows).")
+    parser.add_argument("--autotune", action="store_true", default=None,
+                        help="Tune download concurrency, batch size and image workers while the run goes, "
+                             "starting from the settings of the last tuned run on this kind of machine.")
+    parser.add_argument("--metrics", metavar="PATH",
+                        help="Export metrics to this .jsonl or Prometheus .prom file (default: <query>/metrics.jsonl).")
+    parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args(argv)
+    if args.rerun and args.distributed:
+        parser.error("--rerun runs queries here; it can't be combined with --distributed")
+    return args
+
+
+def query_configs_from_args(args):
     """
-    Applies Gaussian blurring to a face region in the image.
-
-    Args:
-        image: The image array.
-        x, y: The top-left corner of the face bounding box.
-        w, h: The width and height of the bounding box.
+    Yields the configuration of every query requested on the command line, creating new queries as
+    they are reached so that a long list of runs doesn't leave empty query folders behind on failure.
     """
-    region_of_interest = image[y:y+h, x:x+w]
-    blurred = cv2.GaussianBlur(region_of_interest, (99, 99), 30)
-    image[y:y+h, x:x+w] = blurred
+    for query_id in args.resume or []:
+        yield load_query_config(query_id)
+    end_date = datetime.strptime(args.endDate, "%Y-%m-%d") if args.endDate else None
+    for query_id in args.rerun or []:
+        yield rerun_query_config(query_id, end_date)
+
+    selection = {key: getattr(args, key) for key in RUN_SELECTION_KEYS if getattr(args, key)}
+    if not args.spec and not args.paths and not selection:
+        return
+
+    spec = load_run_spec(args.spec) if args.spec else {}
+    defaults = {key: value for key, value in spec.items() if key != "runs"}
+    overrides = {key: value for key, value in vars(args).items()
+                 if value is not None and (key in RUN_SPEC_KEYS or key in QUERY_DEFAULTS)}
+    if args.max_bandwidth is not None:
+        overrides["maxBandwidth"] = int(args.max_bandwidth * 1024 * 1024) or None
+    if args.memory_limit is not None:
+        overrides["memoryLimit"] = int(args.memory_limit * 1024 * 1024) or None
+    if args.metadata_only:
+        overrides["members"] = " ".join(filter(None, ["type:csv", overrides.get("members")]))
+
+    # Paths or a selection given on the command line replace the spec's runs, keeping its top-level settings
+    if args.paths:
+        runs = [{"path": path} for path in args.paths]
+    elif selection:
+        runs = [selection]
+    else:
+        runs = spec.get("runs") or [{}]
+
+    panel_trees = {}
+    for run in runs:
+        run = {**defaults, **run, **overrides}
+        run_selection = {key: run.pop(key) for key in RUN_SELECTION_KEYS if key in run}
+        if "path" in run or not run_selection:
+            yield query_config_from_run(run)
+            continue
+
+        bucket_name = run.get("bucketName") or "screenlake-zip-prod"
+        if bucket_name not in panel_trees:
+            panel_trees[bucket_name] = load_panel_tree(None, bucket_name, refresh=args.refresh_tree)
+        selected = select_panel_versions(panel_trees[bucket_name], run_selection.get("tenants"),
+                                         run_selection.get("panels"), run_selection.get("versions"))
+        if not selected:
+            logging.warning(f"No panel versions match {run_selection}")
+        for entry in selected:
+            yield query_config_from_run(dict(run, path=entry["path"]))
 
-def redact_face(image, x, y, w, h):
-    """
-    Fills a face region in the image with black to redact it.
 
-    Args:
-        image: The image array.
-        x, y: The top-left corner of the face bounding box.
-        w, h: The width and height of the bounding box.
-    """
-    image[y:y+h, x:x+w] = (0, 0, 0)
-def delete_folder(folder_path):
-    """
-    Deletes a folder and all its contents.
-
-    Args:
-        folder_path (str): The path to the folder to be deleted.
-    """
-    try:
-        # Remove the folder and all its contents
-        shutil.rmtree(folder_path)
-        print(f"Successfully deleted the folder: {folder_path}")
-    except FileNotFoundError:
-        print("The folder does not exist.")
-    except Exception as e:
-        print(f"An error occurred: {e}")
-
-def combine_csv_files(input_dict, query_id):
-    output_folder = f"{query_id}/combined"
-
-    for folder, csv_files in input_dict.items():
-        prefix_dict = {}
-
-        # Group CSV files by prefixƒ
-        for csv_file in csv_files:
-            filename = os.path.basename(csv_file)
-
-            # Check if the prefix matches one of the specified prefixes
-            valid_prefixes = ["screenshot_data", "app_accessibility_data", "app_segment_data", "session_data"]
-            for prefix in valid_prefixes:
-                if filename.startswith(prefix):
-                    if prefix not in prefix_dict:
-                        prefix_dict[prefix] = []
-                        prefix_dict[prefix].append(csv_file)
-                    else:
-                        prefix_dict[prefix].append(csv_file)
-
-        panelist_folder = os.path.join(os.path.join(output_folder, 'panelists'), folder + '/metadata')
-        print(panelist_folder)
-        pathlib.Path(panelist_folder).mkdir(parents=True, exist_ok=True)
-
-        # Combine CSV files within each prefix group
-        for prefix, files in prefix_dict.items():
-            combined_csv = os.path.join(panelist_folder, f"{prefix}-consolidated.csv")
-            header_written = False
-
-            for file in files:
-                df = pd.read_csv(file)
-                if not header_written:
-                    df.to_csv(combined_csv, index=False)
-                    header_written = True
+# Step 7: Main function to orchestrate the workflow
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper())
+
+    if args.spec or args.paths or args.resume or args.rerun or args.tenants or args.panels or args.versions or args.work:
+        # Runs are independent: a failing query is recorded as interrupted and the next one starts
+        s3, failed = create_s3_client(), []
+        for query_config in query_configs_from_args(args):
+            try:
+                if args.distributed:
+                    enqueue_query(query_config, s3)
                 else:
-                    df.to_csv(combined_csv, mode='a', header=False, index=False)
-
+                    run_query(query_config, s3, args.metrics)
+            except Exception as e:
+                logging.error(f"Query {query_config['queryId']} failed: {e}")
+                failed.append(query_config["queryId"])
+        for query_id in args.work or []:
+            try:
+                work_query(query_id, s3, args.metrics)
+            except Exception as e:
+                logging.error(f"Query {query_id} failed: {e}")
+                failed.append(query_id)
+        if failed:
+            logging.error(f"Failed queries: {', '.join(failed)}")
+            sys.exit(1)
+        return
 
-# if __name__ == "__main__":
-#     # Example usage:
-#     folder_dict = {
-#         "folder1": ["folder1/screenshot_data_1.csv", "folder1/screenshot_data_2.csv", "folder1/screenshot_data_3.csv"],
-#         "folder2": ["folder2/accessibility_data_1.csv", "folder2/accessibility_data_2.csv"],
-#         "folder3": ["folder3/app_segement_data_1.csv", "folder3/app_segement_data_2.csv"],
-#         "folder4": ["folder4/session_data_1.csv"]
-#     }
-#
-#     combine_csv_files(folder_dict)
-
-
-# Step 7: Main function to orchestrate the workflow
-def main():
     s3 = connect_to_s3()
-    bucket_name, path = get_bucket_and_path()
-    start_date, end_date = get_date_range_from_user()
-
-    zip_batch_size, num_processors, query_id = set_batch_and_processors()
-    download_zip_files_in_batches(s3, bucket_name, path, start_date, end_date, zip_batch_size, num_processors, query_id)
-    process_child_folder_and_unzip_async(query_id)
-
-    result = process_child_folders_csvs(os.path.join(query_id, 'unzipped'))
-    combine_csv_files(result, query_id)
 
-    delete_folder(os.path.join(query_id, "unzipped"))
-    delete_folder(os.path.join(query_id, "zipped"))
+    # A resumed or rerun query reuses its recorded selection; its manifest skips everything already processed
+    query_config = resume_query_from_user()
+    if query_config is None:
+        bucket_name, path = get_bucket_and_path()
+        start_date, end_date = get_date_range_from_user()
+        query_config = set_batch_and_processors(bucket_name, path, start_date, end_date)
+    run_query(query_config, s3, args.metrics)
 
 if __name__ == "__main__":
     main()
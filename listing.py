@@ -0,0 +1,506 @@
+import collections
+import fnmatch
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+
+from metrics import count_metric, metric_span
+from s3io import create_s3_client
+
+
+# Date ranges
+def get_date_range_from_user():
+    """
+    Prompts the user to input a date range and returns the start and end dates as datetime objects.
+    Returns:
+        tuple: start_date, end_date
+    """
+    start_date_str = input("Enter the start date (YYYY-MM-DD, or press Enter for 1 year ago): ")
+    end_date_str = input("Enter the end date (YYYY-MM-DD, or press Enter for today): ")
+    return parse_date_range(start_date_str, end_date_str)
+
+
+def parse_date_range(start_date_str=None, end_date_str=None):
+    """
+    Parses a YYYY-MM-DD date range, defaulting to the year up to today.
+
+    Args:
+        start_date_str: Start date, or None/empty for one year ago.
+        end_date_str: End date, or None/empty for today.
+
+    Returns:
+        tuple: start_date, end_date
+    """
+    # Set default or specified start date
+    if not start_date_str:
+        start_date = datetime.now() - timedelta(days=365)
+    else:
+        start_date = datetime.strptime(start_date_str, "%Y-%m-%d")
+
+    # Set default or specified end date
+    if not end_date_str:
+        end_date = datetime.now()
+    else:
+        end_date = datetime.strptime(end_date_str, "%Y-%m-%d")
+
+    if start_date > end_date:
+        raise ValueError("Start date cannot be after end date.")
+    return start_date, end_date
+
+
+def list_folders_in_path(s3, bucket_name, path):
+    """
+    Lists folders in a specified path within an S3 bucket, following every page of results.
+    Args:
+        s3: Boto3 S3 client
+        bucket_name: Name of the S3 bucket
+        path: Path within the S3 bucket
+    Returns:
+        list: Folders under the specified path
+    """
+    folders = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=path, Delimiter='/'):
+        folders.extend(prefix.get('Prefix') for prefix in page.get('CommonPrefixes', []))
+    return folders
+
+
+# Step 2: Discover the panel tree
+# Panel data is laid out as <base>/<tenant>/panel/<panel>/<version>/panelist/<panelist>/. The tree is
+# crawled concurrently, level by level, down to the folders that contain 'panelist/', and cached locally
+# so that repeated runs select tenants, panels and versions without listing S3 again.
+
+PANEL_BASE_PATH = "academia/tenant/"
+
+# Where crawled panel trees are cached, and for how long they are trusted
+PANEL_TREE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "screenlake")
+PANEL_TREE_TTL = 24 * 60 * 60
+
+# Levels below the base path at which the crawl stops looking for 'panelist/' folders
+_PANEL_TREE_MAX_DEPTH = 6
+
+
+def _panel_entry(version_path, base_path, num_panelists):
+    """
+    Describes a version folder of the panel tree by the names of its tenant, panel and version.
+    """
+    parts = version_path[len(base_path):].strip('/').split('/')
+    return {
+        "tenant": parts[0],
+        "panel": parts[2] if len(parts) > 2 and parts[1] == 'panel' else None,
+        "version": parts[-1] if len(parts) > 1 else None,
+        "path": version_path,
+        "panelists": num_panelists,
+    }
+
+
+def crawl_panel_tree(s3, bucket_name, base_path=PANEL_BASE_PATH, max_workers=16, count_panelists=True):
+    """
+    Crawls the panel tree under base_path, listing the folders of each level concurrently.
+
+    Args:
+        s3: Boto3 S3 client; it should allow max_workers connections.
+        bucket_name: Name of the S3 bucket.
+        base_path: Path whose child folders are the tenants.
+        max_workers: Number of concurrent list requests.
+        count_panelists: Also list the panelist folders of every version to count them.
+
+    Returns:
+        list: One entry per version folder (a folder containing 'panelist/'), with its tenant, panel
+        and version names, path and number of panelists (None if not counted), sorted by path.
+    """
+    versions = []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(list_folders_in_path, s3, bucket_name, base_path): (base_path, 0)}
+        panelist_counts = {}
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                prefix, depth = pending.pop(future)
+                folders = future.result()
+
+                if depth < 0:
+                    # Listing of a version's panelist/ folder
+                    panelist_counts[prefix] = len(folders)
+                    continue
+
+                panelist_folders = [folder for folder in folders if folder.endswith('/panelist/')]
+                if panelist_folders and depth > 0:
+                    versions.append(prefix)
+                    if count_panelists:
+                        pending[executor.submit(list_folders_in_path, s3, bucket_name, panelist_folders[0])] = (prefix, -1)
+                elif depth < _PANEL_TREE_MAX_DEPTH:
+                    for folder in folders:
+                        pending[executor.submit(list_folders_in_path, s3, bucket_name, folder)] = (folder, depth + 1)
+
+    return [_panel_entry(version, base_path, panelist_counts.get(version)) for version in sorted(versions)]
+
+
+def _panel_tree_cache_path(bucket_name, base_path):
+    name = re.sub(r'[^A-Za-z0-9_.-]+', '_', f"{bucket_name}_{base_path}").strip('_')
+    return os.path.join(PANEL_TREE_CACHE_DIR, f"panel_tree_{name}.json")
+
+
+def load_panel_tree(s3, bucket_name, base_path=PANEL_BASE_PATH, ttl=PANEL_TREE_TTL, refresh=False):
+    """
+    Returns the panel tree of a bucket from the local cache, crawling S3 only if the cached tree is
+    missing, older than ttl seconds or a refresh is requested.
+
+    Args:
+        s3: Boto3 S3 client, or None to create one when a crawl is needed.
+        bucket_name: Name of the S3 bucket.
+        base_path: Path whose child folders are the tenants.
+        ttl: Maximum age of a cached tree in seconds.
+        refresh: Crawl even if the cached tree is still fresh.
+
+    Returns:
+        list: Version entries as returned by crawl_panel_tree.
+    """
+    cache_path = _panel_tree_cache_path(bucket_name, base_path)
+    if not refresh and os.path.exists(cache_path):
+        try:
+            with open(cache_path) as cache_file:
+                cached = json.load(cache_file)
+            if time.time() - cached["crawledAt"] < ttl:
+                return cached["versions"]
+        except (ValueError, KeyError) as e:
+            logging.warning(f"Ignoring unreadable panel tree cache {cache_path}: {e}")
+
+    if s3 is None:
+        s3 = create_s3_client(max_pool_connections=16)
+    started = time.monotonic()
+    versions = crawl_panel_tree(s3, bucket_name, base_path)
+    logging.info(f"Crawled {len(versions)} panel versions in {time.monotonic() - started:.1f}s")
+
+    os.makedirs(PANEL_TREE_CACHE_DIR, exist_ok=True)
+    temp_path = cache_path + f".{os.getpid()}.tmp"
+    with open(temp_path, "w") as cache_file:
+        json.dump({"bucketName": bucket_name, "basePath": base_path, "crawledAt": time.time(),
+                   "versions": versions}, cache_file)
+    os.replace(temp_path, cache_path)
+    return versions
+
+
+def _version_number(entry):
+    match = re.search(r'(\d+)$', entry["version"] or "")
+    return int(match.group(1)) if match else -1
+
+
+def select_panel_versions(versions, tenants=None, panels=None, version_names=None):
+    """
+    Selects version folders of a panel tree by tenant, panel and version name.
+
+    Args:
+        versions: Version entries as returned by load_panel_tree.
+        tenants: Tenant names or shell-style patterns (e.g. 'uni-*'); None selects every tenant.
+        panels: Panel names or patterns; None selects every panel.
+        version_names: Version names or patterns (e.g. 'V_2'), or 'latest' for each panel's highest
+            version; None selects every version.
+
+    Returns:
+        list: The selected version entries.
+    """
+    def matches(name, patterns):
+        return patterns is None or any(fnmatch.fnmatchcase(name or "", pattern) for pattern in patterns)
+
+    candidates = [entry for entry in versions if matches(entry["tenant"], tenants) and matches(entry["panel"], panels)]
+    if version_names is None:
+        return candidates
+
+    patterns = [name for name in version_names if name != 'latest']
+    selected = [entry for entry in candidates if patterns and matches(entry["version"], patterns)]
+
+    if 'latest' in version_names:
+        latest = {}
+        for entry in candidates:
+            key = (entry["tenant"], entry["panel"])
+            if key not in latest or _version_number(entry) > _version_number(latest[key]):
+                latest[key] = entry
+        selected += [entry for entry in latest.values() if entry not in selected]
+
+    return sorted(selected, key=lambda entry: entry["path"])
+
+
+def _choose(options, header):
+    """
+    Prompts for one of a list of names; returns None if the user quits.
+    """
+    logging.info(f'Select a {header}:')
+    for i, option in enumerate(options, start=1):
+        print(f"{i}. {option}")
+
+    while True:
+        choice = input("Enter the number corresponding to your choice (q to quit): ") or '1'
+        if choice.lower() == 'q':
+            return None
+        try:
+            if 1 <= int(choice) <= len(options):
+                return options[int(choice) - 1]
+        except ValueError:
+            pass
+        logging.info("Invalid choice. Please enter a valid number or 'q' to quit.")
+
+
+def get_bucket_and_path():
+    """
+    Interactively select a panel version within an AWS S3 bucket, from the cached panel tree.
+
+    Returns:
+        Tuple containing the selected bucket name and directory path.
+    """
+    default_bucket_name = "screenlake-zip-prod"
+
+    # Prompt for the S3 bucket (default: screenlake-zip-prod)
+    bucket_name = input(f"Enter the S3 bucket name (default: {default_bucket_name}): ") or default_bucket_name
+    refresh = input("Refresh the cached list of panels? (y/n, default: n): ").lower() == 'y'
+    versions = load_panel_tree(None, bucket_name, refresh=refresh)
+    if not versions:
+        raise ValueError(f"No panels found at '{PANEL_BASE_PATH}'")
+
+    selection = versions
+    for field, header in (("tenant", "tenant"), ("panel", "panel"), ("version", "version")):
+        options = sorted({entry[field] for entry in selection}, key=str)
+        choice = options[0] if len(options) == 1 else _choose(options, header)
+        if choice is None:
+            raise SystemExit("No panel selected.")
+        selection = [entry for entry in selection if entry[field] == choice]
+
+    entry = selection[0]
+    logging.info(f"Selected {entry['path']} ({entry['panelists']} panelists)")
+    return bucket_name, entry["path"]
+
+
+# Step 3: Query by date range
+# The listing fans out across the sub-prefixes under the selected path (e.g. one per panelist) and lists
+# them in parallel, streaming compact entries to the pipeline as pages arrive.
+
+# Compact listing entry: key, size in bytes, LastModified as a UTC timestamp and ETag without quotes
+S3Object = collections.namedtuple('S3Object', ['key', 'size', 'mtime', 'etag'])
+
+# Folder names recognised as date partitions at the levels a listing is told hold them: YYYY-MM-DD,
+# YYYYMMDD or a Hive-style date=YYYY-MM-DD. The whole name must match, so IDs that merely start with
+# digits are never taken for dates.
+_PARTITION_DATE = re.compile(r'(?:[A-Za-z_]+=)?(\d{4})-?(\d{2})-?(\d{2})/?')
+
+# Date encodings recognised at the start of a key component
+_KEY_DATE_PATTERNS = [
+    (re.compile(r'(\d{4})[-_](\d{2})[-_](\d{2})(?!\d)'), 'ymd'),
+    (re.compile(r'(\d{13})(?!\d)'), 'epoch_ms'),
+    (re.compile(r'(\d{10})(?!\d)'), 'epoch_s'),
+    (re.compile(r'(\d{4})(\d{2})(\d{2})(?!\d)'), 'ymd'),
+]
+
+
+def as_utc(date):
+    """
+    Returns a datetime as a timezone-aware UTC datetime; naive datetimes are taken to be UTC.
+    """
+    if date is None or date.tzinfo is not None:
+        return date
+    return date.replace(tzinfo=timezone.utc)
+
+
+def parse_key_date(component):
+    """
+    Parses a date encoded at the start of a key component, e.g. '2024-05-01', '20240501' or an epoch
+    timestamp in seconds or milliseconds.
+
+    Args:
+        component: A folder or file name from an S3 key.
+
+    Returns:
+        datetime: The encoded date in UTC, or None if the component doesn't start with a date.
+    """
+    for pattern, kind in _KEY_DATE_PATTERNS:
+        match = pattern.match(component)
+        if not match:
+            continue
+        try:
+            if kind == 'epoch_ms':
+                return datetime.fromtimestamp(int(match.group(1)) / 1000, timezone.utc)
+            if kind == 'epoch_s':
+                return datetime.fromtimestamp(int(match.group(1)), timezone.utc)
+            return datetime(*(int(group) for group in match.groups()), tzinfo=timezone.utc)
+        except (ValueError, OverflowError, OSError):
+            continue
+    return None
+
+
+def partition_date(component):
+    """
+    Parses the date of a date partition folder (see _PARTITION_DATE).
+
+    Returns:
+        datetime: The date in UTC, or None if the whole name isn't a date.
+    """
+    match = _PARTITION_DATE.fullmatch(component)
+    if not match:
+        return None
+    try:
+        return datetime(*(int(group) for group in match.groups()), tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+
+def _after_end_date(component, end_date):
+    """
+    Checks whether a date partition folder is dated after end_date. Objects are uploaded after they are
+    captured, so nothing under such a folder can have been modified within the range.
+    """
+    if end_date is None:
+        return False
+    folder_date = partition_date(component)
+    return folder_date is not None and folder_date > end_date
+
+
+def list_s3_objects(s3, bucket_name, path, start_date=None, end_date=None, fanout_depth=2, max_workers=16,
+                    date_levels=()):
+    """
+    Lists objects under a path, fanning out across its sub-prefixes in parallel and streaming the
+    entries whose LastModified falls within the date range.
+
+    The first fanout_depth folder levels below path are discovered with delimited listings; every
+    prefix found at that depth is then listed in full on its own thread. Folders are only skipped at the
+    levels named in date_levels, where they are known to be date partitions; everything else is
+    filtered on LastModified alone.
+
+    Args:
+        s3: Boto3 S3 client
+        bucket_name: Name of the S3 bucket
+        path: Path within the S3 bucket
+        start_date: Start of the date range as datetime (None for no lower bound)
+        end_date: End of the date range as datetime (None for no upper bound)
+        fanout_depth: Number of folder levels to expand before listing prefixes in full
+        max_workers: Number of concurrent listing requests
+        date_levels: Folder levels below path (1 for its direct sub-folders, at most fanout_depth) that
+            are date partitions named YYYY-MM-DD, YYYYMMDD or date=YYYY-MM-DD. Partitions dated after
+            end_date are never listed. Empty for layouts without date partitions, such as the panel tree.
+
+    Yields:
+        S3Object: Matching objects, in no particular order.
+    """
+    start_date, end_date = as_utc(start_date), as_utc(end_date)
+    start_ts = start_date.timestamp() if start_date else float('-inf')
+    end_ts = end_date.timestamp() if end_date else float('inf')
+
+    results = queue.Queue(maxsize=max_workers * 4)
+    stopped = threading.Event()
+    pending = [0]
+    pending_lock = threading.Lock()
+    executor = ThreadPoolExecutor(max_workers)
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def submit(prefix, depth):
+        with pending_lock:
+            pending[0] += 1
+        executor.submit(list_prefix, prefix, depth)
+
+    def list_prefix(prefix, depth):
+        try:
+            params = {'Bucket': bucket_name, 'Prefix': prefix}
+            if depth < fanout_depth:
+                params['Delimiter'] = '/'
+
+            while not stopped.is_set():
+                response = s3.list_objects_v2(**params)
+                entries = []
+
+                for obj in response.get('Contents', []):
+                    mtime = as_utc(obj['LastModified']).timestamp()
+                    if start_ts <= mtime <= end_ts:
+                        entries.append(S3Object(obj['Key'], obj['Size'], mtime, obj['ETag'].strip('"')))
+
+                for common_prefix in response.get('CommonPrefixes', []):
+                    child = common_prefix['Prefix']
+                    if depth + 1 not in date_levels or not _after_end_date(child[len(prefix):], end_date):
+                        submit(child, depth + 1)
+
+                if entries:
+                    put(entries)
+                if 'NextContinuationToken' not in response:
+                    break
+                params['ContinuationToken'] = response['NextContinuationToken']
+        except Exception as e:
+            put(e)
+        finally:
+            put(None)
+
+    submit(path, 0)
+    try:
+        while True:
+            item = results.get()
+            if item is None:
+                with pending_lock:
+                    pending[0] -= 1
+                    if not pending[0]:
+                        break
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield from item
+    finally:
+        stopped.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def query_by_date_range(s3, bucket_name, path, start_date, end_date):
+    """
+    Filters objects in an S3 bucket path by a date range.
+    Args:
+        s3: Boto3 S3 client
+        bucket_name: Name of the S3 bucket
+        path: Path within the S3 bucket
+        start_date: Start of the date range as datetime
+        end_date: End of the date range as datetime
+    Returns:
+        list: Filtered S3 objects within the date range, as S3Object entries
+    """
+    return list(list_s3_objects(s3, bucket_name, path, start_date, end_date))
+
+
+def query_s3_objects_in_date_range(s3, bucket_name, path, start_date, end_date, date_levels=()):
+    """
+    Streams the objects under a path whose LastModified falls within a date range, logging progress.
+
+    Args:
+        s3: Boto3 S3 client
+        bucket_name: Name of the S3 bucket
+        path: Path within the S3 bucket
+        start_date: Start of the date range as datetime
+        end_date: End of the date range as datetime
+        date_levels: Folder levels below path that are date partitions (see list_s3_objects)
+
+    Yields:
+        S3Object: Matching objects, see list_s3_objects.
+    """
+    count = 0  # Initialize a count variable to track the number of files fetched
+
+    # Only the time spent waiting for the listing counts towards its span, not the pipeline's time
+    objects = iter(list_s3_objects(s3, bucket_name, path, start_date, end_date, date_levels=date_levels or ()))
+    while True:
+        with metric_span("list"):
+            obj = next(objects, None)
+        if obj is None:
+            break
+        count += 1
+        count_metric("objects_listed")
+        if count % 1000 == 0:
+            logging.info(f"Files fetched: {count}")
+        yield obj
+
+    logging.info(f"Files fetched: {count}")
@@ -0,0 +1,323 @@
+"""
+In-memory S3 stand-in for offline benchmarks and tests. It serves the subset of the S3 API the pipeline
+uses over HTTP on a local port, so the real boto3 client code paths run against it.
+"""
+import base64
+import hashlib
+import io
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+# The stand-in accepts any credentials, but boto3 refuses to sign requests without some
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+
+class LocalS3Handler(BaseHTTPRequestHandler):
+    """
+    Serves the subset of the S3 API used by the pipeline (ListObjectsV2, GetObject with byte ranges,
+    HeadObject, PutObject and multipart uploads) from the in-memory buckets of its LocalS3Server, using
+    path-style addressing.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _split_path(self):
+        parsed = urlparse(self.path)
+        bucket, _, key = parsed.path.lstrip("/").partition("/")
+        return bucket, unquote(key), {k: v[0] for k, v in parse_qs(parsed.query, keep_blank_values=True).items()}
+
+    def _send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _error(self, status, code, key=""):
+        body = f"<Error><Code>{code}</Code><Key>{escape(key)}</Key></Error>".encode()
+        self._send(status, body, {"Content-Type": "application/xml"})
+
+    def _not_found(self, key):
+        self._error(404, "NoSuchKey", key)
+
+    def _xml(self, element, content):
+        body = (f'<?xml version="1.0" encoding="UTF-8"?><{element} xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                f'{content}</{element}>').encode()
+        self._send(200, body, {"Content-Type": "application/xml"})
+
+    def _object_headers(self, obj):
+        headers = {"ETag": f'"{obj["etag"]}"',
+                   "Last-Modified": formatdate(obj["last_modified"].timestamp(), usegmt=True),
+                   "Accept-Ranges": "bytes"}
+        headers.update({f"x-amz-meta-{name}": value for name, value in obj["metadata"].items()})
+        return headers
+
+    def _read_body(self):
+        """
+        Reads the request body, undoing chunked transfer encoding and the aws-chunked content encoding
+        that newer clients use for streamed checksums.
+        """
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            data = _decode_chunks(self.rfile)
+        else:
+            data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if "aws-chunked" in self.headers.get("Content-Encoding", ""):
+            data = _decode_chunks(io.BytesIO(data))
+        return data
+
+    def _metadata(self):
+        return {name[len("x-amz-meta-"):]: value for name, value in self.headers.items()
+                if name.lower().startswith("x-amz-meta-")}
+
+    def _check_md5(self, data):
+        expected = self.headers.get("Content-MD5")
+        return expected is None or base64.b64decode(expected) == hashlib.md5(data).digest()
+
+    def do_PUT(self):
+        self.server.simulate_latency()
+        bucket, key, query = self._split_path()
+        data = self._read_body()
+        if not self._check_md5(data):
+            return self._error(400, "BadDigest", key)
+
+        if "uploadId" in query:
+            upload = self.server.uploads.get(query["uploadId"])
+            if upload is None:
+                return self._error(404, "NoSuchUpload", key)
+            upload["parts"][int(query["partNumber"])] = data
+            return self._send(200, headers={"ETag": f'"{hashlib.md5(data).hexdigest()}"'})
+
+        obj = self.server.put(bucket, key, data, metadata=self._metadata())
+        self._send(200, headers={"ETag": f'"{obj["etag"]}"'})
+
+    def do_POST(self):
+        self.server.simulate_latency()
+        bucket, key, query = self._split_path()
+        body = self._read_body()
+
+        if "uploads" in query:
+            upload_id = self.server.create_upload(bucket, key, self._metadata())
+            return self._xml("InitiateMultipartUploadResult", f"<Bucket>{escape(bucket)}</Bucket>"
+                             f"<Key>{escape(key)}</Key><UploadId>{upload_id}</UploadId>")
+
+        upload = self.server.uploads.pop(query.get("uploadId"), None)
+        if upload is None:
+            return self._error(404, "NoSuchUpload", key)
+        numbers = [int(element.text) for element in ElementTree.fromstring(body).iter()
+                   if element.tag.endswith("PartNumber")]
+        if any(number not in upload["parts"] for number in numbers):
+            return self._error(400, "InvalidPart", key)
+        parts = [upload["parts"][number] for number in numbers]
+        obj = self.server.put(bucket, key, b"".join(parts), metadata=upload["metadata"])
+        # Multipart ETags are the MD5 of the parts' MD5s, suffixed with the number of parts
+        obj["etag"] = hashlib.md5(b"".join(hashlib.md5(part).digest() for part in parts)).hexdigest() \
+            + f"-{len(parts)}"
+        self._xml("CompleteMultipartUploadResult", f"<Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key>"
+                  f"<ETag>&quot;{obj['etag']}&quot;</ETag>")
+
+    def do_DELETE(self):
+        self.server.simulate_latency()
+        bucket, key, query = self._split_path()
+        if "uploadId" in query:
+            self.server.uploads.pop(query["uploadId"], None)
+        else:
+            self.server.buckets.get(bucket, {}).pop(key, None)
+        self._send(204)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        self.server.simulate_latency()
+        bucket, key, query = self._split_path()
+        objects = self.server.buckets.setdefault(bucket, {})
+
+        if not key:
+            return self._list_objects(bucket, objects, query)
+
+        self.server.record(self.command, key, self.headers.get("Range"))
+        if self.server.take_failure():
+            return self._error(503, "SlowDown", key)
+        obj = objects.get(key)
+        if obj is None:
+            return self._not_found(key)
+        if_match = self.headers.get("If-Match")
+        if if_match and if_match.strip('"') != obj["etag"]:
+            return self._error(412, "PreconditionFailed", key)
+
+        data = obj["data"]
+        headers = self._object_headers(obj)
+        byte_range = self.headers.get("Range")
+        if byte_range:
+            start, _, end = byte_range.split("=", 1)[1].partition("-")
+            start, end = int(start), min(int(end) if end else len(data) - 1, len(data) - 1)
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+            return self._send(206, bytes(data[start:end + 1]), headers)
+
+        self._send(200, bytes(data), headers)
+
+    def _list_objects(self, bucket, objects, query):
+        prefix = query.get("prefix", "")
+        delimiter = query.get("delimiter")
+        max_keys = int(query.get("max-keys", 1000))
+        marker = query.get("continuation-token") or query.get("start-after") or ""
+
+        contents, prefixes, last = [], [], None
+        for key in sorted(objects):
+            if not key.startswith(prefix) or key <= marker:
+                continue
+            if marker.endswith(delimiter or "\0") and key.startswith(marker):
+                continue  # Still inside the common prefix the previous page ended on
+
+            if delimiter and delimiter in key[len(prefix):]:
+                common = key[:key.index(delimiter, len(prefix)) + len(delimiter)]
+                if prefixes and prefixes[-1] == common:
+                    continue
+                if len(contents) + len(prefixes) == max_keys:
+                    break
+                prefixes.append(common)
+                last = common
+            else:
+                if len(contents) + len(prefixes) == max_keys:
+                    break
+                contents.append(key)
+                last = key
+        else:
+            last = None
+
+        parts = [f"<Name>{escape(bucket)}</Name><Prefix>{escape(prefix)}</Prefix>",
+                 f"<KeyCount>{len(contents) + len(prefixes)}</KeyCount><MaxKeys>{max_keys}</MaxKeys>",
+                 f"<IsTruncated>{'true' if last else 'false'}</IsTruncated>"]
+        if delimiter:
+            parts.append(f"<Delimiter>{escape(delimiter)}</Delimiter>")
+        for key in contents:
+            obj = objects[key]
+            parts.append(f"<Contents><Key>{escape(key)}</Key>"
+                         f"<LastModified>{obj['last_modified'].strftime('%Y-%m-%dT%H:%M:%S.000Z')}</LastModified>"
+                         f"<ETag>&quot;{obj['etag']}&quot;</ETag><Size>{len(obj['data'])}</Size>"
+                         f"<StorageClass>STANDARD</StorageClass></Contents>")
+        for common in prefixes:
+            parts.append(f"<CommonPrefixes><Prefix>{escape(common)}</Prefix></CommonPrefixes>")
+        if last:
+            parts.append(f"<NextContinuationToken>{escape(last)}</NextContinuationToken>")
+
+        body = ('<?xml version="1.0" encoding="UTF-8"?>'
+                '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                + "".join(parts) + "</ListBucketResult>").encode()
+        self._send(200, body, {"Content-Type": "application/xml"})
+
+
+def _decode_chunks(stream):
+    """
+    Reads a body of "<hex size>[;extensions]" framed chunks up to the terminating empty chunk, skipping
+    any trailers after it.
+    """
+    data = bytearray()
+    while True:
+        line = stream.readline()
+        if not line.strip():
+            if not line:
+                break
+            continue
+        size = int(line.split(b";")[0], 16)
+        if size == 0:
+            while stream.readline().strip():
+                pass
+            break
+        data += stream.read(size)
+        stream.readline()
+    return bytes(data)
+
+
+class LocalS3Server(ThreadingHTTPServer):
+    """
+    In-memory S3 stand-in for offline benchmarks and tests. Object reads are recorded in requests, and
+    can be made to fail with fail_requests to exercise the client's retries.
+
+    Args:
+        latency_ms: Delay added to every request to emulate network round trips.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency_ms=0):
+        super().__init__(("127.0.0.1", 0), LocalS3Handler)
+        self.buckets = {}
+        self.uploads = {}
+        self.latency = latency_ms / 1000.0
+        self.requests = []
+        self.failures = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def endpoint_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def simulate_latency(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def record(self, method, key, byte_range):
+        """
+        Records an object read as a (method, key, Range header) tuple.
+        """
+        with self.lock:
+            self.requests.append((method, key, byte_range))
+
+    def fail_requests(self, count):
+        """
+        Answers the next count object reads with 503 SlowDown.
+        """
+        with self.lock:
+            self.failures = count
+
+    def take_failure(self):
+        with self.lock:
+            if not self.failures:
+                return False
+            self.failures -= 1
+            return True
+
+    def put(self, bucket, key, data, last_modified=None, metadata=None):
+        """
+        Stores an object directly, bypassing HTTP.
+
+        Returns:
+            dict: The stored object.
+        """
+        obj = self.buckets.setdefault(bucket, {})[key] = {
+            "data": data,
+            "etag": hashlib.md5(data).hexdigest(),
+            "last_modified": last_modified or datetime.now(timezone.utc),
+            "metadata": metadata or {},
+        }
+        return obj
+
+    def create_upload(self, bucket, key, metadata):
+        """
+        Starts a multipart upload and returns its ID.
+        """
+        upload_id = os.urandom(8).hex()
+        self.uploads[upload_id] = {"bucket": bucket, "key": key, "metadata": metadata, "parts": {}}
+        return upload_id
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,221 @@
+import collections
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from pipeline import batch_objects
+
+
+# Object manifest
+# query_id/manifest.sqlite records, per S3 key and ETag, when each stage finished with an object. A rerun
+# of the same query then only processes objects that are new or changed since the last run.
+
+MANIFEST_STAGES = ("downloaded", "extracted", "redacted", "consolidated")
+
+# Per-process manifest connections keyed by (pid, database path); shared by the process's threads
+_manifest_connections = {}
+_manifest_lock = threading.Lock()
+
+
+def open_manifest(query_id):
+    """
+    Opens the manifest of a query, creating it if needed.
+
+    Args:
+        query_id: Unique identifier for the query/download session.
+
+    Returns:
+        sqlite3.Connection: This process's connection to query_id/manifest.sqlite.
+    """
+    path = os.path.join(query_id, "manifest.sqlite")
+    with _manifest_lock:
+        conn = _manifest_connections.get((os.getpid(), path))
+        if conn is None:
+            os.makedirs(query_id, exist_ok=True)
+            conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS objects (key TEXT NOT NULL, etag TEXT NOT NULL, size INTEGER, "
+                         + ", ".join(f"{stage} REAL" for stage in MANIFEST_STAGES)
+                         + ", PRIMARY KEY (key, etag))")
+            # Member indexes of the archives (see store_member_index)
+            conn.execute("CREATE TABLE IF NOT EXISTS archives (key TEXT NOT NULL, etag TEXT NOT NULL, "
+                         "members INTEGER, PRIMARY KEY (key, etag))")
+            conn.execute("CREATE TABLE IF NOT EXISTS members (key TEXT NOT NULL, etag TEXT NOT NULL, name TEXT, "
+                         "size INTEGER, compressed_size INTEGER, crc INTEGER, header_offset INTEGER)")
+            conn.execute("CREATE INDEX IF NOT EXISTS members_archive ON members (key, etag)")
+            # Committed size of each consolidated CSV (see restore_consolidated_output)
+            conn.execute("CREATE TABLE IF NOT EXISTS outputs (path TEXT PRIMARY KEY, size INTEGER)")
+            _manifest_connections[(os.getpid(), path)] = conn
+    return conn
+
+
+def mark_manifest(query_id, obj, stage, outputs=None):
+    """
+    Records that a stage finished with an object.
+
+    Args:
+        query_id: Unique identifier for the query/download session.
+        obj: S3Object entry, or None for files that didn't come from a listing (nothing is recorded).
+        stage: One of MANIFEST_STAGES.
+        outputs: Dict of consolidated CSV paths to their sizes once the object's rows are in them,
+            recorded in the same transaction.
+    """
+    if obj is None:
+        return
+    if stage not in MANIFEST_STAGES:
+        raise ValueError(f"Unknown manifest stage: {stage}")
+
+    conn = open_manifest(query_id)
+    with _manifest_lock:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(f"INSERT INTO objects (key, etag, size, {stage}) VALUES (?, ?, ?, ?) "
+                         f"ON CONFLICT (key, etag) DO UPDATE SET {stage} = excluded.{stage}",
+                         (obj.key, obj.etag, obj.size, time.time()))
+            conn.executemany("INSERT INTO outputs (path, size) VALUES (?, ?) "
+                             "ON CONFLICT (path) DO UPDATE SET size = excluded.size",
+                             list((outputs or {}).items()))
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+def commit_output_size(query_id, path, size):
+    """
+    Records the size of a consolidated CSV that was rewritten outside the consolidation stage, e.g. by
+    sorting it, so that restore_consolidated_output rolls it back to the rewritten file.
+
+    Args:
+        query_id: Unique identifier for the query/download session.
+        path: Path of the consolidated CSV.
+        size: Size of the rewritten CSV in bytes.
+    """
+    conn = open_manifest(query_id)
+    with _manifest_lock:
+        conn.execute("INSERT INTO outputs (path, size) VALUES (?, ?) "
+                     "ON CONFLICT (path) DO UPDATE SET size = excluded.size", (path, size))
+
+
+def restore_consolidated_output(query_id, path):
+    """
+    Rolls a consolidated CSV back, or forward, to the size the manifest last committed for it.
+
+    Rows are appended to a consolidated CSV before the manifest marks their object consolidated, and
+    rewritten outputs are only renamed into place after that commit. A run stopped in between leaves
+    rows of an object that isn't marked consolidated, and would otherwise append them again: they are
+    truncated away here. A rewritten output whose commit went through but whose rename didn't is
+    renamed into place.
+
+    Args:
+        query_id: Unique identifier for the query/download session.
+        path: Path of the consolidated CSV.
+    """
+    conn = open_manifest(query_id)
+    with _manifest_lock:
+        row = conn.execute("SELECT size FROM outputs WHERE path = ?", (path,)).fetchone()
+    committed = row[0] if row else None
+
+    temp_path = path + '.tmp'
+    if os.path.exists(temp_path):
+        if committed is not None and os.path.getsize(temp_path) == committed:
+            os.replace(temp_path, path)
+        else:
+            os.remove(temp_path)
+
+    if committed is not None and os.path.exists(path) and os.path.getsize(path) > committed:
+        logging.warning(f"Truncating {path} to {committed} bytes: dropping rows of an interrupted run.")
+        with open(path, 'r+b') as f:
+            f.truncate(committed)
+
+
+def manifest_pending(query_id, objects, chunk_size=500):
+    """
+    Filters a listing down to the objects whose current ETag hasn't been consolidated yet.
+
+    Args:
+        query_id: Unique identifier for the query/download session.
+        objects: Iterable of S3Object entries.
+        chunk_size: Number of objects looked up per query.
+
+    Yields:
+        S3Object: Objects that are new or changed since they were last consolidated.
+    """
+    conn = open_manifest(query_id)
+    skipped = 0
+
+    for chunk in batch_objects(objects, chunk_size):
+        placeholders = ", ".join("?" * len(chunk))
+        with _manifest_lock:
+            done = set(conn.execute(f"SELECT key, etag FROM objects WHERE consolidated IS NOT NULL "
+                                    f"AND key IN ({placeholders})", [obj.key for obj in chunk]))
+        for obj in chunk:
+            if (obj.key, obj.etag) in done:
+                skipped += 1
+            else:
+                yield obj
+
+    logging.info(f"Skipped {skipped} objects already processed by an earlier run.")
+
+
+def manifest_counts(query_id):
+    """
+    Counts the objects each stage has finished with.
+
+    Args:
+        query_id: Unique identifier for the query/download session.
+
+    Returns:
+        dict: Stage name to number of objects.
+    """
+    conn = open_manifest(query_id)
+    with _manifest_lock:
+        row = conn.execute("SELECT " + ", ".join(f"COUNT({stage})" for stage in MANIFEST_STAGES)
+                           + " FROM objects").fetchone()
+    return dict(zip(MANIFEST_STAGES, row))
+
+
+# Member index cache
+# The name, sizes, CRC and header offset of each member of an archive, cached per archive and ETag so
+# that member filters can skip archives without reading them.
+
+# Entry of an archive's member index
+ZipMember = collections.namedtuple('ZipMember', ['name', 'size', 'compressed_size', 'crc', 'header_offset'])
+
+
+def store_member_index(query_id, obj, members):
+    """
+    Caches the member index of an archive in the query's manifest.
+
+    Args:
+        query_id: Unique identifier for the query/download session.
+        obj: S3Object of the archive, or None (nothing is stored).
+        members: List of ZipMember.
+    """
+    if obj is None:
+        return
+    conn = open_manifest(query_id)
+    with _manifest_lock:
+        conn.execute("BEGIN")
+        conn.execute("DELETE FROM members WHERE key = ? AND etag = ?", (obj.key, obj.etag))
+        conn.executemany("INSERT INTO members VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         [(obj.key, obj.etag) + tuple(member) for member in members])
+        conn.execute("INSERT INTO archives (key, etag, members) VALUES (?, ?, ?) "
+                     "ON CONFLICT (key, etag) DO UPDATE SET members = excluded.members",
+                     (obj.key, obj.etag, len(members)))
+        conn.execute("COMMIT")
+
+
+def load_member_index(query_id, obj):
+    """
+    Returns the cached member index of an archive, or None if it hasn't been indexed under its current ETag.
+    """
+    conn = open_manifest(query_id)
+    with _manifest_lock:
+        if conn.execute("SELECT 1 FROM archives WHERE key = ? AND etag = ?", (obj.key, obj.etag)).fetchone() is None:
+            return None
+        rows = conn.execute("SELECT name, size, compressed_size, crc, header_offset FROM members "
+                            "WHERE key = ? AND etag = ? ORDER BY header_offset", (obj.key, obj.etag)).fetchall()
+    return [ZipMember(*row) for row in rows]
@@ -0,0 +1,157 @@
+import os
+import re
+from datetime import datetime, timedelta
+
+from listing import as_utc, parse_key_date
+from manifest import ZipMember
+from outputs import CSV_PREFIXES, csv_prefix
+
+
+# Zip member index
+# The manifest also caches, per archive and ETag, the name, sizes, CRC and header offset of each member.
+# Member filters select members by type, CSV prefix and the capture time parsed from their names. With a
+# filter, streaming workers read remote archives through ranged GETs of only the central directory and
+# the selected members, and skip archives whose cached index has no match without reading them at all.
+
+# Size of a zip local file header without its name and extra field
+_ZIP_LOCAL_HEADER_SIZE = 30
+
+# Capture dates before this year in member names are taken to be other numbers (IDs, counters)
+_MEMBER_MIN_YEAR = 2000
+
+
+def member_kind(name):
+    """
+    Returns the type of a zip member: 'image', 'csv', or None for members the pipeline ignores.
+    """
+    if name.lower().endswith(('.jpg', '.jpeg')):
+        return 'image'
+    if name.endswith('.csv'):
+        return 'csv'
+    return None
+
+
+def member_timestamp(name):
+    """
+    Parses the capture time encoded in a member's file name, e.g. 'screenshot_1714550400000.jpg' or
+    'session_data_2024-05-01.csv' (see parse_key_date).
+
+    Returns:
+        datetime: The capture time in UTC, or None if the name doesn't encode one.
+    """
+    basename = os.path.basename(name)
+    for match in re.finditer(r'(?<!\d)\d{4}', basename):
+        date = parse_key_date(basename[match.start():])
+        if date is not None and date.year >= _MEMBER_MIN_YEAR:
+            return date
+    return None
+
+
+def zip_member_index(zip_ref):
+    """
+    Builds the member index of an open archive from its central directory.
+
+    Returns:
+        list: ZipMember per file member.
+    """
+    return [ZipMember(info.filename, info.file_size, info.compress_size, info.CRC, info.header_offset)
+            for info in zip_ref.infolist() if not info.is_dir()]
+
+
+class MemberFilter:
+    """
+    Selects zip members by type, CSV prefix and capture time. Parsed from an expression of space- or
+    comma-separated terms; values of the same field are alternatives, different fields must all match:
+        type:csv prefix:session_data
+        type:image since:2024-05-01 until:2024-05-08
+    Members whose names don't encode a capture time pass the time bounds.
+
+    Args:
+        types: Member types to keep ('image', 'csv'), or None for both.
+        prefixes: CSV_PREFIXES to keep, or None for all. Images aren't affected.
+        since: Earliest capture time as datetime, or None.
+        until: Latest capture time as datetime, or None. A date without time includes the whole day.
+    """
+
+    def __init__(self, types=None, prefixes=None, since=None, until=None):
+        self.types = set(types) if types else None
+        self.prefixes = set(prefixes) if prefixes else None
+        self.since = as_utc(since)
+        self.until = as_utc(until)
+
+    @classmethod
+    def parse(cls, expression):
+        """
+        Parses a filter expression.
+
+        Returns:
+            MemberFilter: The filter, or None for an empty expression.
+        """
+        if not expression or not expression.strip():
+            return None
+        values = {"type": [], "prefix": [], "since": [], "until": []}
+        for term in re.split(r'[\s,]+', expression.strip()):
+            field, _, value = term.partition(':')
+            if field not in values or not value:
+                raise ValueError(f"Invalid member filter term: {term}")
+            values[field].append(value)
+
+        unknown = set(values["type"]) - {'image', 'csv'}
+        if unknown:
+            raise ValueError(f"Unknown member types: {', '.join(sorted(unknown))}")
+        unknown = set(values["prefix"]) - set(CSV_PREFIXES)
+        if unknown:
+            raise ValueError(f"Unknown CSV prefixes: {', '.join(sorted(unknown))}")
+        if len(values["since"]) > 1 or len(values["until"]) > 1:
+            raise ValueError("Member filters take at most one since: and one until: bound")
+
+        since = datetime.fromisoformat(values["since"][0]) if values["since"] else None
+        until = None
+        if values["until"]:
+            until = datetime.fromisoformat(values["until"][0])
+            if 'T' not in values["until"][0]:
+                until += timedelta(days=1) - timedelta(microseconds=1)
+        return cls(values["type"], values["prefix"], since, until)
+
+    def matches(self, name):
+        """
+        Checks whether a member is selected.
+        """
+        kind = member_kind(name)
+        if kind is None or (self.types is not None and kind not in self.types):
+            return False
+        if kind == 'csv' and self.prefixes is not None and csv_prefix(os.path.basename(name)) not in self.prefixes:
+            return False
+        if self.since is not None or self.until is not None:
+            timestamp = member_timestamp(name)
+            if timestamp is not None and ((self.since is not None and timestamp < self.since)
+                                          or (self.until is not None and timestamp > self.until)):
+                return False
+        return True
+
+
+def select_members(zip_ref, member_filter=None):
+    """
+    Returns the image and CSV members of an open archive that a member filter selects.
+
+    Args:
+        zip_ref: Open zipfile.ZipFile.
+        member_filter: MemberFilter, or None to select all image and CSV members.
+
+    Returns:
+        list: zipfile.ZipInfo entries, in archive order.
+    """
+    return [info for info in zip_ref.infolist()
+            if member_kind(info.filename) and (member_filter is None or member_filter.matches(info.filename))]
+
+
+def member_ranges(members, member_filter=None):
+    """
+    Returns the (start, end) byte ranges of the selected members of an indexed archive, including their
+    local headers. The extra field of a local header may be longer than in the central directory; any
+    bytes beyond the range are fetched when zipfile reads them.
+    """
+    return [(member.header_offset,
+             member.header_offset + _ZIP_LOCAL_HEADER_SIZE + len(member.name.encode()) + member.compressed_size + 64)
+            for member in members
+            if member_kind(member.name) and (member_filter is None or member_filter.matches(member.name))]
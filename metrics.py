@@ -0,0 +1,187 @@
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import time
+from datetime import datetime, timezone
+
+
+# Metrics
+# Time spent per processing step and counts of the work done are accumulated in a shared array that the
+# pipeline's worker processes receive, and exported with every progress report to a JSON-lines file or a
+# Prometheus textfile. Recording is a no-op until init_metrics is called.
+
+# Timed steps; each records a number of spans and their total seconds
+METRIC_SPANS = ("list", "download", "unzip", "decode", "detect", "redact", "encode", "upload", "consolidate", "sort")
+
+# Counted quantities
+METRIC_COUNTERS = ("objects_listed", "bytes_downloaded", "zips_consolidated", "images", "faces",
+                   "cache_hits", "cache_misses", "images_copied", "bytes_uploaded", "uploads_skipped")
+
+# Shared metrics array of this run and the time it was created
+_metrics = None
+_metrics_started = None
+
+
+def init_metrics():
+    """
+    Creates the shared metrics array. Must be called before the pipeline's workers are started, which
+    receive it with the rest of the run state (see pipeline_state and metrics_state).
+    """
+    global _metrics, _metrics_started
+    _metrics = multiprocessing.Array('d', 2 * len(METRIC_SPANS) + len(METRIC_COUNTERS))
+    _metrics_started = time.monotonic()
+
+
+def metrics_state():
+    """
+    Returns:
+        tuple: The shared metrics array of this run and the time it was created, to pass to worker
+        processes (see restore_metrics).
+    """
+    return _metrics, _metrics_started
+
+
+def restore_metrics(state):
+    """
+    Installs the metrics state returned by metrics_state in a worker process.
+    """
+    global _metrics, _metrics_started
+    _metrics, _metrics_started = state
+
+
+def record_span(name, seconds):
+    """
+    Adds one span of a timed step.
+    """
+    if _metrics is not None:
+        offset = 2 * METRIC_SPANS.index(name)
+        with _metrics.get_lock():
+            _metrics[offset] += 1
+            _metrics[offset + 1] += seconds
+
+
+@contextlib.contextmanager
+def metric_span(name):
+    """
+    Times the enclosed block as a span of a step in METRIC_SPANS.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - started)
+
+
+def count_metric(name, value=1):
+    """
+    Adds to a counter in METRIC_COUNTERS.
+    """
+    if _metrics is not None and value:
+        with _metrics.get_lock():
+            _metrics[2 * len(METRIC_SPANS) + METRIC_COUNTERS.index(name)] += value
+
+
+def metrics_snapshot(query_id=None, summary=None, final=False):
+    """
+    Builds a metrics record from the shared array and a pipeline summary.
+
+    Args:
+        query_id: Unique identifier for the query/download session.
+        summary: Pipeline summary as returned by run_pipeline, or None.
+        final: Whether this is the end-of-run record.
+
+    Returns:
+        dict: Spans (count and seconds per step), counters, derived rates and per-stage figures.
+    """
+    values = [0.0] * (2 * len(METRIC_SPANS) + len(METRIC_COUNTERS))
+    if _metrics is not None:
+        with _metrics.get_lock():
+            values = list(_metrics)
+    elapsed = time.monotonic() - _metrics_started if _metrics_started else 0.0
+
+    spans = {name: {"count": int(values[2 * i]), "seconds": values[2 * i + 1]} for i, name in enumerate(METRIC_SPANS)}
+    counters = {name: int(values[2 * len(METRIC_SPANS) + i]) for i, name in enumerate(METRIC_COUNTERS)}
+    rates = {
+        "images_per_sec": counters["images"] / elapsed if elapsed else 0.0,
+        "download_mb_per_sec": counters["bytes_downloaded"] / elapsed / 1024 / 1024 if elapsed else 0.0,
+        "zips_per_sec": counters["zips_consolidated"] / elapsed if elapsed else 0.0,
+    }
+    return {"time": datetime.now(timezone.utc).isoformat(), "queryId": query_id, "elapsed": elapsed,
+            "final": final, "spans": spans, "counters": counters, "rates": rates, "stages": summary or {}}
+
+
+def _prometheus_text(record):
+    """
+    Formats a metrics record in the Prometheus text exposition format.
+    """
+    labels = f'query="{record["queryId"]}"'
+    lines = ["# TYPE screenlake_elapsed_seconds gauge", f"screenlake_elapsed_seconds{{{labels}}} {record['elapsed']}"]
+    for field in ("seconds", "count"):
+        lines.append(f"# TYPE screenlake_span_{field}_total counter")
+        for name, span in record["spans"].items():
+            lines.append(f'screenlake_span_{field}_total{{{labels},step="{name}"}} {span[field]}')
+    for name, value in record["counters"].items():
+        lines += [f"# TYPE screenlake_{name}_total counter", f"screenlake_{name}_total{{{labels}}} {value}"]
+    for name, value in record["rates"].items():
+        lines += [f"# TYPE screenlake_{name} gauge", f"screenlake_{name}{{{labels}}} {value}"]
+    for field in ("processed", "failed", "queue_depth", "utilization"):
+        lines.append(f"# TYPE screenlake_stage_{field} gauge")
+        for stage, figures in record["stages"].items():
+            if field in figures:
+                lines.append(f'screenlake_stage_{field}{{{labels},stage="{stage}"}} {figures[field]}')
+    memory = record["stages"].get("memory")
+    if memory:
+        for name in ("rss_mb", "peak_rss_mb", "throttled_seconds"):
+            lines += [f"# TYPE screenlake_memory_{name} gauge", f"screenlake_memory_{name}{{{labels}}} {memory[name]}"]
+    return "\n".join(lines) + "\n"
+
+
+def export_metrics(metrics_path, record):
+    """
+    Writes a metrics record: appended as a JSON line, or, for a .prom path, as a Prometheus textfile
+    replaced atomically (e.g. for the node_exporter textfile collector).
+
+    Args:
+        metrics_path: Path of the .jsonl or .prom file.
+        record: Metrics record as returned by metrics_snapshot.
+    """
+    if metrics_path.endswith(".prom"):
+        temp_path = metrics_path + ".tmp"
+        with open(temp_path, "w") as metrics_file:
+            metrics_file.write(_prometheus_text(record))
+        os.replace(temp_path, metrics_path)
+    else:
+        with open(metrics_path, "a") as metrics_file:
+            metrics_file.write(json.dumps(record) + "\n")
+
+
+def log_metrics_summary(record):
+    """
+    Logs an end-of-run summary: where the time went, throughput and the busiest stage.
+    """
+    counters, rates = record["counters"], record["rates"]
+    logging.info(f"Run finished in {record['elapsed']:.1f}s: {counters['zips_consolidated']} zips, "
+                 f"{counters['images']} images ({rates['images_per_sec']:.1f}/s), {counters['faces']} faces, "
+                 f"{counters['bytes_downloaded'] / 1024 / 1024:.1f} MB downloaded "
+                 f"({rates['download_mb_per_sec']:.1f} MB/s), redaction cache hits/misses "
+                 f"{counters['cache_hits']}/{counters['cache_misses']}")
+
+    total = sum(span["seconds"] for span in record["spans"].values()) or 1.0
+    for name, span in sorted(record["spans"].items(), key=lambda entry: -entry[1]["seconds"]):
+        if span["count"]:
+            logging.info(f"  {name:<12} {span['seconds']:10.1f}s  {100 * span['seconds'] / total:5.1f}%  "
+                         f"{1000 * span['seconds'] / span['count']:8.2f} ms/span  ({span['count']} spans)")
+
+    stages = {name: figures for name, figures in record["stages"].items() if "utilization" in figures}
+    if stages:
+        busiest = max(stages, key=lambda name: stages[name]["utilization"])
+        logging.info(f"Busiest stage: {busiest} ({100 * stages[busiest]['utilization']:.0f}% of its workers' time); "
+                     f"adding capacity there is most likely to speed the run up.")
+
+    memory = record["stages"].get("memory")
+    if memory:
+        logging.info(f"Peak memory: {memory['peak_rss_mb']:.0f} MB"
+                     + (f" of {memory['limit_mb']:.0f} MB, upstream stages paused for "
+                        f"{memory['throttled_seconds']:.1f}s" if memory["limit_mb"] else ""))
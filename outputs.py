@@ -0,0 +1,899 @@
+import bisect
+import csv
+import functools
+import heapq
+import io
+import json
+import logging
+import operator
+import os
+import pathlib
+import pickle
+import shutil
+import tempfile
+import zlib
+from datetime import datetime
+
+from listing import as_utc
+from manifest import commit_output_size
+from metrics import metric_span
+from pipeline import batch_objects
+
+
+# Prefixes of the CSV files that are consolidated per panelist
+CSV_PREFIXES = ["screenshot_data", "app_accessibility_data", "app_segment_data", "session_data"]
+
+# Columns that may hold a row's capture time (epoch seconds/milliseconds or ISO 8601), in order of preference
+TIMESTAMP_COLUMNS = ["timestamp", "time", "created_at", "start_time", "session_start", "date"]
+
+# Explicit column types of the columnar outputs, as Arrow type names. Columns not listed are stored as
+# strings. 'timestamp' names the capture-time columns the date partition is derived from.
+COLUMNAR_SCHEMAS = {
+    "screenshot_data": {"timestamp": TIMESTAMP_COLUMNS, "types": {"timestamp": "int64"}},
+    "app_accessibility_data": {"timestamp": TIMESTAMP_COLUMNS, "types": {"timestamp": "int64"}},
+    "app_segment_data": {"timestamp": TIMESTAMP_COLUMNS, "types": {"timestamp": "int64", "start_time": "int64",
+                                                                 "end_time": "int64", "duration": "int64"}},
+    "session_data": {"timestamp": TIMESTAMP_COLUMNS, "types": {"timestamp": "int64", "start_time": "int64",
+                                                             "end_time": "int64", "duration": "int64"}},
+}
+
+
+# CSV consolidation engine
+# Sources whose header matches the output's are appended as raw bytes. Only sources with a different
+# column set are parsed row by row and realigned, so memory stays bounded by the copy buffer.
+
+# Bytes that aren't valid UTF-8 are carried through unchanged
+_CSV_ERRORS = 'surrogateescape'
+
+# Rows buffered before realigned rows are written out
+_CSV_FLUSH_ROWS = 10000
+
+
+def panelist_from_key(key):
+    """
+    Returns the panelist folder name for an S3 key, i.e. the folder the zip file lives in.
+
+    Args:
+        key: S3 object key of a panelist zip file.
+    """
+    return key.split('/')[-2]
+
+
+def csv_prefix(filename):
+    """
+    Returns the consolidation prefix a CSV file name starts with, or None if it matches none of them.
+
+    Args:
+        filename: Base name of the CSV file.
+    """
+    for prefix in CSV_PREFIXES:
+        if filename.startswith(prefix):
+            return prefix
+    return None
+
+
+def _open_csv_source(source):
+    """
+    Opens a CSV source, given as a file path or as the file's bytes, for binary reading.
+    """
+    return open(source, 'rb') if isinstance(source, str) else io.BytesIO(source)
+
+
+def parse_csv_header(line):
+    """
+    Parses a raw header line into column names, dropping a UTF-8 byte order mark.
+    """
+    text = line.decode('utf-8', _CSV_ERRORS).lstrip('\ufeff')
+    return next(csv.reader([text]), [])
+
+
+def _format_csv_row(row):
+    """
+    Formats one CSV row as bytes.
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerow(row)
+    return buffer.getvalue().encode('utf-8', _CSV_ERRORS)
+
+
+def read_csv_header(source):
+    """
+    Reads the column names of a CSV file.
+
+    Args:
+        source: Path of the CSV file, or its content as bytes.
+
+    Returns:
+        list: Column names, empty for an empty file.
+    """
+    with _open_csv_source(source) as f:
+        return parse_csv_header(f.readline())
+
+
+def _copy_csv_rows(f, out, header, columns):
+    """
+    Copies the rows following the header of an open CSV source to out, aligned to columns.
+
+    Args:
+        f: Binary file object positioned just after the source's header line.
+        out: Binary output file.
+        header: The source's column names.
+        columns: Column names of the output.
+    """
+    if header == columns:
+        last = b'\n'
+        for chunk in iter(functools.partial(f.read, 1024 * 1024), b''):
+            out.write(chunk)
+            last = chunk[-1:]
+        if last != b'\n':
+            out.write(b'\n')
+        return
+
+    # Columns missing from the source are left empty
+    positions = {column: index for index, column in reversed(list(enumerate(header)))}
+    mapping = [positions.get(column) for column in columns]
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    reader = csv.reader(io.TextIOWrapper(f, encoding='utf-8', errors=_CSV_ERRORS, newline=''))
+    for count, row in enumerate(reader, start=1):
+        if not row:
+            continue
+        writer.writerow(['' if index is None or index >= len(row) else row[index] for index in mapping])
+        if count % _CSV_FLUSH_ROWS == 0:
+            out.write(buffer.getvalue().encode('utf-8', _CSV_ERRORS))
+            buffer.seek(0)
+            buffer.truncate()
+    out.write(buffer.getvalue().encode('utf-8', _CSV_ERRORS))
+
+
+def write_consolidated_csv(output_path, sources, append=False, replace=True):
+    """
+    Consolidates CSV sources into one output file, opened once.
+
+    The output's columns are the union of the sources' columns in first-seen order (after the
+    existing output's columns when appending). Sources with exactly those columns are copied as raw
+    bytes; others are realigned row by row, leaving missing columns empty. When appending sources
+    that add columns, the existing output is rewritten once with the widened header.
+
+    Args:
+        output_path: Path of the consolidated CSV.
+        sources: CSV file paths and/or CSV contents as bytes.
+        append: Append to an existing output instead of replacing it.
+        replace: Rename a rewritten output into place. Otherwise it is left at output_path + '.tmp'
+            for the caller to rename.
+
+    Returns:
+        str: The path the output was written to: output_path, or its temporary file when not
+            replaced, or None if there was nothing to write.
+    """
+    sources = list(sources)
+    headers = [read_csv_header(source) for source in sources]
+    existing = read_csv_header(output_path) if append and os.path.exists(output_path) else []
+
+    columns = list(existing)
+    seen = set(columns)
+    for header in headers:
+        for column in header:
+            if column not in seen:
+                seen.add(column)
+                columns.append(column)
+
+    if not columns:
+        return None
+
+    def copy_sources(out):
+        for source, header in zip(sources, headers):
+            if header:
+                with _open_csv_source(source) as f:
+                    f.readline()
+                    _copy_csv_rows(f, out, header, columns)
+
+    if existing and existing == columns:
+        with open(output_path, 'ab') as out:
+            copy_sources(out)
+        return output_path
+
+    # New outputs and widened ones are written to a temporary file and renamed into place
+    temp_path = output_path + '.tmp'
+    with open(temp_path, 'wb') as out:
+        out.write(_format_csv_row(columns))
+        if existing:
+            with open(output_path, 'rb') as f:
+                f.readline()
+                _copy_csv_rows(f, out, existing, columns)
+        copy_sources(out)
+    if not replace:
+        return temp_path
+    os.replace(temp_path, output_path)
+    return output_path
+
+
+def combine_csv_files(input_dict, query_id):
+    """
+    Combines each folder's CSV files into one consolidated CSV per prefix.
+
+    Args:
+        input_dict: Mapping of folder (panelist) names to lists of CSV file paths, as returned by
+            process_child_folders_csvs.
+        query_id: Unique identifier for the query/download session.
+    """
+    output_folder = f"{query_id}/combined"
+
+    for folder, csv_files in input_dict.items():
+        prefix_dict = {}
+
+        # Group CSV files by prefix
+        for csv_file in csv_files:
+            prefix = csv_prefix(os.path.basename(csv_file))
+            if prefix is not None:
+                prefix_dict.setdefault(prefix, []).append(csv_file)
+
+        panelist_folder = os.path.join(os.path.join(output_folder, 'panelists'), folder + '/metadata')
+        logging.debug(f"Combining CSVs into {panelist_folder}")
+        pathlib.Path(panelist_folder).mkdir(parents=True, exist_ok=True)
+
+        # Combine CSV files within each prefix group
+        for prefix, files in prefix_dict.items():
+            combined_csv = os.path.join(panelist_folder, f"{prefix}-consolidated.csv")
+            with metric_span("consolidate"):
+                write_consolidated_csv(combined_csv, files)
+
+
+# if __name__ == "__main__":
+#     # Example usage:
+#     folder_dict = {
+#         "folder1": ["folder1/screenshot_data_1.csv", "folder1/screenshot_data_2.csv", "folder1/screenshot_data_3.csv"],
+#         "folder2": ["folder2/accessibility_data_1.csv", "folder2/accessibility_data_2.csv"],
+#         "folder3": ["folder3/app_segement_data_1.csv", "folder3/app_segement_data_2.csv"],
+#         "folder4": ["folder4/session_data_1.csv"]
+#     }
+#
+#     combine_csv_files(folder_dict)
+
+
+# Sorted outputs
+# Optionally, each consolidated CSV is sorted by capture time and deduplicated at the end of the run by an
+# external merge sort: rows are sorted in runs of bounded size that spill to disk, then merged k ways.
+# Rows appended since the previous sort are sorted on their own and merged with the already sorted part,
+# so an incremental run rewrites each file once rather than sorting it from scratch. A sidecar
+# <csv>.idx.json marks a file as sorted and records the byte offset of every index_interval-th row, so
+# time-range reads can seek instead of scanning. Per prefix, the panelists' sorted CSVs are then merged
+# into one cross-panelist CSV under combined/merged.
+
+# Default sort settings; entries can be overridden per run
+SORT_SETTINGS = {
+    "run_bytes": 32 * 1024 * 1024,  # CSV bytes sorted in memory per run before it spills to disk
+    "fan_in": 64,                   # Runs or files merged at once; more are merged in several passes
+    "index_interval": 10000,        # Rows between entries of the sparse offset index
+}
+
+# Bytes at the end of a file's sorted part whose checksum identifies it in the sidecar index
+_SORT_FINGERPRINT_BYTES = 4096
+
+# Sort key of rows without a parseable capture time, which go last
+_NO_TIMESTAMP = float('inf')
+
+
+def row_timestamp(value):
+    """
+    Parses a capture time cell given as epoch seconds, epoch milliseconds or ISO 8601.
+
+    Returns:
+        float: Seconds since the epoch, or None if the cell can't be parsed.
+    """
+    value = value.strip()
+    if not value:
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        try:
+            return as_utc(datetime.fromisoformat(value.replace('Z', '+00:00'))).timestamp()
+        except ValueError:
+            return None
+    # Epoch milliseconds exceed 1e11 for any date after 1973; smaller values are epoch seconds
+    return number / 1000 if number > 1e11 else number
+
+
+def sort_column(columns):
+    """
+    Returns the capture time column of a CSV (the first of TIMESTAMP_COLUMNS it has), or None.
+    """
+    return next((column for column in TIMESTAMP_COLUMNS if column in columns), None)
+
+
+def _index_path(csv_path):
+    return csv_path + '.idx.json'
+
+
+def _fingerprint(f, size):
+    f.seek(max(0, size - _SORT_FINGERPRINT_BYTES))
+    return zlib.crc32(f.read(min(size, _SORT_FINGERPRINT_BYTES)))
+
+
+def load_csv_index(csv_path):
+    """
+    Loads the sidecar index of a sorted CSV.
+
+    Returns:
+        dict: The index, whose 'size' is the length of the file's sorted part; rows appended since
+        follow it unsorted. None if the file was never sorted or was rewritten since.
+    """
+    try:
+        with open(_index_path(csv_path)) as f:
+            index = json.load(f)
+        with open(csv_path, 'rb') as f:
+            columns = parse_csv_header(f.readline())
+            size = os.fstat(f.fileno()).st_size
+            if columns != index["columns"] or size < index["size"] or _fingerprint(f, index["size"]) != index["tail"]:
+                return None
+    except (OSError, ValueError, KeyError):
+        return None
+    return index
+
+
+def csv_rows(f, end=None):
+    """
+    Parses the CSV rows of an open binary file from its current position up to the byte offset end.
+    """
+    def lines():
+        while end is None or f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line.decode('utf-8', _CSV_ERRORS)
+
+    return (row for row in csv.reader(lines()) if row)
+
+
+def _spill(entries, spill_dir):
+    """
+    Writes sorted (key, row) entries to a temporary run file, pickled in chunks.
+    """
+    fd, path = tempfile.mkstemp(dir=spill_dir, suffix='.run')
+    with os.fdopen(fd, 'wb') as f:
+        for chunk in batch_objects(entries, _CSV_FLUSH_ROWS):
+            pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def _read_run(path):
+    """
+    Yields the (key, row) entries of a run file and removes it once read.
+    """
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    yield from pickle.load(f)
+                except EOFError:
+                    break
+    finally:
+        os.remove(path)
+
+
+def _sorted_runs(entries, run_bytes, spill_dir):
+    """
+    Sorts (key, row) entries in runs of about run_bytes of CSV text. All but a last, in-memory run are
+    spilled to disk.
+
+    Returns:
+        list: Iterables of sorted entries, one per run.
+    """
+    runs, run, size = [], [], 0
+    for entry in entries:
+        run.append(entry)
+        size += sum(map(len, entry[1])) + len(entry[1])
+        if size >= run_bytes:
+            run.sort(key=operator.itemgetter(0))
+            runs.append(_read_run(_spill(run, spill_dir)))
+            run, size = [], 0
+    if run:
+        run.sort(key=operator.itemgetter(0))
+        runs.append(run)
+    return runs
+
+
+def merge_runs(runs, fan_in, spill_dir):
+    """
+    Merges sorted runs of (key, row) entries k ways, at most fan_in at a time: with more runs, groups
+    of fan_in are first merged into larger spilled runs.
+
+    Returns:
+        iterator: The merged entries; runs with equal keys keep their order.
+    """
+    runs = list(runs)
+    while len(runs) > fan_in:
+        runs = [_read_run(_spill(heapq.merge(*runs[i:i + fan_in], key=operator.itemgetter(0)), spill_dir))
+                for i in range(0, len(runs), fan_in)]
+    return heapq.merge(*runs, key=operator.itemgetter(0))
+
+
+def _dedupe(entries, key_positions, dropped):
+    """
+    Drops entries whose dedupe key equals that of an earlier entry with the same capture time. Duplicates
+    share their capture time, so only the keys of the current time need to be remembered.
+    """
+    current, seen = None, set()
+    for key, row in entries:
+        if key != current:
+            current, seen = key, set()
+        row_key = tuple(row[i] if i < len(row) else '' for i in key_positions) if key_positions else tuple(row)
+        if row_key in seen:
+            dropped[0] += 1
+            continue
+        seen.add(row_key)
+        yield key, row
+
+
+def write_sorted_csv(output_path, columns, entries, time_column, dedupe_key=None, index_interval=10000, commit=None):
+    """
+    Writes sorted (key, row) entries to a CSV, replacing it atomically, together with its sidecar index.
+
+    Args:
+        output_path: Path of the CSV.
+        columns: Column names.
+        entries: Sorted (capture time, row) entries.
+        time_column: Name of the column the rows are sorted by.
+        dedupe_key: Columns the rows were deduplicated by, recorded in the index.
+        index_interval: Rows between index entries.
+        commit: Optional callable receiving the new size of the CSV once it is written, before it
+            replaces the old one.
+
+    Returns:
+        int: Number of rows written.
+    """
+    temp_path = output_path + '.tmp'
+    offsets, rows = [], 0
+    with open(temp_path, 'wb') as out:
+        out.write(_format_csv_row(columns))
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        offset = out.tell()
+        for key, row in entries:
+            if rows % index_interval == 0:
+                out.write(buffer.getvalue().encode('utf-8', _CSV_ERRORS))
+                buffer.seek(0)
+                buffer.truncate()
+                offset = out.tell()
+                offsets.append([None if key == _NO_TIMESTAMP else key, offset])
+            writer.writerow(row)
+            rows += 1
+        out.write(buffer.getvalue().encode('utf-8', _CSV_ERRORS))
+        size = out.tell()
+
+    with open(temp_path, 'rb') as f:
+        tail = _fingerprint(f, size)
+    index = {"sorted": True, "sortColumn": time_column, "dedupeKey": dedupe_key, "columns": columns,
+             "rows": rows, "size": size, "tail": tail, "interval": index_interval, "index": offsets}
+    with open(_index_path(output_path) + '.tmp', 'w') as f:
+        json.dump(index, f)
+    if commit is not None:
+        commit(size)
+    os.replace(temp_path, output_path)
+    os.replace(_index_path(output_path) + '.tmp', _index_path(output_path))
+    return rows
+
+
+def _dedupe_positions(columns, time_column, dedupe_key):
+    """
+    Returns the positions of the dedupe key columns, or None to compare whole rows. A key naming a
+    column the CSV doesn't have falls back to whole rows.
+    """
+    if not dedupe_key or any(column not in columns for column in dedupe_key):
+        return None
+    return [columns.index(column) for column in dict.fromkeys([time_column] + list(dedupe_key))]
+
+
+def sort_consolidated_csv(csv_path, dedupe_key=None, settings=None, spill_dir=None, commit=None):
+    """
+    Sorts a consolidated CSV by capture time and drops duplicate rows, in place. Only rows appended
+    since the last sort are sorted; they are then merged with the sorted part.
+
+    Args:
+        csv_path: Path of the consolidated CSV.
+        dedupe_key: Columns identifying duplicate rows besides the capture time, or None for whole rows.
+        settings: Overrides for SORT_SETTINGS.
+        spill_dir: Folder for spilled runs (default: next to the CSV).
+        commit: Optional callable receiving the sorted CSV's size before it replaces the CSV (see
+            write_sorted_csv).
+
+    Returns:
+        tuple: Rows written and duplicate rows dropped, or None if the CSV has no capture time column.
+    """
+    settings = {**SORT_SETTINGS, **(settings or {})}
+    columns = read_csv_header(csv_path)
+    time_column = sort_column(columns)
+    if time_column is None:
+        return None
+    position = columns.index(time_column)
+
+    index = load_csv_index(csv_path)
+    sorted_size = index["size"] if index else 0
+    if index and os.path.getsize(csv_path) == sorted_size and index.get("dedupeKey") == dedupe_key:
+        return index["rows"], 0
+    if index and index.get("dedupeKey") != dedupe_key:
+        sorted_size = 0
+
+    def entries(f, end=None):
+        for row in csv_rows(f, end):
+            timestamp = row_timestamp(row[position]) if position < len(row) else None
+            yield (_NO_TIMESTAMP if timestamp is None else timestamp), row
+
+    dropped = [0]
+    with open(csv_path, 'rb') as head, open(csv_path, 'rb') as tail:
+        header_size = len(head.readline())
+        runs = []
+        if sorted_size:
+            runs.append(entries(head, sorted_size))
+            tail.seek(sorted_size)
+        else:
+            tail.seek(header_size)
+        runs += _sorted_runs(entries(tail), settings["run_bytes"], spill_dir or os.path.dirname(csv_path))
+
+        merged = merge_runs(runs, settings["fan_in"], spill_dir or os.path.dirname(csv_path))
+        merged = _dedupe(merged, _dedupe_positions(columns, time_column, dedupe_key), dropped)
+        rows = write_sorted_csv(csv_path, columns, merged, time_column, dedupe_key, settings["index_interval"],
+                                commit)
+    return rows, dropped[0]
+
+
+def merge_panelist_csvs(inputs, output_path, settings=None, spill_dir=None):
+    """
+    Merges sorted consolidated CSVs of several panelists into one CSV sorted by capture time, with a
+    leading panelist column. The output's columns are the union of the inputs' columns.
+
+    Args:
+        inputs: (panelist, csv_path) tuples of sorted CSVs.
+        output_path: Path of the merged CSV.
+        settings: Overrides for SORT_SETTINGS.
+        spill_dir: Folder for intermediate runs when there are more inputs than fan_in.
+
+    Returns:
+        int: Rows written.
+    """
+    settings = {**SORT_SETTINGS, **(settings or {})}
+    headers = [read_csv_header(csv_path) for _, csv_path in inputs]
+    columns = ["panelist"]
+    for header in headers:
+        columns.extend(column for column in header if column not in columns)
+    time_column = sort_column(columns)
+
+    def entries(panelist, csv_path, header):
+        positions = {column: index for index, column in reversed(list(enumerate(header)))}
+        mapping = [positions.get(column) for column in columns[1:]]
+        time_position = positions.get(time_column)
+        with open(csv_path, 'rb') as f:
+            f.readline()
+            for row in csv_rows(f):
+                timestamp = row_timestamp(row[time_position]) if time_position is not None and time_position < len(row) \
+                    else None
+                yield ((_NO_TIMESTAMP if timestamp is None else timestamp),
+                       [panelist] + ['' if index is None or index >= len(row) else row[index] for index in mapping])
+
+    runs = [entries(panelist, csv_path, header) for (panelist, csv_path), header in zip(inputs, headers)]
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    merged = merge_runs(runs, settings["fan_in"], spill_dir or os.path.dirname(output_path))
+    return write_sorted_csv(output_path, columns, merged, time_column, None, settings["index_interval"])
+
+
+def sort_outputs(query_id, dedupe_key=None, settings=None):
+    """
+    Sorts and deduplicates every consolidated CSV of a query, then merges each prefix across panelists
+    into combined/merged/<prefix>-consolidated.csv.
+
+    Args:
+        query_id: Unique identifier for the query/download session.
+        dedupe_key: Columns identifying duplicate rows besides the capture time, or None for whole rows.
+        settings: Overrides for SORT_SETTINGS.
+    """
+    panelists_folder = os.path.join(query_id, "combined", "panelists")
+    panelists = sorted(os.listdir(panelists_folder)) if os.path.isdir(panelists_folder) else []
+    spill_dir = os.path.join(query_id, "sort")
+    os.makedirs(spill_dir, exist_ok=True)
+
+    try:
+        for prefix in CSV_PREFIXES:
+            inputs, total, dropped = [], 0, 0
+            for panelist in panelists:
+                csv_path = os.path.join(panelists_folder, panelist, "metadata", f"{prefix}-consolidated.csv")
+                if not os.path.exists(csv_path):
+                    continue
+                # Deduplication can shrink the CSV, so its new size is committed to the manifest before
+                # it replaces the old one (see restore_consolidated_output)
+                with metric_span("sort"):
+                    result = sort_consolidated_csv(csv_path, dedupe_key, settings, spill_dir,
+                                                   functools.partial(commit_output_size, query_id, csv_path))
+                if result is None:
+                    logging.warning(f"Not sorting {csv_path}: it has none of the columns {TIMESTAMP_COLUMNS}.")
+                    continue
+                total += result[0]
+                dropped += result[1]
+                inputs.append((panelist, csv_path))
+
+            if not inputs:
+                continue
+            merged_path = os.path.join(query_id, "combined", "merged", f"{prefix}-consolidated.csv")
+            with metric_span("sort"):
+                merge_panelist_csvs(inputs, merged_path, settings, spill_dir)
+            logging.info(f"Sorted {total} {prefix} rows of {len(inputs)} panelists into {merged_path} "
+                         f"({dropped} duplicates dropped).")
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+
+def read_csv_time_range(csv_path, start=None, end=None):
+    """
+    Reads the rows of a sorted CSV whose capture time falls within a range, seeking to the first
+    candidate row through the sidecar index. Unsorted CSVs, and rows appended after the last sort,
+    are scanned in full.
+
+    Args:
+        csv_path: Path of the CSV.
+        start: Earliest capture time as datetime, or None.
+        end: Latest capture time as datetime, or None.
+
+    Yields:
+        dict: Column name to value, per matching row.
+    """
+    start_ts = as_utc(start).timestamp() if start else float('-inf')
+    end_ts = as_utc(end).timestamp() if end else float('inf')
+    index = load_csv_index(csv_path)
+
+    with open(csv_path, 'rb') as f:
+        columns = parse_csv_header(f.readline())
+        for row in time_range_rows(f, columns, index, start_ts, end_ts):
+            yield dict(zip(columns, row))
+
+
+def time_range_rows(f, columns, index, start_ts, end_ts):
+    """
+    Yields the rows of an open CSV, positioned after its header, whose capture time lies between
+    start_ts and end_ts (see read_csv_time_range).
+
+    Args:
+        f: CSV file opened in binary mode.
+        columns: The CSV's column names.
+        index: Its sidecar index as returned by load_csv_index, or None.
+        start_ts: Earliest capture time as epoch seconds.
+        end_ts: Latest capture time as epoch seconds.
+    """
+    position = columns.index(sort_column(columns)) if sort_column(columns) else None
+    sorted_end = f.tell()
+
+    if index and position is not None:
+        sorted_end = index["size"]
+        # The last index entry before start; entries without a time sort last
+        times = [entry[0] if entry[0] is not None else _NO_TIMESTAMP for entry in index["index"]]
+        entry = bisect.bisect_left(times, start_ts) - 1
+        if entry >= 0:
+            f.seek(index["index"][entry][1])
+        for row in csv_rows(f, sorted_end):
+            timestamp = row_timestamp(row[position]) if position < len(row) else None
+            if timestamp is None or timestamp > end_ts:
+                break
+            if timestamp >= start_ts:
+                yield row
+        f.seek(sorted_end)
+
+    for row in csv_rows(f):
+        timestamp = row_timestamp(row[position]) if position is not None and position < len(row) else None
+        if position is None or (timestamp is not None and start_ts <= timestamp <= end_ts):
+            yield row
+
+
+# Columnar outputs
+# The consolidated CSVs stay the incremental source of truth; at the end of a run they are converted to
+# compressed Parquet or Arrow IPC files per panelist, plus one dataset per prefix across all panelists,
+# partitioned by panelist and capture date.
+
+# File extension per columnar format
+COLUMNAR_FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+# Partition columns added to every columnar row
+PARTITION_COLUMNS = ["panelist", "date"]
+
+
+def columnar_schema(prefix, columns):
+    """
+    Builds the explicit Arrow schema of a prefix's columnar output.
+
+    Args:
+        prefix: One of CSV_PREFIXES.
+        columns: Column names of the consolidated CSVs.
+
+    Returns:
+        pyarrow.Schema: The CSV columns, typed per COLUMNAR_SCHEMAS, followed by the partition columns.
+    """
+    import pyarrow as pa
+
+    types = COLUMNAR_SCHEMAS.get(prefix, {}).get("types", {})
+    fields = [pa.field(column, pa.type_for_alias(types.get(column, "string")))
+              for column in columns if column not in PARTITION_COLUMNS]
+    return pa.schema(fields + [pa.field("panelist", pa.string()), pa.field("date", pa.date32())])
+
+
+# Types a column falls back to, in order, when its values don't fit its COLUMNAR_SCHEMAS type
+COLUMNAR_FALLBACK_TYPES = ["float64", "string"]
+
+
+def fit_columnar_schema(schema, inputs):
+    """
+    Reads the consolidated CSVs once and widens each typed column whose values don't all fit its type,
+    e.g. a timestamp written as ISO 8601 text or a fractional duration, to the first fallback type that
+    fits them all (see COLUMNAR_FALLBACK_TYPES).
+
+    Args:
+        schema: Schema from columnar_schema.
+        inputs: (panelist, consolidated CSV path) tuples.
+
+    Returns:
+        pyarrow.Schema: The schema with the columns that didn't fit widened.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+
+    types = {field.name: field.type for field in schema
+             if field.name not in PARTITION_COLUMNS and field.type != pa.string()}
+
+    for _, csv_path in inputs:
+        header = read_csv_header(csv_path)
+        if not any(column in types for column in header):
+            continue
+        reader = pa_csv.open_csv(csv_path, convert_options=pa_csv.ConvertOptions(
+            column_types={column: pa.string() for column in header}, strings_can_be_null=False,
+            include_columns=[column for column in header if column in types]))
+        for batch in reader:
+            for column in batch.schema.names:
+                values = _empty_to_null(batch.column(column))
+                while types[column] != pa.string():
+                    try:
+                        pc.cast(values, types[column])
+                        break
+                    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                        fallbacks = [pa.type_for_alias(alias) for alias in COLUMNAR_FALLBACK_TYPES]
+                        wider = fallbacks[fallbacks.index(types[column]) + 1:] if types[column] in fallbacks else fallbacks
+                        logging.warning(f"Column '{column}' of {csv_path} doesn't fit type {types[column]}; "
+                                        f"storing it as {wider[0]}.")
+                        types[column] = wider[0]
+
+    return pa.schema([field.with_type(types[field.name]) if field.name in types else field for field in schema])
+
+
+def _empty_to_null(values):
+    """
+    Turns empty strings into nulls so they can be cast to non-string types.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    return pc.if_else(pc.equal(values, ""), pa.scalar(None, pa.string()), values)
+
+
+def partition_dates(values):
+    """
+    Derives capture dates from a string column of epoch seconds, epoch milliseconds or ISO 8601 times.
+
+    Args:
+        values: pyarrow string array.
+
+    Returns:
+        pyarrow date32 array; values that can't be parsed become null.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    values = _empty_to_null(values)
+    try:
+        numbers = pc.cast(values, pa.float64())
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        try:
+            return pc.cast(pc.cast(values, pa.timestamp("us")), pa.date32())
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            return pa.nulls(len(values), pa.date32())
+
+    # Epoch milliseconds exceed 1e11 for any date after 1973; smaller values are epoch seconds
+    millis = pc.if_else(pc.greater(numbers, 1e11), numbers, pc.multiply(numbers, 1000))
+    return pc.cast(pc.cast(pc.cast(millis, pa.int64(), safe=False), pa.timestamp("ms")), pa.date32())
+
+
+def _columnar_batches(prefix, inputs, schema, output_format):
+    """
+    Reads consolidated CSVs in record batches conformed to schema, writing each panelist's columnar
+    file along the way.
+
+    Args:
+        prefix: One of CSV_PREFIXES.
+        inputs: (panelist, consolidated CSV path) tuples.
+        schema: Schema from columnar_schema.
+        output_format: 'parquet' or 'arrow'.
+
+    Yields:
+        pyarrow.RecordBatch: Rows of all panelists.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+
+    timestamp_candidates = COLUMNAR_SCHEMAS.get(prefix, {}).get("timestamp", TIMESTAMP_COLUMNS)
+
+    for panelist, csv_path in inputs:
+        header = read_csv_header(csv_path)
+        timestamp_column = next((column for column in timestamp_candidates if column in header), None)
+        reader = pa_csv.open_csv(csv_path, convert_options=pa_csv.ConvertOptions(
+            column_types={column: pa.string() for column in header}, strings_can_be_null=False))
+
+        output_path = os.path.splitext(csv_path)[0] + COLUMNAR_FORMATS[output_format]
+        if output_format == "parquet":
+            writer = pq.ParquetWriter(output_path, schema, compression="zstd")
+        else:
+            writer = pa.ipc.new_file(output_path, schema, options=pa.ipc.IpcWriteOptions(compression="zstd"))
+
+        with writer:
+            for batch in reader:
+                rows = batch.num_rows
+                arrays = []
+                for field in schema:
+                    if field.name == "panelist":
+                        arrays.append(pa.array([panelist] * rows, pa.string()))
+                    elif field.name == "date":
+                        arrays.append(partition_dates(batch.column(timestamp_column)) if timestamp_column
+                                      else pa.nulls(rows, pa.date32()))
+                    elif field.name not in batch.schema.names:
+                        arrays.append(pa.nulls(rows, field.type))
+                    elif field.type == pa.string():
+                        arrays.append(batch.column(field.name))
+                    else:
+                        try:
+                            arrays.append(pc.cast(_empty_to_null(batch.column(field.name)), field.type))
+                        except pa.ArrowInvalid as e:
+                            raise ValueError(f"Column '{field.name}' of {csv_path} doesn't fit type {field.type}: {e}")
+
+                conformed = pa.RecordBatch.from_arrays(arrays, schema=schema)
+                writer.write_batch(conformed)
+                yield conformed
+
+
+def write_columnar_outputs(query_id, output_format="parquet"):
+    """
+    Converts a query's consolidated CSVs to compressed columnar files. Each panelist gets a
+    <prefix>-consolidated.parquet (or .arrow) file next to its CSV, and each prefix gets one dataset
+    across all panelists under combined/datasets/<prefix>, partitioned as panelist=<id>/date=<date>.
+
+    Args:
+        query_id: Unique identifier for the query/download session.
+        output_format: 'parquet' or 'arrow'.
+    """
+    import pyarrow.dataset as ds
+
+    if output_format not in COLUMNAR_FORMATS:
+        raise ValueError(f"Unknown columnar format: {output_format}")
+
+    panelists_folder = os.path.join(query_id, "combined", "panelists")
+    panelists = sorted(os.listdir(panelists_folder)) if os.path.isdir(panelists_folder) else []
+    file_format = ds.ParquetFileFormat() if output_format == "parquet" else ds.IpcFileFormat()
+
+    for prefix in CSV_PREFIXES:
+        inputs = [(panelist, os.path.join(panelists_folder, panelist, "metadata", f"{prefix}-consolidated.csv"))
+                  for panelist in panelists]
+        inputs = [(panelist, csv_path) for panelist, csv_path in inputs if os.path.exists(csv_path)]
+        if not inputs:
+            continue
+
+        # Panelists' CSVs may have drifted apart; the dataset uses the union of their columns
+        columns = []
+        for _, csv_path in inputs:
+            columns.extend(column for column in read_csv_header(csv_path) if column not in columns)
+        schema = fit_columnar_schema(columnar_schema(prefix, columns), inputs)
+
+        dataset_folder = os.path.join(query_id, "combined", "datasets", prefix)
+        shutil.rmtree(dataset_folder, ignore_errors=True)
+        ds.write_dataset(_columnar_batches(prefix, inputs, schema, output_format), dataset_folder,
+                         schema=schema, format=file_format,
+                         file_options=file_format.make_write_options(compression="zstd"),
+                         partitioning=PARTITION_COLUMNS, partitioning_flavor="hive",
+                         max_partitions=1_000_000, existing_data_behavior="overwrite_or_ignore")
+        logging.info(f"Wrote {output_format} dataset {dataset_folder} for {len(inputs)} panelists.")
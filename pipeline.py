@@ -0,0 +1,680 @@
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from metrics import metrics_snapshot, metrics_state, restore_metrics
+
+
+# Step 5: Pipeline scheduler
+# Each stage is served by a persistent pool of worker processes reading from a bounded queue. A full
+# queue blocks the stage feeding it, so a slow stage throttles its producers instead of piling up work.
+
+class _Stop:
+    """
+    Sentinel sent through a stage queue to stop one of its workers. The class itself is sent: classes are
+    pickled by reference, so it arrives as the same object, and no stage output can be mistaken for it.
+    """
+
+
+_STOP = _Stop
+
+# Stage counters kept in a shared array: processed items, failed items and busy seconds per stage
+_STAT_FIELDS = ("processed", "failed", "busy_seconds")
+
+
+# Memory budget
+# The pipeline's memory is sampled from /proc as the proportional set size (PSS) of the driver and its
+# workers, which splits the pages forked processes share among them instead of counting them once per
+# process. With a memory limit, the source and the first stage stop taking new items while the total is
+# above it, so that the items in flight drain before more are admitted.
+
+# Seconds between memory samples
+MEMORY_SAMPLE_INTERVAL = 0.25
+
+
+def process_memory(pid):
+    """
+    Returns the memory of a process in bytes: its PSS, or its RSS on kernels without smaps_rollup.
+
+    Args:
+        pid: Process ID.
+
+    Returns:
+        int: Bytes, or None if the process is gone or /proc isn't available.
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def _watch_memory(memory, workers, queues, admit, done):
+    """
+    Samples the memory of the driver and its workers into the memory figures until done is set. With a
+    limit, closes the admission gate while the total is above it. The gate reopens once the total drops
+    below 90% of the limit, or once the queues behind the first stage are empty: memory that is still
+    held then isn't work in flight (e.g. freed memory the allocator keeps), and waiting longer would
+    stall the run.
+    """
+    limit = memory["limit_mb"] * 1024 * 1024 if admit is not None else None
+    sampled, warned = time.monotonic(), False
+
+    while not done.wait(MEMORY_SAMPLE_INTERVAL):
+        pids = [os.getpid()] + [process.pid for processes in workers for process in processes]
+        total = sum(process_memory(pid) or 0 for pid in pids)
+        now = time.monotonic()
+        memory["rss_mb"] = total / 1024 / 1024
+        memory["peak_rss_mb"] = max(memory["peak_rss_mb"], memory["rss_mb"])
+        if admit is None:
+            continue
+        if not admit.is_set():
+            memory["throttled_seconds"] += now - sampled
+        sampled = now
+
+        backlog = sum(max(_queue_depth(queue), 0) for queue in queues[1:])
+        if total > limit and backlog:
+            admit.clear()
+        elif total <= 0.9 * limit or not backlog:
+            if total > limit and not warned:
+                logging.warning(f"Memory limit of {memory['limit_mb']:.0f} MB is below the pipeline's working set "
+                                f"({memory['rss_mb']:.0f} MB); admitting work anyway.")
+                warned = True
+            admit.set()
+
+
+# Autotuning
+# With autotuning, a thread in the driver samples stage throughput, queue depths, machine CPU, the
+# pipeline's memory and the download rate every interval seconds, and adjusts three settings within
+# limits: the download threads per worker, the batch size and the number of active image workers. The
+# image stage starts all of its processes up front and those above the active count wait idle. At most
+# one setting changes per interval, so that its effect can be measured, and an increase that doesn't
+# raise throughput is reverted. The settings reached are saved per machine profile, and later autotuned
+# runs on the same kind of machine start from them.
+
+# Default autotuning settings; entries can be overridden per run
+AUTOTUNE_SETTINGS = {
+    "interval": 10,             # Seconds between tuning decisions
+    "min_concurrency": 2,       # Range of download threads per worker process
+    "max_concurrency": 64,
+    "min_batch_size": 5,        # Range of objects per batch
+    "max_batch_size": 200,
+    "min_image_workers": 1,     # Least active image workers; the most is the image stage's process count
+    "batch_seconds": (10, 60),  # Range of seconds the first stage should spend per batch
+    "cpu_high": 0.9,            # Machine CPU utilization above which no workers or threads are added
+    "memory_high": 0.85,        # Share of the memory limit (or of physical memory) at which the tuner backs off
+    "min_gain": 0.05,           # Throughput gain an increase must bring to be kept
+    "hold_intervals": 3,        # Intervals a reverted setting is left alone
+    "profile_path": "autotune.json",  # Tuned settings per machine profile
+}
+
+# Tuned settings, in the order of the autotuner's shared values, and their query setting names
+TUNED_SETTINGS = {"concurrency": "downloadConcurrency", "batch_size": "batchSize", "image_workers": "imageWorkers"}
+
+# Autotuner of the running pipeline, passed to its worker processes
+_autotuner = None
+
+
+def cpu_times():
+    """
+    Returns the machine's cumulative busy and total CPU time in clock ticks from /proc/stat.
+
+    Returns:
+        tuple: (busy, total), or None where /proc isn't available.
+    """
+    try:
+        with open("/proc/stat") as f:
+            fields = [int(value) for value in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    # Idle and I/O wait are the fourth and fifth fields
+    return sum(fields) - sum(fields[3:5]), sum(fields)
+
+
+def physical_memory():
+    """
+    Returns the machine's physical memory in bytes, or None if it can't be determined.
+    """
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError):
+        return None
+
+
+def machine_profile():
+    """
+    Returns the key tuned settings are saved under: the CPU count and physical memory in GB.
+    """
+    memory = physical_memory()
+    return f"{multiprocessing.cpu_count()}cpu-{round(memory / 1024 ** 3) if memory else 0}gb"
+
+
+def load_tuned_settings(path=None):
+    """
+    Returns the settings saved by the last autotuned run on this machine profile.
+
+    Returns:
+        dict: Query setting name to value, or None if no run was tuned on this kind of machine.
+    """
+    try:
+        with open(path or AUTOTUNE_SETTINGS["profile_path"]) as f:
+            tuned = json.load(f).get(machine_profile())
+    except (OSError, ValueError):
+        return None
+    return {name: tuned[name] for name in TUNED_SETTINGS.values() if name in tuned} if tuned else None
+
+
+def save_tuned_settings(tuned, path=None):
+    """
+    Saves tuned settings under this machine's profile, keeping those of other profiles.
+
+    Args:
+        tuned: Query setting name to value.
+        path: Profile file (default: AUTOTUNE_SETTINGS['profile_path']).
+    """
+    path = path or AUTOTUNE_SETTINGS["profile_path"]
+    profiles = {}
+    try:
+        with open(path) as f:
+            profiles = json.load(f)
+    except (OSError, ValueError):
+        pass
+    profiles[machine_profile()] = dict(tuned, updated=datetime.now(timezone.utc).isoformat())
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(profiles, f, indent=2)
+    os.replace(temp_path, path)
+
+
+class Autotuner:
+    """
+    Adjusts the download threads, batch size and active image workers of a running pipeline. The values
+    live in a shared array that the pipeline's workers receive and read as they go.
+
+    Args:
+        concurrency: Starting number of download threads per worker process.
+        batch_size: Starting number of objects per batch.
+        image_workers: Starting number of active image workers, or None for all of the image stage's.
+        settings: Overrides for AUTOTUNE_SETTINGS.
+        memory_limit: Bytes the pipeline may hold (default: physical memory).
+    """
+
+    def __init__(self, concurrency, batch_size, image_workers=None, settings=None, memory_limit=None):
+        self.settings = {**AUTOTUNE_SETTINGS, **(settings or {})}
+        self.limits = {
+            "concurrency": (self.settings["min_concurrency"], self.settings["max_concurrency"]),
+            "batch_size": (self.settings["min_batch_size"], self.settings["max_batch_size"]),
+            "image_workers": (self.settings["min_image_workers"], multiprocessing.cpu_count()),
+        }
+        self.memory_limit = memory_limit or physical_memory()
+        # Written by the tuning thread only, so readers need no lock
+        self.values = multiprocessing.Array('i', len(TUNED_SETTINGS), lock=False)
+        self.set("concurrency", concurrency)
+        self.set("batch_size", batch_size)
+        self.set("image_workers", image_workers or self.limits["image_workers"][1])
+        self.image_stage = None
+        self.stages, self.stage_index = [], None
+        self.released = None
+        self.trial = None
+        self.held = {}
+
+    def get(self, name):
+        """
+        Returns the current value of a tuned setting.
+        """
+        return self.values[list(TUNED_SETTINGS).index(name)]
+
+    def set(self, name, value, reason=None):
+        """
+        Sets a tuned setting, clamped to its limits, logging the change with its reason.
+
+        Returns:
+            bool: Whether the value changed.
+        """
+        low, high = self.limits[name]
+        value = max(low, min(high, int(value)))
+        index = list(TUNED_SETTINGS).index(name)
+        if value == self.values[index]:
+            return False
+        if reason:
+            logging.info(f"Autotune: {name} {self.values[index]} -> {value} ({reason})")
+        self.values[index] = value
+        return True
+
+    def tune_stage(self, stage):
+        """
+        Marks a stage as the image stage, whose active workers are tuned up to its process count.
+        """
+        stage["tuned"] = "image_workers"
+        self.image_stage = stage
+        self.limits["image_workers"] = (min(self.settings["min_image_workers"], stage["workers"]), stage["workers"])
+        self.set("image_workers", self.get("image_workers"))
+
+    def release(self):
+        """
+        Ends tuning and activates every image worker, so that all of them receive their stop sentinel.
+        """
+        self.released = self.get("image_workers")
+        self.values[list(TUNED_SETTINGS).index("image_workers")] = self.limits["image_workers"][1]
+
+    def tuned(self):
+        """
+        Returns:
+            dict: The current values under their query setting names.
+        """
+        tuned = {setting: self.get(name) for name, setting in TUNED_SETTINGS.items()}
+        if self.released is not None:
+            tuned["imageWorkers"] = self.released
+        return tuned
+
+    def _sample(self, stages, queues, stats):
+        """
+        Returns the figures the tuning decisions are based on: cumulative counters and current queue depths.
+        """
+        with stats.get_lock():
+            counters = list(stats)
+        record = metrics_snapshot()
+        width = len(_STAT_FIELDS)
+        return {"time": time.monotonic(), "cpu": cpu_times(),
+                "processed": [counters[index * width] for index in range(len(stages))],
+                "busy": [counters[index * width + 2] for index in range(len(stages))],
+                "depth": [max(_queue_depth(queue), 0) for queue in queues],
+                "bytes": record["counters"]["bytes_downloaded"], "images": record["counters"]["images"]}
+
+    def _raise(self, name, value, reason, throughput):
+        """
+        Raises a setting on trial: it is reverted after the next interval unless throughput grew.
+        """
+        if self.held.get(name, 0) > 0:
+            return False
+        previous = self.get(name)
+        if not self.set(name, value, reason):
+            return False
+        self.trial = (name, previous, throughput)
+        return True
+
+    def _tune(self, before, after, memory):
+        """
+        Makes at most one tuning decision from the figures sampled at the start and end of an interval.
+        """
+        settings = self.settings
+        elapsed = after["time"] - before["time"]
+        for name in self.held:
+            self.held[name] -= 1
+        rates = {"concurrency": (after["bytes"] - before["bytes"]) / elapsed,
+                 "image_workers": (after["images"] - before["images"]) / elapsed}
+
+        # An increase that didn't pay off is reverted and left alone for a while
+        if self.trial is not None:
+            name, previous, throughput = self.trial
+            self.trial = None
+            if throughput and rates[name] < throughput * (1 + settings["min_gain"]):
+                self.set(name, previous, f"throughput {rates[name]:.1f}/s didn't grow from {throughput:.1f}/s")
+                self.held[name] = settings["hold_intervals"]
+                return
+
+        # Back off under memory pressure: fewer image workers first, then fewer threads, then smaller batches
+        rss = memory["rss_mb"] * 1024 * 1024 if memory else None
+        if rss and self.memory_limit and rss > settings["memory_high"] * self.memory_limit:
+            reason = f"memory at {rss / self.memory_limit:.0%} of {self.memory_limit / 1024 ** 2:.0f} MB"
+            for name, value in (("image_workers", self.get("image_workers") - 1),
+                                ("concurrency", self.get("concurrency") * 3 // 4),
+                                ("batch_size", self.get("batch_size") // 2)):
+                if name == "image_workers" and self.stage_index is None:
+                    continue
+                if self.set(name, value, reason):
+                    self.held[name] = settings["hold_intervals"]
+                    return
+            return
+
+        cpu = None
+        if before["cpu"] and after["cpu"] and after["cpu"][1] > before["cpu"][1]:
+            cpu = (after["cpu"][0] - before["cpu"][0]) / (after["cpu"][1] - before["cpu"][1])
+        cpu_free = cpu is None or cpu < settings["cpu_high"]
+
+        def utilization(index, workers):
+            return (after["busy"][index] - before["busy"][index]) / (elapsed * workers)
+
+        # More image workers while images back up and there are cores to spare; fewer while they idle
+        if self.stage_index is not None:
+            index = self.stage_index
+            active = self.get("image_workers")
+            busy = utilization(index, active)
+            if after["depth"][index] > active and busy > 0.8 and cpu_free:
+                if self._raise("image_workers", active + 1, f"{after['depth'][index]} items queued, "
+                               f"workers {busy:.0%} busy", rates["image_workers"]):
+                    return
+            elif after["depth"][index] == 0 and busy < 0.5:
+                if self.set("image_workers", active - 1, f"workers {busy:.0%} busy with nothing queued"):
+                    return
+
+        # More download threads while the first stage is busy and the stage after it is starved
+        first = self.stages[0]
+        busy = utilization(0, first.get("workers", 1))
+        if len(self.stages) > 1 and busy > 0.8 and after["depth"][1] <= self.stages[1].get("workers", 1) and cpu_free:
+            concurrency = self.get("concurrency")
+            if self._raise("concurrency", max(concurrency + 1, concurrency * 3 // 2),
+                           f"{first['name']} {busy:.0%} busy, next stage starved", rates["concurrency"]):
+                return
+
+        # Batches that take the first stage a reasonable time: long enough to amortize per-batch
+        # overhead, short enough to balance the work and checkpoint often
+        processed = after["processed"][0] - before["processed"][0]
+        if processed:
+            seconds = (after["busy"][0] - before["busy"][0]) / processed
+            low, high = settings["batch_seconds"]
+            if seconds < low:
+                self.set("batch_size", self.get("batch_size") * 2, f"{seconds:.1f}s per batch")
+            elif seconds > high:
+                self.set("batch_size", self.get("batch_size") // 2, f"{seconds:.1f}s per batch")
+
+    def run(self, stages, queues, stats, memory, done):
+        """
+        Tuning loop run in a thread of the driver until done is set.
+
+        Args:
+            stages: The pipeline's stage dictionaries.
+            queues: Queue in front of each stage.
+            stats: Shared array of stage counters.
+            memory: Memory figures sampled by the pipeline (see _watch_memory), or None.
+            done: Event set when the pipeline stops.
+        """
+        self.stages = stages
+        self.stage_index = next((index for index, stage in enumerate(stages) if stage is self.image_stage), None)
+        before = self._sample(stages, queues, stats)
+        while not done.wait(self.settings["interval"]) and self.released is None:
+            after = self._sample(stages, queues, stats)
+            try:
+                self._tune(before, after, memory)
+            except Exception as e:
+                logging.warning(f"Autotune step failed: {e}")
+            before = after
+
+
+def pipeline_state(autotuner=None):
+    """
+    Returns the run state that the pipeline's workers need from the driver: the shared metrics array
+    and the autotuner. It is passed to each worker explicitly, so that workers started with spawn (the
+    default on macOS and Windows) see it as well as forked ones.
+    """
+    return {"metrics": metrics_state(), "autotuner": autotuner}
+
+
+def restore_pipeline_state(state):
+    """
+    Installs the run state returned by pipeline_state in a worker process.
+    """
+    global _autotuner
+    restore_metrics(state["metrics"])
+    _autotuner = state["autotuner"]
+
+
+def _stage_worker(index, stage, in_queue, out_queue, stats, busy, slot, admit=None, rank=0, state=None,
+                  initializer=None):
+    """
+    Worker loop for one pipeline stage. Runs until it receives the stop sentinel.
+
+    Args:
+        index: Position of the stage in the pipeline.
+        stage: Stage dictionary (see run_pipeline).
+        in_queue: Queue the stage reads items from.
+        out_queue: Queue of the next stage, or None for the last stage.
+        stats: Shared array of stage counters.
+        busy: Shared array of busy seconds per worker.
+        slot: Index of this worker in busy.
+        admit: Event that is cleared while the pipeline is above its memory limit, or None.
+        rank: Index of this worker among the stage's workers.
+        state: Run state as returned by pipeline_state, or None to keep this process's.
+        initializer: Optional callable run before the stage's own initializer (see run_pipeline).
+    """
+    if state is not None:
+        restore_pipeline_state(state)
+    if initializer is not None:
+        initializer()
+    if stage.get('initializer'):
+        stage['initializer']()
+
+    offset = index * len(_STAT_FIELDS)
+    tuned = stage.get('tuned') if _autotuner is not None else None
+    while True:
+        # Workers beyond the autotuned number of active workers wait without taking items
+        while tuned and rank >= _autotuner.get(tuned):
+            time.sleep(0.25)
+        item = in_queue.get()
+        if item is _STOP:
+            break
+        if admit is not None:
+            admit.wait()
+
+        started = time.monotonic()
+        failed = False
+        try:
+            outputs = stage['target'](item)
+            if outputs and out_queue is not None:
+                for output in outputs:
+                    out_queue.put(output)
+        except Exception as e:
+            failed = True
+            logging.error(f"Stage '{stage['name']}' failed on an item: {e}")
+
+        elapsed = time.monotonic() - started
+        with stats.get_lock():
+            stats[offset + (1 if failed else 0)] += 1
+            stats[offset + 2] += elapsed
+        busy[slot] += elapsed
+
+
+def _queue_depth(queue):
+    """
+    Returns the approximate number of items in a queue, or -1 where the platform can't report it.
+    """
+    try:
+        return queue.qsize()
+    except NotImplementedError:
+        return -1
+
+
+def _pipeline_summary(stages, queues, stats, busy, submitted, elapsed, memory=None):
+    """
+    Builds per-stage queue depth, throughput and utilization figures from the shared counters.
+
+    Returns:
+        dict: Stage name to a dictionary of figures. The 'list' entry counts items fed to the pipeline,
+        the 'memory' entry (where /proc is available) holds the current and peak memory of the
+        pipeline's processes, its limit and the seconds upstream stages were held back. With autotuning,
+        the 'autotune' entry holds the current tuned settings.
+    """
+    summary = {"list": {"submitted": submitted, "items_per_sec": submitted / elapsed if elapsed else 0.0}}
+
+    with stats.get_lock():
+        counters = list(stats)
+    busy_seconds = list(busy)
+
+    slot = 0
+    for index, stage in enumerate(stages):
+        processed, failed, busy = counters[index * len(_STAT_FIELDS):(index + 1) * len(_STAT_FIELDS)]
+        workers = stage.get('workers', 1)
+        summary[stage['name']] = {
+            "queue_depth": _queue_depth(queues[index]),
+            "processed": int(processed),
+            "failed": int(failed),
+            "items_per_sec": processed / elapsed if elapsed else 0.0,
+            "utilization": busy / (elapsed * workers) if elapsed else 0.0,
+            "worker_utilization": [round(seconds / elapsed, 3) if elapsed else 0.0
+                                   for seconds in busy_seconds[slot:slot + workers]],
+        }
+        slot += workers
+
+    if memory is not None:
+        summary["memory"] = dict(memory)
+    if _autotuner is not None:
+        summary["autotune"] = _autotuner.tuned()
+    return summary
+
+
+def _report_pipeline(stages, queues, stats, busy, counter, started, done, report_interval, on_progress,
+                     memory=None):
+    """
+    Logs per-stage queue depth and throughput every report_interval seconds until done is set.
+    """
+    while not done.wait(report_interval):
+        summary = _pipeline_summary(stages, queues, stats, busy, counter[0], time.monotonic() - started, memory)
+        for name, figures in summary.items():
+            logging.info(f"[{name}] " + ", ".join(f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}"
+                                                 for k, v in figures.items()))
+        if on_progress:
+            on_progress(summary)
+
+
+def run_pipeline(source, stages, queue_size=64, report_interval=30, on_progress=None, memory_limit=None,
+                 autotuner=None, initializer=None):
+    """
+    Runs items through a chain of stages connected by bounded queues, each stage served by a
+    persistent pool of worker processes.
+
+    Args:
+        source: Iterable of items for the first stage. It is consumed in this process, so it can be
+            a lazy listing.
+        stages: List of stage dictionaries with the keys
+            'name': Stage name used in reports.
+            'target': Callable taking one item and returning an iterable of items for the next stage
+                (or None). Must be picklable, e.g. a module-level function or functools.partial.
+                Outputs are queued as they are produced, so a generator target is throttled by the
+                next stage's queue.
+            'workers': Number of worker processes (default: 1).
+            'initializer': Optional callable run once in each worker before it takes items.
+            'queue_size': Optional maximum number of items waiting in front of this stage.
+            'tuned': Optional name of the autotuned setting holding the stage's number of active workers
+                (see Autotuner.tune_stage).
+        queue_size: Maximum number of items waiting in front of each stage without its own queue_size.
+        report_interval: Seconds between progress reports.
+        on_progress: Optional callable receiving the summary with every progress report and once
+            more when the pipeline stops, e.g. to checkpoint the run.
+        memory_limit: Bytes the driver and workers may hold together (see process_memory). While
+            they hold more, neither the source nor the first stage takes new items. None for no limit.
+        autotuner: Autotuner adjusting the run's settings while it runs, or None.
+        initializer: Optional picklable callable run once in every worker before its stage's initializer,
+            e.g. to install the driver's query settings (see query_worker_initializer).
+
+    Returns:
+        dict: Per-stage queue depth, processed and failed counts, items/sec, utilization of the stage's
+        workers overall and of each worker.
+
+    If the source raises or the run is interrupted (KeyboardInterrupt, SystemExit), the workers are
+    terminated instead of drained and the exception is re-raised.
+    """
+    queues = [multiprocessing.Queue(maxsize=stage.get('queue_size', queue_size)) for stage in stages]
+    stats = multiprocessing.Array('d', len(stages) * len(_STAT_FIELDS))
+    admit = multiprocessing.Event() if memory_limit else None
+    if admit is not None:
+        admit.set()
+    # Each worker only adds to its own slot, so the busy array needs no lock
+    busy = multiprocessing.Array('d', sum(stage.get('workers', 1) for stage in stages), lock=False)
+
+    # The driver reads the tuned settings too, e.g. to batch the source
+    global _autotuner
+    _autotuner = autotuner
+    state = pipeline_state(autotuner)
+
+    workers = []
+    slot = 0
+    for index, stage in enumerate(stages):
+        out_queue = queues[index + 1] if index + 1 < len(stages) else None
+        processes = []
+        for rank in range(stage.get('workers', 1)):
+            processes.append(multiprocessing.Process(
+                target=_stage_worker,
+                args=(index, stage, queues[index], out_queue, stats, busy, slot, admit if index == 0 else None,
+                      rank, state, initializer)))
+            slot += 1
+        for process in processes:
+            process.start()
+        workers.append(processes)
+
+    started = time.monotonic()
+    counter = [0]
+    done = threading.Event()
+    memory = None
+    if process_memory(os.getpid()) is not None:
+        memory = {"limit_mb": memory_limit / 1024 / 1024 if memory_limit else None, "rss_mb": 0.0,
+                  "peak_rss_mb": 0.0, "throttled_seconds": 0.0}
+        threading.Thread(target=_watch_memory, args=(memory, workers, queues, admit, done), daemon=True).start()
+    if autotuner is not None:
+        threading.Thread(target=autotuner.run, args=(stages, queues, stats, memory, done), daemon=True).start()
+    reporter = threading.Thread(target=_report_pipeline,
+                                args=(stages, queues, stats, busy, counter, started, done, report_interval,
+                                      on_progress, memory),
+                                daemon=True)
+    reporter.start()
+
+    interrupted = True
+    try:
+        for item in source:
+            if admit is not None:
+                admit.wait()
+            queues[0].put(item)
+            counter[0] += 1
+
+        if autotuner is not None:
+            autotuner.release()
+        # Stop the stages in order so each one drains its queue before the next one is told to stop
+        for index, processes in enumerate(workers):
+            for _ in processes:
+                queues[index].put(_STOP)
+            for process in processes:
+                process.join()
+        interrupted = False
+    finally:
+        if interrupted:
+            # Unfinished items aren't recorded as done, so the next run picks them up again
+            for processes in workers:
+                for process in processes:
+                    process.terminate()
+            for processes in workers:
+                for process in processes:
+                    process.join()
+
+        done.set()
+        reporter.join()
+
+        summary = _pipeline_summary(stages, queues, stats, busy, counter[0], time.monotonic() - started, memory)
+        _autotuner = None
+        if on_progress:
+            on_progress(summary)
+
+    logging.debug(f"Pipeline finished: {json.dumps(summary)}")
+    return summary
+
+
+def batch_objects(objects, zip_batch_size):
+    """
+    Groups S3 objects into lists of at most zip_batch_size objects.
+
+    Args:
+        objects: Iterable of S3 objects.
+        zip_batch_size: Maximum number of objects per batch, or a callable returning it, which is called
+            as each batch is started (e.g. to follow the autotuned batch size).
+
+    Yields:
+        list: A batch of objects. The last batch may be smaller.
+    """
+    size = zip_batch_size if callable(zip_batch_size) else lambda: zip_batch_size
+    batch, limit = [], size()
+    for obj in objects:
+        batch.append(obj)
+        if len(batch) >= limit:
+            yield batch
+            batch, limit = [], size()
+    if batch:
+        yield batch
@@ -0,0 +1,898 @@
+import contextlib
+import functools
+import io
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import zipfile
+from datetime import datetime, timezone
+
+from catalog import write_catalog
+from listing import query_s3_objects_in_date_range
+from manifest import (load_member_index, manifest_counts, manifest_pending, mark_manifest,
+                      restore_consolidated_output, store_member_index)
+from members import MemberFilter, member_kind, member_ranges, select_members, zip_member_index
+from metrics import count_metric, export_metrics, init_metrics, log_metrics_summary, metric_span, metrics_snapshot
+from outputs import csv_prefix, panelist_from_key, sort_outputs, write_columnar_outputs, write_consolidated_csv
+from pipeline import (Autotuner, batch_objects, load_tuned_settings, machine_profile, run_pipeline,
+                      save_tuned_settings)
+from queryconfig import lock_query, query_detection_settings, query_encode_settings, save_query_config
+from redact import (ImageResult, configure_encoder, detection_settings_from, encoder_settings, image_output_path,
+                    redact_image_batch, redact_stage, redaction_cache, redaction_cache_stats, share_zip_images,
+                    tuned_image_workers)
+from s3io import (S3RangeFile, configure_output_sink, create_s3_client, download_concurrency, download_s3_object,
+                  get_download_worker, init_download_worker, output_exists, output_sink_config, read_ahead,
+                  read_s3_object, upload_outputs)
+
+
+# Queries
+# A query lists a panel's zip files in its date range, runs them through the pipeline's download, unzip,
+# redaction and consolidation stages and finalizes the consolidated outputs.
+
+def download_stage(query_id, bucket_name, num_processors, download_settings=None, autotuner=None):
+    """
+    Returns the download stage: num_processors workers, each with its own S3 client and download threads.
+
+    Args:
+        query_id: Unique identifier for the query/download session.
+        bucket_name: Name of the S3 bucket.
+        num_processors: Number of worker processes.
+        download_settings: Overrides for DOWNLOAD_SETTINGS.
+        autotuner: Autotuner of the run, or None.
+    """
+    return {"name": "download", "workers": num_processors,
+            "initializer": functools.partial(init_download_worker, download_settings, num_processors, autotuner),
+            "target": functools.partial(download_batch, query_id=query_id, bucket_name=bucket_name)}
+
+
+def checkpoint_batches(query_config, batches):
+    """
+    Passes batches through while recording, in the query configuration, how many files were handed to
+    the pipeline and the first key of the latest batch.
+
+    Args:
+        query_config: The query configuration to update.
+        batches: Iterable of S3Object batches.
+
+    Yields:
+        list: The batches, unchanged.
+    """
+    for batch in batches:
+        query_config["numFilesToDownload"] += len(batch)
+        query_config["lastBatchBeginId"] = batch[0].key
+        yield batch
+
+
+def checkpoint_query(query_config, summary=None):
+    """
+    Updates the query configuration with the progress recorded in the manifest and saves it atomically.
+    Used as the pipeline's on_progress callback.
+
+    Args:
+        query_config: The query configuration.
+        summary: Pipeline summary (unused; progress is read from the manifest).
+    """
+    counts = manifest_counts(query_config["queryId"])
+    query_config["numFilesDownloaded"] = counts["downloaded"]
+    query_config["numFilesConsolidated"] = counts["consolidated"]
+    query_config["updatedAt"] = datetime.now(timezone.utc).isoformat()
+    save_query_config(query_config)
+
+
+def report_progress(query_config=None, metrics_path=None, summary=None):
+    """
+    Pipeline on_progress callback: checkpoints the query and exports a metrics record.
+
+    Args:
+        query_config: Query configuration to checkpoint, or None.
+        metrics_path: Metrics file to export to, or None.
+        summary: Pipeline summary.
+    """
+    if query_config is not None:
+        checkpoint_query(query_config, summary)
+    if metrics_path:
+        export_metrics(metrics_path, metrics_snapshot(query_config and query_config["queryId"], summary))
+
+
+def configure_query_worker(encode_settings, output_config):
+    """
+    Installs the driver's encode settings and output sink configuration in a pipeline worker process.
+
+    Args:
+        encode_settings: Encode settings as returned by encoder_settings.
+        output_config: Output sink configuration as returned by output_sink_config.
+    """
+    configure_encoder(encode_settings)
+    configure_output_sink(*(output_config or ()))
+
+
+def query_worker_initializer():
+    """
+    Returns the pipeline initializer passing this process's query settings to the pipeline's workers,
+    so that workers started with spawn see them as well as forked ones (see run_pipeline).
+    """
+    return functools.partial(configure_query_worker, encoder_settings(), output_sink_config())
+
+
+def download_zip_files_in_batches(s3, bucket_name, path, start_date, end_date, zip_batch_size, num_processors,
+                                  query_id, download_settings=None):
+    """
+     Downloads objects from S3 in batches, using multiple processes.
+
+     Args:
+         s3_client: Boto3 S3 client instance.
+         bucket_name: Name of the S3 bucket.
+         path: Path within the S3 bucket from which to download objects.
+         start_date: Start date for querying objects.
+         end_date: End date for querying objects.
+         zip_batch_size: Number of files to download in each batch.
+         num_processors: Number of parallel processes to use for downloading.
+         query_id: Unique identifier for the query/download session.
+         download_settings: Overrides for DOWNLOAD_SETTINGS.
+
+     Returns:
+         dict: Pipeline summary as returned by run_pipeline.
+     """
+    objects_to_download = query_s3_objects_in_date_range(s3, bucket_name, path, start_date, end_date)
+    stages = [download_stage(query_id, bucket_name, num_processors, download_settings)]
+    return run_pipeline(batch_objects(objects_to_download, zip_batch_size), stages,
+                        initializer=query_worker_initializer())
+
+
+def download_batch(batch, query_id, bucket_name):
+    """
+    Downloads a batch of files from an S3 bucket, running the process's download threads concurrently.
+
+    Args:
+        batch: List of S3Object entries to download.
+        query_id: Unique identifier for the query/download session.
+        bucket_name: Name of the S3 bucket.
+
+    Returns:
+        list: (object, local path) tuples of the downloaded (or already present) zip files.
+    """
+    worker = get_download_worker()
+
+    def download(obj):
+        file_path = os.path.join(f'{query_id}/zipped', *obj.key.split('/')[1:])  # Construct local file path
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)  # Ensure the directory exists
+
+        # Download file if it doesn't already exist
+        if not os.path.exists(file_path):
+            download_s3_object(bucket_name, obj.key, obj.size, file_path, worker, obj.etag)
+        mark_manifest(query_id, obj, "downloaded")
+        return obj, file_path
+
+    return list(worker["object_executor"].map(download, batch))
+
+
+def stream_unzip_and_redact(zip_source, image_folder, redaction_type='redact', detection_settings=None,
+                            cache=None, member_filter=None):
+    """
+    Reads a zip archive without extracting it to disk. Images are decoded from memory, redacted in
+    batches and written once to the image folder; CSV members are returned for the consolidation stage.
+
+    Args:
+        zip_source: Path or file-like object holding the zip archive, or an open zipfile.ZipFile.
+        image_folder: Folder where redacted images are written.
+        redaction_type (str): The type of processing ('redact' or 'blur') to apply to detected faces.
+        detection_settings: Overrides for DETECTION_SETTINGS.
+        cache: FaceBoxCache of the archive's panelist, or None.
+        member_filter: MemberFilter selecting the members to read, or None for all.
+
+    Returns:
+        list: (filename, bytes) tuples, one per CSV member.
+    """
+    settings = detection_settings_from(detection_settings)
+    csv_members = []
+    pending = []
+
+    with contextlib.ExitStack() as stack:
+        zip_ref = zip_source
+        if not isinstance(zip_source, zipfile.ZipFile):
+            zip_ref = stack.enter_context(zipfile.ZipFile(zip_source, 'r'))
+        for file_info in select_members(zip_ref, member_filter):
+            if member_kind(file_info.filename) == 'image':
+                processed_image_path = image_output_path(os.path.join(image_folder, file_info.filename))
+
+                # Skip images that were already redacted by a previous run
+                if not output_exists(processed_image_path):
+                    with metric_span("unzip"):
+                        pending.append((zip_ref.read(file_info), processed_image_path))
+                    if len(pending) >= settings["batch_size"]:
+                        redact_image_batch(pending, redaction_type, settings, cache)
+                        pending = []
+            else:
+                with metric_span("unzip"):
+                    csv_members.append((file_info.filename, zip_ref.read(file_info)))
+
+    if pending:
+        redact_image_batch(pending, redaction_type, settings, cache)
+    return csv_members
+
+
+def stream_batch(batch, query_id, bucket_name, redaction_type='redact', detection_settings=None,
+                 share_images=False, member_filter=None):
+    """
+    Streams a batch of zip files from S3 through the unzip and redaction steps in memory.
+
+    Args:
+        batch: List of objects to process.
+        query_id: Unique identifier for the query/download session.
+        bucket_name: Name of the S3 bucket.
+        redaction_type (str): The type of processing ('redact' or 'blur') to apply to detected faces.
+        detection_settings: Overrides for DETECTION_SETTINGS.
+        share_images: Hand decoded images to the redaction stage through shared memory instead of
+            redacting them here (see share_zip_images).
+        member_filter: MemberFilter selecting the members to read. Archives are then read through
+            ranged GETs of their central directory and selected members only, and archives whose
+            cached member index has no match aren't read at all.
+
+    Yields:
+        tuple: (object, panelist, csv_members) per zip file that was processed. With share_images, each
+        zip's SharedImage items followed by an (object, panelist, csv_members, num_images) tuple.
+    """
+    worker = get_download_worker()
+
+    def fetch(obj):
+        try:
+            if member_filter is None:
+                return io.BytesIO(read_s3_object(bucket_name, obj.key, obj.size, worker, obj.etag))
+            index = load_member_index(query_id, obj)
+            ranges = member_ranges(index, member_filter) if index is not None else None
+            if ranges == []:
+                return None
+            source = S3RangeFile(bucket_name, obj, worker)
+            # The central directory sits at the end of the archive; with a cached index the selected
+            # members are fetched up front as well, in coalesced ranges
+            source.prefetch([(max(0, obj.size - source.block_size), obj.size)] + (ranges or []))
+            return source
+        except Exception as e:
+            return e
+
+    # Bodies are fetched concurrently ahead of the zip currently being redacted, but only as many as
+    # there are download threads, so a large batch doesn't hold all of its zips in memory at once
+    bodies = read_ahead(worker["object_executor"], fetch, batch, download_concurrency(worker))
+    for obj, body in zip(batch, bodies):
+        panelist = panelist_from_key(obj.key)
+        image_folder = f"{query_id}/combined/panelists/{panelist}/images"
+
+        try:
+            if isinstance(body, Exception):
+                raise body
+            mark_manifest(query_id, obj, "downloaded")
+            csv_members, num_images = [], 0
+            # body is None for archives whose cached index has no selected members
+            if body is not None:
+                with zipfile.ZipFile(body, 'r') as zip_ref:
+                    if load_member_index(query_id, obj) is None:
+                        store_member_index(query_id, obj, zip_member_index(zip_ref))
+                    if share_images:
+                        for shared_image in share_zip_images(zip_ref, image_folder, obj, panelist, csv_members,
+                                                             member_filter=member_filter):
+                            num_images += 1
+                            yield shared_image
+                    else:
+                        csv_members = stream_unzip_and_redact(zip_ref, image_folder, redaction_type,
+                                                              detection_settings,
+                                                              redaction_cache(panelist, detection_settings),
+                                                              member_filter)
+        except Exception as e:
+            logging.error(f"Error streaming {obj.key}: {e}")
+            continue
+
+        mark_manifest(query_id, obj, "extracted")
+        if share_images:
+            yield obj, panelist, csv_members, num_images
+            continue
+        mark_manifest(query_id, obj, "redacted")
+        yield obj, panelist, csv_members
+
+    if not share_images:
+        logging.debug(f"Redaction cache: {redaction_cache_stats()}")
+
+
+def append_csv_members(panelist, csv_members, query_id, written, append_existing=False):
+    """
+    Appends CSV members of a panelist's zip file to the panelist's consolidated CSVs. Outputs that
+    have to be rewritten are left next to their final path, to be renamed into place once the
+    manifest has committed the zip (see consolidate_panelist_csvs).
+
+    Args:
+        panelist: Panelist folder name.
+        csv_members: (filename, data) tuples as returned by stream_unzip_and_redact, where data is the
+            CSV content as bytes or the path of an extracted CSV file.
+        query_id: Unique identifier for the query/download session.
+        written: Set of consolidated CSV paths already started during this run. The first members for
+            an output replace any file left by a previous run; later ones are appended, aligned to
+            the output's columns (see write_consolidated_csv).
+        append_existing: Append to consolidated CSVs left by a previous run instead of replacing them.
+            Each is first restored to the size the manifest committed for it.
+
+    Returns:
+        dict: Consolidated CSV path to the path its rows were written to.
+    """
+    metadata_folder = os.path.join(query_id, 'combined', 'panelists', panelist, 'metadata')
+
+    outputs = {}
+    prefix_dict = {}
+    for filename, data in csv_members:
+        prefix = csv_prefix(os.path.basename(filename))
+        if prefix is not None:
+            prefix_dict.setdefault(prefix, []).append(data)
+
+    for prefix, sources in prefix_dict.items():
+        os.makedirs(metadata_folder, exist_ok=True)
+        combined_csv = os.path.join(metadata_folder, f"{prefix}-consolidated.csv")
+
+        if append_existing and combined_csv not in written:
+            restore_consolidated_output(query_id, combined_csv)
+        append = combined_csv in written or (append_existing and os.path.exists(combined_csv))
+        written_path = write_consolidated_csv(combined_csv, sources, append, replace=False)
+        if written_path is not None:
+            outputs[combined_csv] = written_path
+            written.add(combined_csv)
+
+    return outputs
+
+
+def stream_zip_files_in_batches(bucket_name, objects, zip_batch_size, num_processors, query_id,
+                                redaction_type='redact', download_settings=None, incremental=False,
+                                query_config=None, detection_settings=None, image_workers=0, metrics_path=None,
+                                memory_limit=None, member_filter=None, autotuner=None):
+    """
+    Streams zip files from S3 in batches, redacting images and consolidating CSVs without staging
+    the zipped or unzipped files on disk.
+
+    Args:
+        bucket_name: Name of the S3 bucket.
+        objects: S3 objects to process.
+        zip_batch_size: Number of files to process in each batch.
+        num_processors: Number of parallel processes to use.
+        query_id: Unique identifier for the query/download session.
+        redaction_type (str): The type of processing ('redact' or 'blur') to apply to detected faces.
+        download_settings: Overrides for DOWNLOAD_SETTINGS.
+        incremental: Skip objects the manifest lists as consolidated and append to existing outputs.
+        query_config: Query configuration to checkpoint progress into while the pipeline runs.
+        detection_settings: Overrides for DETECTION_SETTINGS.
+        image_workers: Processes of a separate redaction stage fed through shared memory, or 0 to
+            redact inside the streaming workers.
+        metrics_path: File to export metrics to with every progress report (see export_metrics).
+        memory_limit: Bytes the pipeline's processes may hold before listing and streaming pause.
+        member_filter: MemberFilter selecting the zip members to read, or None for all (see stream_batch).
+        autotuner: Autotuner adjusting the download concurrency, batch size and active redaction workers
+            while the pipeline runs, or None.
+
+    Returns:
+        dict: Pipeline summary as returned by run_pipeline.
+    """
+    if incremental:
+        objects = manifest_pending(query_id, objects)
+
+    if autotuner is not None:
+        zip_batch_size = functools.partial(autotuner.get, "batch_size")
+    batches = batch_objects(objects, zip_batch_size)
+    if query_config is not None:
+        batches = checkpoint_batches(query_config, batches)
+    on_progress = None
+    if query_config is not None or metrics_path:
+        on_progress = functools.partial(report_progress, query_config, metrics_path)
+
+    stages = [
+        {"name": "stream", "workers": num_processors,
+         "initializer": functools.partial(init_download_worker, download_settings, num_processors, autotuner),
+         "target": functools.partial(stream_batch, query_id=query_id, bucket_name=bucket_name,
+                                     redaction_type=redaction_type, detection_settings=detection_settings,
+                                     share_images=bool(image_workers), member_filter=member_filter)},
+        consolidate_stage(query_id, incremental),
+    ]
+    if image_workers:
+        stages.insert(1, redact_stage(tuned_image_workers(image_workers, autotuner), redaction_type,
+                                      detection_settings))
+        if autotuner is not None:
+            autotuner.tune_stage(stages[1])
+    return run_pipeline(batches, stages, on_progress=on_progress, memory_limit=memory_limit, autotuner=autotuner,
+                        initializer=query_worker_initializer())
+
+
+# Consolidated CSVs started by the consolidation worker during this run
+_consolidated_outputs = set()
+
+# Zips whose images are still in the redaction stage: object -> [images outstanding, any failed, CSV item]
+_redacting_zips = {}
+
+
+def consolidate_panelist_csvs(item, query_id, append_existing=False):
+    """
+    Consolidation stage target: appends one zip file's CSV members to the panelist's consolidated CSVs.
+
+    Args:
+        item: (object, panelist, csv_members) tuple. Behind the shared-memory redaction stage, either an
+            (object, panelist, csv_members, num_images) tuple or an ImageResult: the zip's CSV members
+            are then held back until all of its images are redacted, and dropped if one of them failed,
+            so that the whole zip is processed again by the next run.
+        query_id: Unique identifier for the query/download session.
+        append_existing: Append to consolidated CSVs left by a previous run instead of replacing them.
+    """
+    if isinstance(item, ImageResult) or len(item) == 4:
+        obj = item.job if isinstance(item, ImageResult) else item[0]
+        state = _redacting_zips.setdefault(obj, [0, False, None])
+        if isinstance(item, ImageResult):
+            state[0] -= 1
+            state[1] = state[1] or not item.ok
+        else:
+            state[0] += item[3]
+            state[2] = item[:3]
+        if state[2] is None or state[0] > 0:
+            return
+
+        del _redacting_zips[obj]
+        if state[1]:
+            logging.error(f"Not consolidating {obj.key}: some of its images could not be redacted.")
+            return
+        item = state[2]
+        mark_manifest(query_id, obj, "redacted")
+
+    obj, panelist, csv_members = item
+    with metric_span("consolidate"):
+        outputs = append_csv_members(panelist, csv_members, query_id, _consolidated_outputs, append_existing)
+    # The outputs' sizes are committed with the object, so a run stopped before this point has its
+    # rows truncated away by the next one (see restore_consolidated_output)
+    mark_manifest(query_id, obj, "consolidated",
+                  outputs={path: os.path.getsize(temp_path) for path, temp_path in outputs.items()})
+    for path, temp_path in outputs.items():
+        if temp_path != path:
+            os.replace(temp_path, path)
+    count_metric("zips_consolidated")
+
+
+def consolidate_stage(query_id, incremental=False):
+    """
+    Returns the consolidation stage. It runs a single worker so that no two processes append to the
+    same consolidated CSV.
+
+    Args:
+        query_id: Unique identifier for the query/download session.
+        incremental: Append to consolidated CSVs left by a previous run instead of replacing them.
+    """
+    return {"name": "consolidate", "workers": 1,
+            "target": functools.partial(consolidate_panelist_csvs, query_id=query_id, append_existing=incremental)}
+
+
+def unzip_panelist_zip(item, query_id, redaction_type='redact', detection_settings=None, share_images=False,
+                       member_filter=None):
+    """
+    Unzip stage target: extracts a downloaded zip file into its panelist's folders and redacts its images.
+
+    Args:
+        item: (object, zip path) tuple. The zip file lives in a folder named after the panelist; the
+            object is the zip's S3Object entry, or None if it didn't come from a listing.
+        query_id: Unique identifier for the operation, used in directory structuring.
+        redaction_type (str): The type of processing ('redact' or 'blur') to apply to detected faces.
+        detection_settings: Overrides for DETECTION_SETTINGS.
+        share_images: Hand decoded images to the redaction stage through shared memory instead of
+            redacting them here.
+        member_filter: MemberFilter selecting the members to process, or None for all.
+
+    Returns:
+        list: A single (object, panelist, csv_members) tuple for the consolidation stage, or nothing
+        if the zip couldn't be processed. With share_images, an iterator over the zip's SharedImage
+        items followed by an (object, panelist, csv_members, num_images) tuple.
+    """
+    obj, zip_file = item
+    panelist = os.path.basename(os.path.dirname(zip_file))
+    # Each zip extracts into its own folder: zips of a panelist often hold CSVs of the same name, and a
+    # CSV already extracted from another zip must not be taken for this zip's
+    zip_name = os.path.splitext(os.path.basename(zip_file))[0]
+    destination_folder = f"{query_id}/unzipped/panelists/{panelist}/{zip_name}"
+    image_folder = f"{query_id}/combined/panelists/{panelist}/images"
+
+    os.makedirs(destination_folder, exist_ok=True)
+    os.makedirs(image_folder, exist_ok=True)
+
+    if share_images:
+        return _unzip_and_share_images(obj, zip_file, panelist, query_id, destination_folder, image_folder,
+                                       member_filter)
+
+    index = []
+    csv_files = unzip_file(zip_file, destination_folder, image_folder, redaction_type, detection_settings,
+                           redaction_cache(panelist, detection_settings), member_filter, index)
+    if csv_files is None:
+        return []
+    store_member_index(query_id, obj, index)
+
+    mark_manifest(query_id, obj, "extracted")
+    mark_manifest(query_id, obj, "redacted")
+    return [(obj, panelist, [(os.path.basename(csv_file), csv_file) for csv_file in csv_files])]
+
+
+def _unzip_and_share_images(obj, zip_file, panelist, query_id, destination_folder, image_folder,
+                            member_filter=None):
+    """
+    Extracts a zip's CSV files and yields its images as SharedImage items (see unzip_panelist_zip).
+    """
+    csv_members, num_images = [], 0
+    try:
+        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+            store_member_index(query_id, obj, zip_member_index(zip_ref))
+            for shared_image in share_zip_images(zip_ref, image_folder, obj, panelist, csv_members,
+                                                 destination_folder, member_filter):
+                num_images += 1
+                yield shared_image
+    except Exception as e:
+        logging.error(f"Error unzipping {zip_file}: {e}")
+        return
+
+    mark_manifest(query_id, obj, "extracted")
+    yield obj, panelist, csv_members, num_images
+
+
+def run_query_pipeline(bucket_name, objects, zip_batch_size, num_processors, query_id, streaming=False,
+                       redaction_type='redact', download_settings=None, incremental=True, query_config=None,
+                       detection_settings=None, image_workers=0, metrics_path=None, memory_limit=None,
+                       member_filter=None, autotuner=None):
+    """
+    Runs the list -> download -> unzip/redact -> consolidate pipeline over a set of S3 objects.
+
+    Args:
+        bucket_name: Name of the S3 bucket.
+        objects: Iterable of S3 objects to process.
+        zip_batch_size: Number of files per download batch.
+        num_processors: Number of download (or streaming) worker processes.
+        query_id: Unique identifier for the query/download session.
+        streaming: Whether to stream zips in memory instead of staging them on disk.
+        redaction_type (str): The type of processing ('redact' or 'blur') to apply to detected faces.
+        download_settings: Overrides for DOWNLOAD_SETTINGS.
+        incremental: Skip objects the query's manifest lists as consolidated under their current ETag
+            and append new rows to the existing consolidated CSVs. Otherwise every object is processed
+            and the consolidated CSVs are rewritten.
+        query_config: Query configuration to checkpoint progress into while the pipeline runs.
+        detection_settings: Overrides for DETECTION_SETTINGS.
+        image_workers: Processes of a separate redaction stage fed through shared memory, balancing the
+            redaction work per image. 0 redacts each zip's images inside the unzip workers.
+        metrics_path: File to export metrics to with every progress report (see export_metrics).
+        memory_limit: Bytes the pipeline's processes may hold before listing and downloads pause.
+        member_filter: MemberFilter selecting the zip members to process, or None for all. Only streaming
+            reads just the selected members' bytes; on disk, whole zips are downloaded.
+        autotuner: Autotuner adjusting the download concurrency, batch size and the active workers of
+            the stage that redacts images while the pipeline runs, or None.
+
+    Returns:
+        dict: Pipeline summary as returned by run_pipeline.
+    """
+    if streaming:
+        return stream_zip_files_in_batches(bucket_name, objects, zip_batch_size, num_processors, query_id,
+                                           redaction_type, download_settings, incremental, query_config,
+                                           detection_settings, image_workers, metrics_path, memory_limit,
+                                           member_filter, autotuner)
+
+    if incremental:
+        objects = manifest_pending(query_id, objects)
+
+    if autotuner is not None:
+        zip_batch_size = functools.partial(autotuner.get, "batch_size")
+    batches = batch_objects(objects, zip_batch_size)
+    if query_config is not None:
+        batches = checkpoint_batches(query_config, batches)
+    on_progress = None
+    if query_config is not None or metrics_path:
+        on_progress = functools.partial(report_progress, query_config, metrics_path)
+
+    # With a redaction stage the unzip workers only decode, so most cores go to the redaction workers
+    stages = [
+        download_stage(query_id, bucket_name, num_processors, download_settings, autotuner),
+        {"name": "unzip", "workers": max(1, multiprocessing.cpu_count() - image_workers),
+         "target": functools.partial(unzip_panelist_zip, query_id=query_id, redaction_type=redaction_type,
+                                     detection_settings=detection_settings, share_images=bool(image_workers),
+                                     member_filter=member_filter)},
+        consolidate_stage(query_id, incremental),
+    ]
+    if image_workers:
+        stages.insert(2, redact_stage(tuned_image_workers(image_workers, autotuner), redaction_type,
+                                      detection_settings))
+    if autotuner is not None:
+        # Images are redacted by the redaction stage if there is one, or else by the unzip workers
+        autotuner.tune_stage(stages[2] if image_workers else stages[1])
+    return run_pipeline(batches, stages, on_progress=on_progress, memory_limit=memory_limit, autotuner=autotuner,
+                        initializer=query_worker_initializer())
+
+def unzip_file(zip_file, destination_folder, image_folder, redaction_type='redact', detection_settings=None,
+               cache=None, member_filter=None, index=None):
+    """
+    Unzips a file to a specified destination folder, with additional processing for images. CSV files
+    are extracted; images are redacted straight from the archive unless their output already exists.
+
+    Args:
+        zip_file: Path to the zip file.
+        destination_folder: Folder where files should be extracted to.
+        image_folder: Folder where images should be stored after processing.
+        redaction_type (str): The type of processing ('redact' or 'blur') to apply to detected faces.
+        detection_settings: Overrides for DETECTION_SETTINGS.
+        cache: FaceBoxCache of the archive's panelist, or None.
+        member_filter: MemberFilter selecting the members to process, or None for all.
+        index: List the archive's member index is appended to, or None.
+
+    Returns:
+        list: Paths of the archive's CSV files in the destination folder, including ones extracted by
+        an earlier run, or None if the archive couldn't be processed.
+    """
+    settings = detection_settings_from(detection_settings)
+    csv_files = []
+    pending = []
+    try:
+        count_of_existing_files, count_of_non_existing_files = 0, 0
+
+        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+            if index is not None:
+                index.extend(zip_member_index(zip_ref))
+            for file_info in select_members(zip_ref, member_filter):
+                if member_kind(file_info.filename) == 'csv':
+                    # CSVs are consolidated from their extracted copies
+                    extracted_file_path = os.path.join(destination_folder, file_info.filename)
+                    csv_files.append(extracted_file_path)
+                    if os.path.exists(extracted_file_path):
+                        count_of_existing_files += 1
+                        continue
+                    with metric_span("unzip"):
+                        zip_ref.extract(file_info, destination_folder)
+                    logging.debug(f"Extracted: {file_info.filename}")
+                    count_of_non_existing_files += 1
+                    continue
+
+                # Skip images that were already redacted by a previous run
+                processed_image_path = image_output_path(os.path.join(image_folder, file_info.filename))
+                if output_exists(processed_image_path):
+                    count_of_existing_files += 1
+                    continue
+                with metric_span("unzip"):
+                    pending.append((zip_ref.read(file_info), processed_image_path))
+                if len(pending) >= settings["batch_size"]:
+                    redact_image_batch(pending, redaction_type, settings, cache)
+                    pending = []
+                count_of_non_existing_files += 1
+
+            if pending:
+                redact_image_batch(pending, redaction_type, settings, cache)
+
+            logging.debug(f"Existing files count: {count_of_existing_files}")
+            logging.debug(f"Processed new files count: {count_of_non_existing_files}")
+            if cache is not None:
+                logging.debug(f"Redaction cache hits: {cache.hits}, misses: {cache.misses}")
+
+        # Attempt to remove the original zip file after extraction
+        try:
+            # os.remove(zip_file)
+            logging.debug(f"Removed zip file: {zip_file}")
+        except OSError as e:
+            logging.error(f"Error deleting zip file {zip_file}: {e}")
+
+    except Exception as e:
+        logging.error(f"Error unzipping {zip_file}: {e}")
+        return None
+
+    return csv_files
+
+def process_child_folder_and_unzip_synchronous(parent, children, query_id):
+    """
+    Unzips child folders synchronously within a given parent directory.
+
+    Args:
+        parent: Parent directory containing child folders.
+        children: List of child folders to be unzipped.
+        query_id: Unique identifier for the operation, used in directory structuring.
+    """
+    for child in children:
+        child_path = os.path.join(parent, child)
+        zip_name = os.path.splitext(child)[0]
+        destination_folder = f"{query_id}/unzipped/panelists/{os.path.basename(parent)}/{zip_name}"
+        image_folder = f"{query_id}/combined/panelists/{os.path.basename(parent)}/images"
+
+        # Create destination and image folders
+        os.makedirs(destination_folder, exist_ok=True)
+        os.makedirs(image_folder, exist_ok=True)
+
+        unzip_file(child_path, destination_folder, image_folder)
+
+
+def process_child_folder_and_unzip_async(path, image_workers=0):
+    """
+    Asynchronously unzips all child folders within a specified path.
+
+    Args:
+        path: Path containing child folders to be unzipped.
+        image_workers: Processes of a separate redaction stage fed through shared memory, or 0 to
+            redact each zip's images inside its unzip worker.
+
+    Returns:
+        dict: Pipeline summary as returned by run_pipeline.
+    """
+    def zip_files():
+        for root, dirs, files in os.walk(path):
+            for file in files:
+                if file.endswith('.zip'):
+                    yield None, os.path.join(root, file)
+
+    # Zips are handed out one at a time so that large panelists don't hold up a whole wave of folders;
+    # with image workers, the images themselves are spread over the redaction processes
+    stages = [{"name": "unzip", "workers": max(1, multiprocessing.cpu_count() - image_workers),
+               "target": functools.partial(unzip_panelist_zip, query_id=path, share_images=bool(image_workers))}]
+    if image_workers:
+        stages.append(redact_stage(image_workers))
+    return run_pipeline(zip_files(), stages, initializer=query_worker_initializer())
+
+
+def process_child_folders_csvs(path):
+    """
+    Gathers CSV files from child folders within a given directory.
+
+    Args:
+        path (str): The path to the parent directory.
+
+    Returns:
+        dict: A mapping of child folder names to lists of their CSV files.
+    """
+    result_dict = {}
+
+    for root, dirs, _ in os.walk(path):
+        for dir_name in dirs:
+            child_folder = os.path.join(root, dir_name)
+            child_files = [os.path.join(child_folder, file) for file in os.listdir(child_folder) if
+                           file.endswith('.csv')]
+
+            # Include folder only if it contains CSV files
+            if child_files:
+                result_dict[dir_name] = child_files
+
+    return result_dict
+
+
+def delete_folder(folder_path):
+    """
+    Deletes a folder and all its contents.
+
+    Args:
+        folder_path (str): The path to the folder to be deleted.
+    """
+    try:
+        # Remove the folder and all its contents
+        shutil.rmtree(folder_path)
+        logging.info(f"Successfully deleted the folder: {folder_path}")
+    except FileNotFoundError:
+        logging.warning(f"The folder {folder_path} does not exist.")
+    except Exception as e:
+        logging.error(f"Could not delete {folder_path}: {e}")
+
+def finalize_query_outputs(query_config):
+    """
+    Finishes the outputs of a query whose consolidated CSVs are complete: sorts them if requested,
+    writes the columnar outputs and uploads everything to the output sink.
+
+    Args:
+        query_config: The query configuration.
+    """
+    query_id = query_config["queryId"]
+    if query_config.get("sortOutputs"):
+        sort_outputs(query_id, query_config.get("dedupeKey"))
+    if query_config.get("outputFormat", "csv") != "csv":
+        try:
+            write_columnar_outputs(query_id, query_config["outputFormat"])
+        except (ImportError, ValueError) as e:
+            # The consolidated CSVs are complete either way; the conversion can be rerun on its own
+            logging.error(f"Could not write {query_config['outputFormat']} outputs: {e}")
+    write_catalog(query_id)
+    upload_outputs(query_id)
+
+
+def failed_stage_items(summary):
+    """
+    Returns:
+        dict: Number of failed items per stage of a pipeline summary, for the stages with failures.
+    """
+    return {name: figures["failed"] for name, figures in (summary or {}).items()
+            if isinstance(figures, dict) and figures.get("failed")}
+
+
+def run_query(query_config, s3=None, metrics_path=None, objects=None, finalize=True):
+    """
+    Runs (or resumes) a query to completion and records its status in query_config.json.
+
+    Args:
+        query_config: The query configuration.
+        s3: Boto3 S3 client used for listing; a default client is created if omitted.
+        metrics_path: .jsonl or .prom file to export metrics to (default: query_id/metrics.jsonl).
+        objects: S3 objects to process instead of listing the query's path, e.g. those of a shard.
+        finalize: Sort, convert and upload the consolidated outputs at the end (see
+            finalize_query_outputs); shards of a distributed query leave that to the reduce step.
+
+    Raises:
+        RuntimeError: If items failed in a pipeline stage. The query is then saved as 'partial' and
+            keeps its downloaded zips; resuming it retries the objects that weren't consolidated.
+    """
+    if s3 is None:
+        s3 = create_s3_client()
+
+    query_id, streaming = query_config["queryId"], query_config["streaming"]
+    bucket_name, path = query_config["bucketName"], query_config["path"]
+    start_date = datetime.fromisoformat(query_config["startDate"])
+    end_date = datetime.fromisoformat(query_config["endDate"])
+    download_settings = {"concurrency": query_config["downloadConcurrency"],
+                         "max_bandwidth": query_config["maxBandwidth"]}
+    detection_settings = query_detection_settings(query_config)
+    if detection_settings["backend"] == "none":
+        logging.warning(f"Face detection is disabled for query {query_id}: images are saved without redaction.")
+
+    lock = lock_query(query_id)
+
+    # Spot-instance interruptions arrive as SIGTERM: stop cleanly so the checkpoint is written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+    metrics_path = metrics_path or os.path.join(query_id, "metrics.jsonl")
+    init_metrics()
+    configure_output_sink(query_config.get("outputUri"))
+    configure_encoder(query_encode_settings(query_config))
+
+    autotuner = None
+    if query_config.get("autotune"):
+        tuned = load_tuned_settings() or {}
+        if tuned:
+            logging.info(f"Autotune: starting from the settings of the last tuned run on {machine_profile()}: {tuned}")
+        autotuner = Autotuner(tuned.get("downloadConcurrency", query_config["downloadConcurrency"]),
+                              tuned.get("batchSize", query_config["batchSize"]),
+                              tuned.get("imageWorkers") or query_config.get("imageWorkers") or None,
+                              memory_limit=query_config.get("memoryLimit"))
+
+    query_config["status"] = "running"
+    query_config["numFilesToDownload"] = 0
+    save_query_config(query_config)
+    summary = None
+    try:
+        if objects is None:
+            objects = query_s3_objects_in_date_range(s3, bucket_name, path, start_date, end_date,
+                                                     query_config.get("dateLevels"))
+        summary = run_query_pipeline(bucket_name, objects, query_config["batchSize"], query_config["numProcessors"],
+                                     query_id, streaming, download_settings=download_settings,
+                                     query_config=query_config, detection_settings=detection_settings,
+                                     image_workers=query_config.get("imageWorkers", 0), metrics_path=metrics_path,
+                                     memory_limit=query_config.get("memoryLimit"),
+                                     member_filter=MemberFilter.parse(query_config.get("members")),
+                                     autotuner=autotuner)
+        if autotuner is not None:
+            query_config["tunedSettings"] = autotuner.tuned()
+            save_tuned_settings(query_config["tunedSettings"])
+            logging.info(f"Autotune: finished with {query_config['tunedSettings']}, saved for later runs on "
+                         f"{machine_profile()}")
+    except BaseException:
+        query_config["status"] = "interrupted"
+        save_query_config(query_config)
+        logging.error(f"Query {query_id} was interrupted; enter its ID on the next run to resume it.")
+        raise
+    finally:
+        record = metrics_snapshot(query_id, summary, final=True)
+        export_metrics(metrics_path, record)
+        log_metrics_summary(record)
+
+    if finalize:
+        try:
+            finalize_query_outputs(query_config)
+        except Exception:
+            query_config["status"] = "interrupted"
+            save_query_config(query_config)
+            raise
+
+    failed = failed_stage_items(summary)
+    query_config["status"] = "partial" if failed else "completed"
+    save_query_config(query_config)
+    lock.close()
+    if failed:
+        counts = ", ".join(f"{name}: {count}" for name, count in failed.items())
+        logging.error(f"Query {query_id} finished with {sum(failed.values())} failed items ({counts}); "
+                      f"resume it to retry them.")
+        raise RuntimeError(f"{sum(failed.values())} items failed ({counts})")
+    if streaming:
+        return
+
+    delete_folder(os.path.join(query_id, "unzipped"))
+    delete_folder(os.path.join(query_id, "zipped"))
@@ -0,0 +1,269 @@
+import fcntl
+import json
+import logging
+import os
+import uuid
+from datetime import datetime
+
+from members import MemberFilter
+from outputs import COLUMNAR_FORMATS
+from redact import DETECTION_SETTINGS, ENCODE_SETTINGS, detection_settings_from, encode_settings_from
+from s3io import parse_s3_uri
+
+
+# Query configurations
+# query_id/query_config.json holds a query's settings and its progress, so that an interrupted or finished
+# query can be resumed or rerun from it.
+
+def new_query_id():
+    """
+    Generates a unique query ID, so that concurrent or repeated queries never share a folder.
+    """
+    return f"query_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+
+
+def save_query_config(query_config):
+    """
+    Atomically writes a query configuration to query_id/query_config.json. The file is written to a
+    temporary name and renamed, so a crash never leaves a truncated checkpoint behind.
+
+    Args:
+        query_config: The query configuration.
+    """
+    config_path = os.path.join(query_config["queryId"], "query_config.json")
+    temp_path = config_path + ".tmp"
+    with open(temp_path, "w") as config_file:
+        json.dump(query_config, config_file, indent=2)
+        config_file.flush()
+        os.fsync(config_file.fileno())
+    os.replace(temp_path, config_path)
+
+
+def load_query_config(query_id):
+    """
+    Loads the configuration of an existing query.
+
+    Args:
+        query_id: Unique identifier for the query/download session.
+
+    Returns:
+        dict: The query configuration.
+    """
+    config_path = os.path.join(query_id, "query_config.json")
+    if not os.path.exists(config_path):
+        raise ValueError(f"No query configuration found at '{config_path}'")
+    with open(config_path) as config_file:
+        return json.load(config_file)
+
+
+def lock_query(query_id):
+    """
+    Takes an exclusive lock on a query folder so that two runs never work on the same query at once.
+
+    Args:
+        query_id: Unique identifier for the query/download session.
+
+    Returns:
+        The open lock file; the lock is held until it is closed or the process exits.
+    """
+    os.makedirs(query_id, exist_ok=True)
+    lock_file = open(os.path.join(query_id, ".lock"), "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        raise RuntimeError(f"Query '{query_id}' is already being processed by another run.")
+    return lock_file
+
+
+def rerun_query_config(query_id, end_date=None):
+    """
+    Loads an existing query and moves its end date forward, so that running it again picks up the
+    objects uploaded since. Its manifest skips everything already consolidated, and new rows are
+    appended to the existing outputs.
+
+    Args:
+        query_id: Unique identifier for the query/download session.
+        end_date: New end of the date range as datetime (default: now).
+
+    Returns:
+        dict: The query configuration, also saved to query_config.json.
+    """
+    query_config = load_query_config(query_id)
+    end_date = end_date or datetime.now()
+    if end_date < datetime.fromisoformat(query_config["endDate"]):
+        raise ValueError(f"Query '{query_id}' already ends on {query_config['endDate']}, after {end_date.isoformat()}")
+
+    query_config["endDate"] = end_date.isoformat()
+    save_query_config(query_config)
+    logging.info(f"Rerunning query {query_id} up to {query_config['endDate']}.")
+    return query_config
+
+
+def resume_query_from_user():
+    """
+    Asks for the ID of an interrupted or earlier query to resume. A completed query is rerun up to
+    now (see rerun_query_config).
+
+    Returns:
+        dict: The configuration of the query to resume, or None to start a new query.
+    """
+    query_id = input("Enter a query ID to resume (press Enter to start a new query): ").strip()
+    if not query_id:
+        return None
+    query_config = load_query_config(query_id)
+    if query_config["status"] == "completed":
+        return rerun_query_config(query_id)
+    return query_config
+
+
+# Defaults of the per-query settings, shared by the prompts and the command line
+QUERY_DEFAULTS = {
+    "batchSize": 25,
+    "numProcessors": 4,
+    "downloadConcurrency": 8,
+    "maxBandwidth": None,  # Bytes per second across all processes
+    "streaming": False,
+    "outputFormat": "csv",
+    "detectionMode": "full",
+    "detectionScale": 0.5,
+    "detector": "haar",  # Face detector backend (see DETECTOR_BACKENDS)
+    "detectorModel": None,  # Model file of the ssd and yunet detectors
+    "detectorConfig": None,  # deploy.prototxt of the ssd detector
+    "detectorThreads": None,  # OpenCV threads per worker process; None keeps OpenCV's default
+    "redactionCacheSize": 0,  # Frames per panelist whose face boxes identical frames reuse; 0 disables the cache
+    "imageFormat": "source",  # Format of saved images: 'source' keeps each image's own, or jpeg/png/webp
+    "imageQuality": 95,  # JPEG and WebP quality of re-encoded images
+    "turbojpeg": False,  # Encode JPEGs with PyTurboJPEG (libjpeg-turbo)
+    "imageWorkers": 0,  # Processes of the shared-memory redaction stage; 0 redacts inside the unzip workers
+    "outputUri": None,  # s3://bucket/prefix to upload redacted images and consolidated outputs to
+    "memoryLimit": None,  # Bytes the pipeline's processes may hold before upstream stages pause
+    "members": None,  # Member filter expression, e.g. "type:csv prefix:session_data" (see MemberFilter)
+    "sortOutputs": False,  # Sort consolidated CSVs by capture time and drop duplicate rows (see sort_outputs)
+    "dedupeKey": None,  # Columns identifying duplicate rows besides the capture time; None compares whole rows
+    "shardBy": "panelist",  # Shards of a distributed query: one per panelist, or 'hash' for numShards by key hash
+    "numShards": 16,
+    "dateLevels": None,  # Folder levels below the path that are date partitions, e.g. [2]; None prunes nothing
+    "autotune": False,  # Adjust download concurrency, batch size and image workers while the query runs
+}
+
+
+def query_detection_settings(query_config):
+    """
+    Returns the detection settings (overrides for DETECTION_SETTINGS) of a query configuration.
+    """
+    return {"mode": query_config.get("detectionMode", "full"),
+            "scale": query_config.get("detectionScale", DETECTION_SETTINGS["scale"]),
+            "backend": query_config.get("detector", "haar"),
+            "model": query_config.get("detectorModel"),
+            "config": query_config.get("detectorConfig"),
+            "threads": query_config.get("detectorThreads"),
+            "cache_size": query_config.get("redactionCacheSize", DETECTION_SETTINGS["cache_size"])}
+
+
+def query_encode_settings(query_config):
+    """
+    Returns the encode settings (overrides for ENCODE_SETTINGS) of a query configuration.
+    """
+    return {"format": query_config.get("imageFormat", "source"),
+            "quality": query_config.get("imageQuality", ENCODE_SETTINGS["quality"]),
+            "turbojpeg": query_config.get("turbojpeg", False)}
+
+
+def new_query_config(bucket_name, path, start_date, end_date, settings=None):
+    """
+    Creates a query: validates its settings, generates a query ID, prepares the directory structure
+    and saves the configuration to query_config.json.
+
+    Args:
+        bucket_name: Name of the S3 bucket.
+        path: Path within the S3 bucket.
+        start_date: Start of the date range as datetime.
+        end_date: End of the date range as datetime.
+        settings: Overrides for QUERY_DEFAULTS.
+
+    Returns:
+        dict: The query configuration.
+    """
+    settings = dict(QUERY_DEFAULTS, **(settings or {}))
+    unknown = set(settings) - set(QUERY_DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown query settings: {', '.join(sorted(unknown))}")
+    if settings["outputFormat"] not in ('csv',) + tuple(COLUMNAR_FORMATS):
+        raise ValueError(f"Unknown output format: {settings['outputFormat']}")
+    detection_settings_from(query_detection_settings(settings))
+    encode_settings_from(query_encode_settings(settings))
+    if settings["outputUri"]:
+        parse_s3_uri(settings["outputUri"])
+    MemberFilter.parse(settings["members"])
+    if settings["shardBy"] not in ("panelist", "hash") or settings["numShards"] < 1:
+        raise ValueError(f"Invalid sharding: {settings['shardBy']} into {settings['numShards']} shards")
+    if settings["dateLevels"] is not None and not all(isinstance(level, int) and level > 0
+                                                      for level in settings["dateLevels"]):
+        raise ValueError(f"dateLevels must be a list of folder levels from 1: {settings['dateLevels']}")
+    if settings["dedupeKey"] is not None and not isinstance(settings["dedupeKey"], list):
+        raise ValueError(f"dedupeKey must be a list of column names: {settings['dedupeKey']}")
+
+    # Generate a unique query ID for each session to avoid conflicts
+    query_id = new_query_id()
+
+    # Configuration dictionary for the query
+    query_config = {
+        "queryId": query_id,
+        "bucketName": bucket_name,
+        "path": path,
+        "startDate": start_date.isoformat() if start_date else None,
+        "endDate": end_date.isoformat() if end_date else None,
+        **settings,
+        "numFilesToDownload": 0,  # Initial setup, no files to download yet
+        "numFilesDownloaded": 0,  # Tracker for downloaded files
+        "numFilesConsolidated": 0,  # Tracker for files whose CSVs reached the consolidated outputs
+        "lastBatchBeginId": "",   # First key of the latest batch handed to the pipeline
+        "status": "created",
+    }
+
+    # Prepare directories for zipped and unzipped files (streaming runs never stage on disk)
+    directories = {"base": query_id}
+    if not settings["streaming"]:
+        directories["zipped"] = os.path.join(query_id, "zipped")
+        directories["unzipped"] = os.path.join(query_id, "unzipped")
+
+    # Create the directories if they don't exist
+    for directory in directories.values():
+        os.makedirs(directory, exist_ok=True)
+
+    # Save the query configuration to a JSON file
+    save_query_config(query_config)
+
+    logging.info(f"Configuration saved to {os.path.join(query_id, 'query_config.json')}.")
+    return query_config
+
+
+# Step 4: Set batch and processor parameters
+def set_batch_and_processors(bucket_name=None, path=None, start_date=None, end_date=None):
+    """
+    Prompts for the batch size for zip file downloads and the number of processors to use, then creates
+    the query (see new_query_config). The other per-query settings keep their QUERY_DEFAULTS; use the
+    command line (see parse_args) to change them.
+
+    Args:
+        bucket_name: Name of the S3 bucket, recorded so the query can be resumed.
+        path: Path within the S3 bucket, recorded so the query can be resumed.
+        start_date: Start of the date range as datetime, recorded so the query can be resumed.
+        end_date: End of the date range as datetime, recorded so the query can be resumed.
+
+    Returns:
+        dict: The query configuration, also saved to query_config.json.
+    """
+    # Prompt the user for batch size and number of processors with default values
+    try:
+        zip_batch_size = int(input(f"Enter the batch size for zip file downloads "
+                                   f"(default: {QUERY_DEFAULTS['batchSize']}): ") or QUERY_DEFAULTS['batchSize'])
+        num_processors = int(input(f"Enter the number of processors (default: {QUERY_DEFAULTS['numProcessors']}): ")
+                             or QUERY_DEFAULTS['numProcessors'])
+    except ValueError as e:
+        logging.error("Invalid input, please enter a number.")
+        raise e
+
+    return new_query_config(bucket_name, path, start_date, end_date,
+                            {"batchSize": zip_batch_size, "numProcessors": num_processors})
@@ -0,0 +1,857 @@
+import collections
+import functools
+import hashlib
+import logging
+import multiprocessing
+import os
+
+from members import member_kind, select_members
+from metrics import count_metric, metric_span
+from s3io import get_output_sink, output_exists
+
+
+# Image encoding
+# Redacted images are re-encoded in the configured format and quality. Images in which nothing was
+# redacted are copied byte for byte from their zip member when the output format matches theirs, which
+# skips the encode and its generation loss for the majority of screenshots, which show no face. JPEGs can
+# be encoded with libjpeg-turbo through PyTurboJPEG.
+
+# Default encode settings; entries can be overridden per run
+ENCODE_SETTINGS = {
+    "format": "source",   # 'source' keeps each image's own format, or 'jpeg', 'png' or 'webp'
+    "quality": 95,        # JPEG and WebP quality of re-encoded images
+    "turbojpeg": False,   # Encode JPEGs with PyTurboJPEG (libjpeg-turbo) instead of OpenCV
+    "passthrough": True,  # Copy images without detections unchanged when their format matches the output's
+}
+
+# Image formats by file extension, and the extension written for each format
+IMAGE_FORMATS = {'.jpg': 'jpeg', '.jpeg': 'jpeg', '.png': 'png', '.webp': 'webp'}
+FORMAT_EXTENSIONS = {'jpeg': '.jpg', 'png': '.png', 'webp': '.webp'}
+
+# Encode settings of the current query, passed to the pipeline's worker processes
+_encode_settings = dict(ENCODE_SETTINGS)
+
+# PyTurboJPEG encoder of this process, created on first use; False if the library can't be loaded
+_turbojpeg = None
+
+
+def encode_settings_from(overrides=None):
+    """
+    Merges encode setting overrides into ENCODE_SETTINGS.
+
+    Args:
+        overrides: Dictionary of settings to override, or None.
+
+    Returns:
+        dict: The complete encode settings.
+    """
+    settings = dict(ENCODE_SETTINGS, **(overrides or {}))
+    if settings["format"] != "source" and settings["format"] not in FORMAT_EXTENSIONS:
+        raise ValueError(f"Unknown image format: {settings['format']}")
+    if not 0 <= settings["quality"] <= 100:
+        raise ValueError(f"Image quality must be in [0, 100], got {settings['quality']}")
+    return settings
+
+
+def configure_encoder(settings=None):
+    """
+    Sets the encode settings of the following pipeline runs. Called before the pipeline starts, so that
+    its worker processes receive them (see query_worker_initializer).
+
+    Args:
+        settings: Overrides for ENCODE_SETTINGS.
+    """
+    global _encode_settings
+    _encode_settings = encode_settings_from(settings)
+
+
+def encoder_settings():
+    """
+    Returns:
+        dict: The encode settings of this process (see configure_encoder).
+    """
+    return _encode_settings
+
+
+def image_output_path(path):
+    """
+    Returns the output path of an image, with the extension of the configured output format.
+    """
+    if _encode_settings["format"] == "source":
+        return path
+    return os.path.splitext(path)[0] + FORMAT_EXTENSIONS[_encode_settings["format"]]
+
+
+def sniff_image_format(data):
+    """
+    Returns the format of encoded image bytes ('jpeg', 'png' or 'webp') from their signature, or None.
+    """
+    if data[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def _get_turbojpeg():
+    global _turbojpeg
+    if _turbojpeg is None:
+        try:
+            from turbojpeg import TurboJPEG
+            _turbojpeg = TurboJPEG()
+        except (ImportError, OSError, RuntimeError) as e:
+            logging.warning(f"PyTurboJPEG is not available ({e}); encoding JPEGs with OpenCV.")
+            _turbojpeg = False
+    return _turbojpeg
+
+
+def encode_image(image, output_image_path):
+    """
+    Encodes an image in the format of its output path's extension, with the configured quality.
+
+    Args:
+        image: The BGR image array.
+        output_image_path: Path the image is saved to.
+
+    Returns:
+        bytes: The encoded image, or None if it couldn't be encoded.
+    """
+    import cv2
+
+    extension = os.path.splitext(output_image_path)[1].lower() or '.jpg'
+    image_format, quality = IMAGE_FORMATS.get(extension), _encode_settings["quality"]
+    params = []
+    if image_format == 'jpeg':
+        if _encode_settings["turbojpeg"] and _get_turbojpeg():
+            return _get_turbojpeg().encode(image, quality=quality)
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    elif image_format == 'webp':
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    ok, encoded = cv2.imencode(extension, image, params)
+    return encoded.tobytes() if ok else None
+
+
+def save_image(output_image_path, image, original=None):
+    """
+    Encodes a redacted image and writes it to its output path, or uploads it to the output sink.
+
+    Args:
+        output_image_path: Path the image is saved to.
+        image: The BGR image array.
+        original: The image's encoded bytes if nothing was redacted in it. They are saved unchanged
+            if their format matches the output path's (see ENCODE_SETTINGS).
+
+    Returns:
+        bool: Whether the image was saved.
+    """
+    data = None
+    if original is not None and _encode_settings["passthrough"]:
+        extension = os.path.splitext(output_image_path)[1].lower()
+        if sniff_image_format(original) == IMAGE_FORMATS.get(extension):
+            data = original
+            count_metric("images_copied")
+    if data is None:
+        with metric_span("encode"):
+            data = encode_image(image, output_image_path)
+        if data is None:
+            return False
+
+    sink = get_output_sink()
+    if sink is not None:
+        sink.put(output_image_path, bytes(data))
+        return True
+    os.makedirs(os.path.dirname(output_image_path), exist_ok=True)
+    with open(output_image_path, 'wb') as f:
+        f.write(data)
+    return True
+
+
+# Face detection
+# Detection dominates the per-image cost. Detectors are pluggable backends (see DETECTOR_BACKENDS) that
+# each worker loads once and runs on batches of images: the Haar cascade, OpenCV's DNN SSD or YuNet face
+# models, or 'none' to skip detection. In 'fast' mode the detector runs on downscaled copies and the
+# boxes are mapped back to full resolution, which trades a little recall on the smallest faces for speed.
+
+# Default detection settings; entries can be overridden per run. min_size is in full-resolution pixels.
+DETECTION_SETTINGS = {
+    "mode": "full",       # 'full' or 'fast'
+    "scale": 0.5,         # Downscale factor of the fast detection pass
+    "backend": "haar",    # Key of DETECTOR_BACKENDS
+    "model": None,        # Model file of the 'ssd' (.caffemodel) and 'yunet' (.onnx) backends
+    "config": None,       # Network description of the 'ssd' backend (deploy.prototxt)
+    "threads": None,      # OpenCV threads per worker process (None: OpenCV's default)
+    "confidence": 0.5,    # Minimum score of a DNN detection
+    "input_size": 300,    # Side of the square blob the SSD model runs on
+    "scale_factor": 1.1,  # Cascade pyramid step
+    "min_neighbors": 5,
+    "min_size": 30,
+    "batch_size": 16,     # Images decoded and redacted together by a worker
+    "cache_size": 0,      # Recent frames whose face boxes are kept per panelist (0 disables the cache)
+}
+
+# Detectors of this process keyed by (backend, model, config), loaded on first use by get_detector
+_face_detectors = {}
+
+
+def detection_settings_from(overrides=None):
+    """
+    Merges detection setting overrides into DETECTION_SETTINGS.
+
+    Args:
+        overrides: Dictionary of settings to override, or None.
+
+    Returns:
+        dict: The complete detection settings.
+    """
+    settings = dict(DETECTION_SETTINGS, **(overrides or {}))
+    if settings["mode"] not in ("full", "fast"):
+        raise ValueError(f"Unknown detection mode: {settings['mode']}")
+    if not 0 < settings["scale"] <= 1:
+        raise ValueError(f"Detection scale must be in (0, 1], got {settings['scale']}")
+    if settings["backend"] not in DETECTOR_BACKENDS:
+        raise ValueError(f"Unknown detector backend: {settings['backend']}")
+    if settings["backend"] in ("ssd", "yunet") and not settings["model"]:
+        raise ValueError(f"The {settings['backend']} detector needs a model file (detection setting 'model')")
+    if settings["backend"] == "ssd" and not settings["config"]:
+        raise ValueError("The ssd detector needs its deploy.prototxt (detection setting 'config')")
+    return settings
+
+
+class FaceDetector:
+    """
+    Base class of the face detector backends. A backend is loaded once per process by get_detector and
+    detects faces in batches of images.
+
+    Args:
+        settings: The complete detection settings.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    def detect(self, images, scale=1.0):
+        """
+        Detects faces in a batch of images.
+
+        Args:
+            images: List of BGR image arrays, all downscaled by scale.
+            scale: Downscale factor of the images, for size limits given in full-resolution pixels.
+
+        Returns:
+            list: Face boxes as (x, y, w, h) in the pixels of the images passed in, per image.
+        """
+        raise NotImplementedError
+
+
+class HaarDetector(FaceDetector):
+    """
+    OpenCV's frontal face Haar cascade. Cascades run on one image at a time, so a batch is a loop.
+    """
+
+    def __init__(self, settings):
+        import cv2
+
+        super().__init__(settings)
+        self.cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+
+    def detect(self, images, scale=1.0):
+        import cv2
+
+        min_size = max(1, round(self.settings["min_size"] * scale))
+        results = []
+        for image in images:
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            faces = self.cascade.detectMultiScale(gray, scaleFactor=self.settings["scale_factor"],
+                                                  minNeighbors=self.settings["min_neighbors"],
+                                                  minSize=(min_size, min_size))
+            results.append([tuple(int(v) for v in face) for face in faces])
+        return results
+
+
+class SsdDetector(FaceDetector):
+    """
+    OpenCV's ResNet-10 SSD face model (res10_300x300_ssd_iter_140000.caffemodel with its deploy.prototxt),
+    run on the CPU. A whole batch goes through the network as one blob.
+    """
+
+    # Mean BGR values subtracted from the input the model was trained with
+    MEAN = (104.0, 177.0, 123.0)
+
+    def __init__(self, settings):
+        import cv2
+
+        super().__init__(settings)
+        self.net = cv2.dnn.readNet(settings["model"], settings["config"])
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+
+    def detect(self, images, scale=1.0):
+        import cv2
+
+        size = self.settings["input_size"]
+        blob = cv2.dnn.blobFromImages(images, 1.0, (size, size), self.MEAN, swapRB=False, crop=False)
+        self.net.setInput(blob)
+        # One row per detection: image index in the batch, class, score and the box in relative coordinates
+        detections = self.net.forward().reshape(-1, 7)
+
+        results = [[] for _ in images]
+        for index, _, score, x1, y1, x2, y2 in detections:
+            if score < self.settings["confidence"] or not 0 <= index < len(images):
+                continue
+            height, width = images[int(index)].shape[:2]
+            left, top = max(0, int(x1 * width)), max(0, int(y1 * height))
+            right, bottom = min(width, int(x2 * width + 1)), min(height, int(y2 * height + 1))
+            if right > left and bottom > top:
+                results[int(index)].append((left, top, right - left, bottom - top))
+        return results
+
+
+class YuNetDetector(FaceDetector):
+    """
+    OpenCV's YuNet face model (face_detection_yunet_*.onnx) through cv2.FaceDetectorYN, run on the CPU.
+    FaceDetectorYN decodes one image at a time, so a batch is a loop.
+    """
+
+    def __init__(self, settings):
+        import cv2
+
+        super().__init__(settings)
+        self.model = cv2.FaceDetectorYN.create(settings["model"], "", (320, 320), settings["confidence"])
+
+    def detect(self, images, scale=1.0):
+        results = []
+        for image in images:
+            height, width = image.shape[:2]
+            self.model.setInputSize((width, height))
+            _, faces = self.model.detect(image)
+            boxes = []
+            # Rows are the box, five landmarks and the score
+            for x, y, w, h in (faces[:, :4] if faces is not None else []):
+                left, top = max(0, int(x)), max(0, int(y))
+                right, bottom = min(width, int(x + w + 1)), min(height, int(y + h + 1))
+                if right > left and bottom > top:
+                    boxes.append((left, top, right - left, bottom - top))
+            results.append(boxes)
+        return results
+
+
+class NoopDetector(FaceDetector):
+    """
+    Finds no faces, for studies whose screenshots need no redaction.
+    """
+
+    def detect(self, images, scale=1.0):
+        return [[] for _ in images]
+
+
+# Face detector backends by name
+DETECTOR_BACKENDS = {
+    "haar": HaarDetector,
+    "ssd": SsdDetector,
+    "yunet": YuNetDetector,
+    "none": NoopDetector,
+}
+
+
+def get_detector(detection_settings=None):
+    """
+    Returns this process's detector for the given settings, loading it on first use. Loading also
+    applies the 'threads' setting to OpenCV in this process.
+
+    Args:
+        detection_settings: Overrides for DETECTION_SETTINGS.
+    """
+    settings = detection_settings_from(detection_settings)
+    key = (settings["backend"], settings["model"], settings["config"])
+    detector = _face_detectors.get(key)
+    if detector is None:
+        if settings["threads"] is not None:
+            import cv2
+            cv2.setNumThreads(settings["threads"])
+        detector = _face_detectors[key] = DETECTOR_BACKENDS[settings["backend"]](settings)
+    detector.settings = settings
+    return detector
+
+
+def detect_faces_batch(images, detection_settings=None):
+    """
+    Detects faces in a batch of decoded images.
+
+    Args:
+        images: List of BGR image arrays.
+        detection_settings: Overrides for DETECTION_SETTINGS.
+
+    Returns:
+        list: Face bounding boxes as (x, y, w, h) in full-resolution pixels, per image.
+    """
+    import cv2
+    import numpy as np
+
+    settings = detection_settings_from(detection_settings)
+    detector = get_detector(settings)
+    scale = settings["scale"] if settings["mode"] == "fast" else 1.0
+    if scale == 1.0:
+        return detector.detect(images)
+
+    small = [cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) for image in images]
+    results = []
+    for image, faces in zip(images, detector.detect(small, scale)):
+        # Map back outwards so that the rounding of the downscaled box never leaves part of a face uncovered
+        height, width = image.shape[:2]
+        boxes = []
+        for (x, y, w, h) in faces:
+            left, top = int(x / scale), int(y / scale)
+            right, bottom = min(width, int(np.ceil((x + w) / scale))), min(height, int(np.ceil((y + h) / scale)))
+            boxes.append((left, top, right - left, bottom - top))
+        results.append(boxes)
+    return results
+
+
+def detect_faces(image, detection_settings=None):
+    """
+    Detects faces in a decoded image.
+
+    Args:
+        image: The BGR image array.
+        detection_settings: Overrides for DETECTION_SETTINGS.
+
+    Returns:
+        list: Face bounding boxes as (x, y, w, h) in full-resolution pixels.
+    """
+    return detect_faces_batch([image], detection_settings)[0]
+
+
+def content_hash(image):
+    """
+    Hashes an image's pixels. Only frames with exactly the same pixels share a hash: any change, such
+    as a face appearing on an otherwise unchanged screen, gives a different one.
+
+    Args:
+        image: The image array.
+
+    Returns:
+        bytes: BLAKE2b digest of the image's shape and pixels.
+    """
+    digest = hashlib.blake2b(repr(image.shape).encode(), digest_size=16)
+    digest.update(memoryview(image).cast('B') if image.flags.c_contiguous else image.tobytes())
+    return digest.digest()
+
+
+class FaceBoxCache:
+    """
+    LRU cache of the face boxes of a panelist's recent frames, keyed by content hash. A frame with
+    exactly the same pixels as a cached frame reuses its boxes instead of running the detector again.
+
+    Args:
+        max_entries: Number of frames to keep.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, image_hash):
+        """
+        Returns the face boxes of the cached frame with this hash, or None on a miss.
+        """
+        faces = self.entries.get(image_hash)
+        if faces is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(image_hash)
+        return faces
+
+    def store(self, image_hash, faces):
+        """
+        Records the face boxes detected in a frame, evicting the least recently used frame if full.
+        """
+        self.entries[image_hash] = faces
+        self.entries.move_to_end(image_hash)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+# Per-process face box caches keyed by panelist, least recently used first
+_redaction_caches = collections.OrderedDict()
+
+# Panelists whose caches a process keeps
+_MAX_CACHED_PANELISTS = 64
+
+
+def redaction_cache(panelist, detection_settings=None):
+    """
+    Returns this process's face box cache for a panelist, or None if caching is disabled.
+
+    Args:
+        panelist: Panelist folder name; frames are only matched against the same panelist's frames.
+        detection_settings: Overrides for DETECTION_SETTINGS.
+    """
+    settings = detection_settings_from(detection_settings)
+    if not settings["cache_size"]:
+        return None
+
+    cache = _redaction_caches.get(panelist)
+    if cache is None:
+        cache = _redaction_caches[panelist] = FaceBoxCache(settings["cache_size"])
+        while len(_redaction_caches) > _MAX_CACHED_PANELISTS:
+            _redaction_caches.popitem(last=False)
+    _redaction_caches.move_to_end(panelist)
+    return cache
+
+
+def redaction_cache_stats():
+    """
+    Returns:
+        dict: Cache hits and misses summed over this process's panelist caches.
+    """
+    return {"hits": sum(cache.hits for cache in _redaction_caches.values()),
+            "misses": sum(cache.misses for cache in _redaction_caches.values())}
+
+
+def redact_image_batch(items, redaction_type='redact', detection_settings=None, cache=None):
+    """
+    Decodes, redacts and saves a batch of images (see save_image).
+
+    Args:
+        items: (source, output_image_path) tuples, where source is the encoded image as bytes or the
+            path of an image file.
+        redaction_type (str): The type of processing ('redact' or 'blur') to apply to detected faces.
+        detection_settings: Overrides for DETECTION_SETTINGS.
+        cache: FaceBoxCache of the images' panelist, or None to run the detector on every image.
+
+    Returns:
+        list: The detected face bounding boxes of each image.
+    """
+    import cv2
+    import numpy as np
+
+    settings = detection_settings_from(detection_settings)
+    images, originals = [], []
+    for source, output_image_path in items:
+        if not isinstance(source, (bytes, bytearray, memoryview)):
+            with open(source, 'rb') as f:
+                source = f.read()
+        with metric_span("decode"):
+            image = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError(f"Could not decode image for {output_image_path}")
+        images.append(image)
+        originals.append(source)
+
+    detected = []
+    results = detect_image_faces(images, settings, cache, detected)
+    for image, original, faces, ran, (_, output_image_path) in zip(images, originals, results, detected, items):
+        apply_redaction(image, faces, redaction_type)
+        # Only a detector result clears an image for passthrough, never boxes reused from the cache
+        if not save_image(output_image_path, image, original if ran and not faces else None):
+            raise ValueError(f"Could not save {output_image_path}")
+        count_metric("images")
+    return results
+
+
+def detect_and_redact_faces(input_image_path, output_image_path, redaction_type='redact', detection_settings=None):
+    """
+    Detects faces in an image and applies redaction or blurring.
+
+    Args:
+        input_image_path (str): Path to the input image.
+        output_image_path (str): Path where the processed image will be saved.
+        redaction_type (str): The type of processing ('redact' or 'blur') to apply to detected faces.
+        detection_settings: Overrides for DETECTION_SETTINGS.
+    """
+    redact_image_batch([(input_image_path, output_image_path)], redaction_type, detection_settings)
+
+
+def redact_image_bytes(image_bytes, output_image_path, redaction_type='redact', detection_settings=None):
+    """
+    Decodes an encoded image from memory, redacts detected faces and saves the result.
+
+    Args:
+        image_bytes (bytes): Encoded JPEG image.
+        output_image_path (str): Path where the processed image will be saved.
+        redaction_type (str): The type of processing ('redact' or 'blur') to apply to detected faces.
+        detection_settings: Overrides for DETECTION_SETTINGS.
+    """
+    redact_image_batch([(image_bytes, output_image_path)], redaction_type, detection_settings)
+
+
+def redact_image(image, redaction_type='redact', detection_settings=None, cache=None, detected=None):
+    """
+    Detects faces in a decoded image and redacts or blurs them in place.
+
+    Args:
+        image: The image array.
+        redaction_type (str): The type of processing ('redact' or 'blur') to apply to detected faces.
+        detection_settings: Overrides for DETECTION_SETTINGS.
+        cache: FaceBoxCache to reuse the boxes of an identical recent frame from, or None.
+        detected: List to append whether the detector ran on the image to (see detect_image_faces).
+
+    Returns:
+        Detected face bounding boxes as (x, y, w, h).
+    """
+    faces = detect_image_faces([image], detection_settings, cache, detected)[0]
+    apply_redaction(image, faces, redaction_type)
+    return faces
+
+
+def detect_image_faces(images, detection_settings=None, cache=None, detected=None):
+    """
+    Detects faces in a batch of decoded images, reusing cached boxes for frames identical to a recent
+    one. The remaining frames go through the detector as one batch.
+
+    Args:
+        images: List of image arrays.
+        detection_settings: Overrides for DETECTION_SETTINGS.
+        cache: FaceBoxCache to reuse the boxes of an identical recent frame from, or None.
+        detected: List to append, per image, whether the detector ran on it rather than its boxes
+            being reused from the cache.
+
+    Returns:
+        list: Detected face bounding boxes as (x, y, w, h), per image.
+    """
+    if detected is None:
+        detected = []
+    with metric_span("detect"):
+        if cache is None:
+            detected.extend([True] * len(images))
+            return detect_faces_batch(images, detection_settings)
+
+        # Frames of this batch awaiting detection, by hash. Later identical frames of the batch share
+        # their result; nothing is cached until the detector has returned it.
+        pending = {}
+        sources, results = [], []
+        for image in images:
+            image_hash = content_hash(image)
+            if image_hash in pending:
+                cache.hits += 1
+                count_metric("cache_hits")
+                sources.append(pending[image_hash])
+                results.append(None)
+                continue
+            faces = cache.lookup(image_hash)
+            count_metric("cache_misses" if faces is None else "cache_hits")
+            if faces is None:
+                pending[image_hash] = len(results)
+            sources.append(None)
+            results.append(faces)
+
+        detected.extend(results[index] is None and source is None for index, source in enumerate(sources))
+        if pending:
+            found = detect_faces_batch([images[index] for index in pending.values()], detection_settings)
+            for (image_hash, index), faces in zip(pending.items(), found):
+                results[index] = faces
+                cache.store(image_hash, faces)
+        results = [results[index if source is None else source] for index, source in enumerate(sources)]
+    return results
+
+
+def apply_redaction(image, faces, redaction_type='redact'):
+    """
+    Redacts or blurs face regions of an image in place.
+
+    Args:
+        image: The image array.
+        faces: Face bounding boxes as (x, y, w, h).
+        redaction_type (str): The type of processing ('redact' or 'blur') to apply to the faces.
+    """
+    with metric_span("redact"):
+        for (x, y, w, h) in faces:
+            if redaction_type == 'blur':
+                blur_face(image, x, y, w, h)
+            else:  # Default to 'redact' for any other input
+                redact_face(image, x, y, w, h)
+    count_metric("faces", len(faces))
+
+def blur_face(image, x, y, w, h):
+    """
+    Applies Gaussian blurring to a face region in the image.
+
+    Args:
+        image: The image array.
+        x, y: The top-left corner of the face bounding box.
+        w, h: The width and height of the bounding box.
+    """
+    import cv2
+
+    region_of_interest = image[y:y+h, x:x+w]
+    blurred = cv2.GaussianBlur(region_of_interest, (99, 99), 30)
+    image[y:y+h, x:x+w] = blurred
+
+def redact_face(image, x, y, w, h):
+    """
+    Fills a face region in the image with black to redact it.
+
+    Args:
+        image: The image array.
+        x, y: The top-left corner of the face bounding box.
+        w, h: The width and height of the bounding box.
+    """
+    image[y:y+h, x:x+w] = (0, 0, 0)
+
+
+# Shared-memory redaction stage
+# Unzip and streaming workers decode images into shared memory blocks and pass only their names to a
+# pool of redaction workers, so the redaction work is balanced per image rather than per zip or panelist
+# and pixel buffers are never pickled. The consolidation stage holds a zip's CSV rows back until all of
+# its images are redacted.
+
+# Decoded image waiting in a shared memory block, followed by its encoded_size encoded bytes; job is the
+# S3Object of the zip it came from
+SharedImage = collections.namedtuple('SharedImage', ['job', 'panelist', 'output_path', 'shm_name', 'shape',
+                                                     'encoded_size'])
+
+# Outcome of redacting a SharedImage, passed on to the consolidation stage
+ImageResult = collections.namedtuple('ImageResult', ['job', 'ok'])
+
+
+def share_image(image, job, panelist, output_path, encoded=b''):
+    """
+    Copies a decoded image, and the encoded bytes it was decoded from, into a new shared memory block.
+
+    Args:
+        image: The decoded BGR image array.
+        job: S3Object of the zip the image came from.
+        panelist: Panelist folder name.
+        output_path: Path where the redacted image is to be saved.
+        encoded: The encoded image, saved unchanged if no face is found in it.
+
+    Returns:
+        SharedImage: Descriptor of the block. The redaction stage unlinks the block once it is done.
+    """
+    from multiprocessing import shared_memory
+    import numpy as np
+
+    block = shared_memory.SharedMemory(create=True, size=max(1, image.nbytes + len(encoded)))
+    try:
+        np.ndarray(image.shape, dtype=np.uint8, buffer=block.buf)[...] = image
+        block.buf[image.nbytes:image.nbytes + len(encoded)] = encoded
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+    block.close()
+    return SharedImage(job, panelist, output_path, block.name, image.shape, len(encoded))
+
+
+def share_zip_images(zip_ref, image_folder, job, panelist, csv_members, destination_folder=None, member_filter=None):
+    """
+    Decodes the images of a zip archive that haven't been redacted yet into shared memory.
+
+    Args:
+        zip_ref: Open zipfile.ZipFile.
+        image_folder: Folder where redacted images are written.
+        job: S3Object of the zip.
+        panelist: Panelist folder name.
+        csv_members: List the archive's CSV members are appended to as (filename, data) tuples.
+        destination_folder: Folder to extract CSV files to, passing their paths as data. If None, the
+            CSV contents are passed as bytes.
+        member_filter: MemberFilter selecting the members to read, or None for all.
+
+    Yields:
+        SharedImage: One per image to redact.
+    """
+    import cv2
+    import numpy as np
+
+    for file_info in select_members(zip_ref, member_filter):
+        if member_kind(file_info.filename) == 'image':
+            processed_image_path = image_output_path(os.path.join(image_folder, file_info.filename))
+
+            # Skip images that were already redacted by a previous run
+            if output_exists(processed_image_path):
+                continue
+            with metric_span("unzip"):
+                data = zip_ref.read(file_info)
+            with metric_span("decode"):
+                image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                raise ValueError(f"Could not decode image for {processed_image_path}")
+            yield share_image(image, job, panelist, processed_image_path, data)
+        else:
+            if destination_folder is None:
+                csv_members.append((file_info.filename, zip_ref.read(file_info)))
+                continue
+            extracted_file_path = os.path.join(destination_folder, file_info.filename)
+            if not os.path.exists(extracted_file_path):
+                zip_ref.extract(file_info, destination_folder)
+            csv_members.append((os.path.basename(file_info.filename), extracted_file_path))
+
+
+def redact_shared_image(item, redaction_type='redact', detection_settings=None):
+    """
+    Redaction stage target: redacts a SharedImage in place, saves it and frees its block. Other items
+    are passed through unchanged.
+
+    Args:
+        item: SharedImage, or an item for the consolidation stage.
+        redaction_type (str): The type of processing ('redact' or 'blur') to apply to detected faces.
+        detection_settings: Overrides for DETECTION_SETTINGS.
+
+    Returns:
+        list: An ImageResult for a SharedImage, otherwise the item itself.
+    """
+    if not isinstance(item, SharedImage):
+        return [item]
+
+    from multiprocessing import shared_memory
+    import numpy as np
+
+    block = shared_memory.SharedMemory(name=item.shm_name)
+    image = None
+    try:
+        image = np.ndarray(item.shape, dtype=np.uint8, buffer=block.buf)
+        detected = []
+        faces = redact_image(image, redaction_type, detection_settings,
+                             redaction_cache(item.panelist, detection_settings), detected)
+        original = None
+        # Only a detector result clears an image for passthrough, never boxes reused from the cache
+        if detected[0] and not faces and item.encoded_size:
+            original = bytes(block.buf[image.nbytes:image.nbytes + item.encoded_size])
+        ok = save_image(item.output_path, image, original)
+        count_metric("images")
+    except Exception as e:
+        logging.error(f"Error redacting {item.output_path}: {e}")
+        ok = False
+    finally:
+        # The array must be released before the block's buffer can be closed
+        image = None
+        block.close()
+        block.unlink()
+
+    return [ImageResult(item.job, bool(ok))]
+
+
+def tuned_image_workers(image_workers, autotuner=None):
+    """
+    Returns the number of redaction processes to start: image_workers, or with autotuning enough for
+    the autotuner to add workers while cores are idle.
+    """
+    if autotuner is None:
+        return image_workers
+    return max(image_workers, multiprocessing.cpu_count() - 1)
+
+
+def redact_stage(image_workers, redaction_type='redact', detection_settings=None):
+    """
+    Returns the shared-memory redaction stage.
+
+    Args:
+        image_workers: Number of redaction processes.
+        redaction_type (str): The type of processing ('redact' or 'blur') to apply to detected faces.
+        detection_settings: Overrides for DETECTION_SETTINGS.
+    """
+    from multiprocessing import resource_tracker
+
+    # Started before the workers fork so that they all share it: blocks created by one process and
+    # unlinked by another are accounted for once, and blocks left by terminated workers are removed
+    resource_tracker.ensure_running()
+
+    # A short queue bounds the decoded images held in shared memory at any time
+    return {"name": "redact", "workers": image_workers, "queue_size": 2 * image_workers,
+            "target": functools.partial(redact_shared_image, redaction_type=redaction_type,
+                                        detection_settings=detection_settings)}
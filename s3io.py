@@ -0,0 +1,663 @@
+import base64
+import collections
+import contextlib
+import hashlib
+import io
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import count_metric, metric_span
+
+
+# Step 1: Connect to AWS S3
+def connect_to_s3():
+    """
+    Connects to AWS S3 using existing credentials or prompts for new credentials.
+    Returns:
+        boto3 S3 client
+    """
+    import boto3
+
+    credentials_path = os.path.expanduser("~/.aws/credentials")
+    config_path = os.path.expanduser("~/.aws/config")
+
+    # Check if AWS credentials and configuration files exist
+    if os.path.exists(credentials_path) and os.path.exists(config_path):
+        use_existing = input("AWS credentials are found. Use existing credentials? (y/n): ")
+        if use_existing.lower() == 'y' or not use_existing:
+            logging.info("Using existing AWS credentials.")
+        else:
+            aws_access_key = input("Enter AWS Access Key: ")
+            aws_secret_key = input("Enter AWS Secret Key: ")
+            return boto3.client('s3', aws_access_key_id=aws_access_key, aws_secret_access_key=aws_secret_key)
+    else:
+        aws_access_key = input("Enter AWS Access Key: ")
+        aws_secret_key = input("Enter AWS Secret Key: ")
+        return boto3.client('s3', aws_access_key_id=aws_access_key, aws_secret_access_key=aws_secret_key)
+
+    return boto3.client('s3')
+
+
+# Step 6: S3 download engine
+# Each worker process builds its own client (clients must not be shared across forks) and runs many
+# concurrent GETs over its connection pool. Large objects are fetched as parallel byte ranges.
+
+# Default download settings; entries can be overridden per run
+DOWNLOAD_SETTINGS = {
+    "concurrency": 8,                         # Concurrent GETs per worker process
+    "part_size": 8 * 1024 * 1024,             # Byte range size for ranged GETs
+    "multipart_threshold": 16 * 1024 * 1024,  # Objects larger than this are fetched as parallel ranges
+    "max_bandwidth": None,                    # Bytes per second across all workers, None for no cap
+    "endpoint_url": None,                     # Alternative S3 endpoint, e.g. a local S3 stand-in
+}
+
+# Per-process download state created by init_download_worker
+_download_worker = None
+
+
+class BandwidthLimiter:
+    """
+    Token bucket shared by the download threads of one process.
+
+    Args:
+        bytes_per_second: Sustained rate to allow.
+    """
+
+    def __init__(self, bytes_per_second):
+        self.rate = float(bytes_per_second)
+        self.tokens = self.rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, num_bytes):
+        """
+        Blocks until num_bytes may be transferred.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= num_bytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+
+def create_s3_client(max_pool_connections=10, endpoint_url=None):
+    """
+    Creates an S3 client with a connection pool large enough for concurrent requests.
+
+    Args:
+        max_pool_connections: Size of the client's connection pool.
+        endpoint_url: Alternative S3 endpoint, e.g. a local S3 stand-in.
+
+    Returns:
+        boto3 S3 client
+    """
+    import boto3
+    from botocore.config import Config
+
+    config = Config(max_pool_connections=max_pool_connections, retries={"max_attempts": 10, "mode": "adaptive"})
+    if endpoint_url:
+        config = config.merge(Config(s3={"addressing_style": "path"}))
+    return boto3.client('s3', endpoint_url=endpoint_url, config=config)
+
+
+def init_download_worker(settings=None, num_workers=1, autotuner=None):
+    """
+    Stage initializer creating the download state of a worker process: its S3 client, thread pools
+    and bandwidth limiter.
+
+    Args:
+        settings: Overrides for DOWNLOAD_SETTINGS.
+        num_workers: Number of worker processes sharing the bandwidth cap.
+        autotuner: Autotuner of the run, whose concurrency setting bounds the concurrent downloads, or None.
+
+    Returns:
+        dict: The download state.
+    """
+    global _download_worker
+    settings = {**DOWNLOAD_SETTINGS, **(settings or {})}
+    concurrency = settings["concurrency"]
+    max_bandwidth = settings["max_bandwidth"]
+    if autotuner is not None:
+        # The pools are sized for the most threads the autotuner may allow; download_slot holds the
+        # number of concurrent downloads to its current setting
+        concurrency = autotuner.limits["concurrency"][1]
+
+    _download_worker = {
+        "settings": settings,
+        "autotuner": autotuner,
+        # Each object thread may run its own ranged GETs, so leave room for both in the pool
+        "s3": create_s3_client(2 * concurrency, settings["endpoint_url"]),
+        "object_executor": ThreadPoolExecutor(concurrency),
+        "part_executor": ThreadPoolExecutor(concurrency),
+        "limiter": BandwidthLimiter(max_bandwidth / num_workers) if max_bandwidth else None,
+        "slots": threading.Condition(),
+        "active": 0,
+    }
+    return _download_worker
+
+
+def get_download_worker():
+    """
+    Returns this process's download state, creating it with default settings on first use.
+    """
+    return _download_worker or init_download_worker()
+
+
+def download_concurrency(worker):
+    """
+    Returns the number of concurrent downloads a worker process runs: the autotuned setting, if any,
+    or its configured concurrency.
+    """
+    autotuner = worker["autotuner"]
+    return autotuner.get("concurrency") if autotuner is not None else worker["settings"]["concurrency"]
+
+
+@contextlib.contextmanager
+def download_slot(worker):
+    """
+    Holds one of the worker's download slots for the enclosed download. Without autotuning the thread
+    pools already bound the number of concurrent downloads and this is a no-op.
+    """
+    if worker["autotuner"] is None:
+        yield
+        return
+    with worker["slots"]:
+        # The limit may be raised at any time, so check it again every so often
+        while worker["active"] >= download_concurrency(worker):
+            worker["slots"].wait(0.25)
+        worker["active"] += 1
+    try:
+        yield
+    finally:
+        with worker["slots"]:
+            worker["active"] -= 1
+            worker["slots"].notify()
+
+
+def _read_body(body, write_at, offset, limiter):
+    """
+    Copies a streaming response body to write_at in chunks, honouring the bandwidth limiter.
+    """
+    for chunk in body.iter_chunks(chunk_size=256 * 1024):
+        if limiter:
+            limiter.consume(len(chunk))
+        write_at(offset, chunk)
+        offset += len(chunk)
+
+
+def _if_match(etag):
+    """
+    Returns the extra get_object arguments that make a GET fail with 412 PreconditionFailed unless the
+    object still has the listed ETag, so that an object replaced during a download is never stitched
+    together from the parts of two versions.
+    """
+    return {"IfMatch": f'"{etag}"'} if etag else {}
+
+
+def fetch_s3_object(bucket_name, key, size, write_at, worker=None, etag=None):
+    """
+    Fetches an S3 object, using parallel ranged GETs when it is larger than the multipart threshold.
+
+    Args:
+        bucket_name: Name of the S3 bucket.
+        key: Key of the object.
+        size: Size of the object in bytes, as reported by the listing.
+        write_at: Callable (offset, data) that stores a chunk of the object.
+        worker: Download state (default: this process's).
+        etag: ETag reported by the listing. If given, the download fails if the object has changed since.
+    """
+    worker = worker or get_download_worker()
+    s3, settings, limiter = worker["s3"], worker["settings"], worker["limiter"]
+
+    def fetch_range(start):
+        end = min(start + settings["part_size"], size) - 1
+        body = s3.get_object(Bucket=bucket_name, Key=key, Range=f"bytes={start}-{end}", **_if_match(etag))['Body']
+        _read_body(body, write_at, start, limiter)
+
+    with download_slot(worker), metric_span("download"):
+        if size <= settings["multipart_threshold"]:
+            body = s3.get_object(Bucket=bucket_name, Key=key, **_if_match(etag))['Body']
+            _read_body(body, write_at, 0, limiter)
+        else:
+            for future in [worker["part_executor"].submit(fetch_range, start)
+                           for start in range(0, size, settings["part_size"])]:
+                future.result()
+    count_metric("bytes_downloaded", size)
+
+
+def read_ahead(executor, fn, items, ahead):
+    """
+    Like executor.map, but submits calls only as results are consumed, keeping at most `ahead` calls
+    running or finished ahead of the consumer.
+
+    Args:
+        executor: Executor to run the calls on.
+        fn: Callable taking one item.
+        items: Iterable of items.
+        ahead: Maximum number of results held ahead of the consumer.
+
+    Yields:
+        The results, in the order of items.
+    """
+    pending = collections.deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) > ahead:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def download_s3_object(bucket_name, key, size, file_path, worker=None, etag=None):
+    """
+    Downloads an S3 object to a file. The data goes to a temporary file that is renamed once
+    complete, so an interrupted download never leaves a truncated file behind.
+
+    Args:
+        bucket_name: Name of the S3 bucket.
+        key: Key of the object.
+        size: Size of the object in bytes.
+        file_path: Local destination path.
+        worker: Download state (default: this process's).
+        etag: ETag reported by the listing, checked by every GET (see fetch_s3_object).
+    """
+    partial_path = file_path + '.part'
+    fd = os.open(partial_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        fetch_s3_object(bucket_name, key, size, lambda offset, data: os.pwrite(fd, data, offset), worker, etag)
+    except BaseException:
+        os.close(fd)
+        os.remove(partial_path)
+        raise
+    os.close(fd)
+    os.replace(partial_path, file_path)
+
+
+def read_s3_object(bucket_name, key, size, worker=None, etag=None):
+    """
+    Reads an S3 object into memory.
+
+    Args:
+        bucket_name: Name of the S3 bucket.
+        key: Key of the object.
+        size: Size of the object in bytes.
+        worker: Download state (default: this process's).
+        etag: ETag reported by the listing, checked by every GET (see fetch_s3_object).
+
+    Returns:
+        bytearray: The object's content.
+    """
+    buffer = bytearray(size)
+
+    def write_at(offset, data):
+        buffer[offset:offset + len(data)] = data
+
+    fetch_s3_object(bucket_name, key, size, write_at, worker, etag)
+    return buffer
+
+
+# S3 output sink
+# With an output URI set, redacted images are encoded in memory and uploaded straight to the target prefix
+# instead of being written to the local image folders, and the consolidated outputs are uploaded at the
+# end of the run. Keys mirror the local paths, so a rerun finds the images it already uploaded and skips
+# them, and skips output files whose content hasn't changed.
+
+# Default upload settings; entries can be overridden per run
+OUTPUT_SETTINGS = {
+    "concurrency": 8,                         # Concurrent file uploads, and concurrent parts per file
+    "part_size": 16 * 1024 * 1024,            # Part size of multipart uploads (S3 minimum: 5 MB)
+    "multipart_threshold": 16 * 1024 * 1024,  # Files larger than this are uploaded in parts
+    "endpoint_url": None,                     # Alternative S3 endpoint, e.g. a local S3 stand-in
+}
+
+# Output URI and settings of the current query, passed to the pipeline's worker processes
+_output_config = None
+
+# Upload state of this process, created on first use by get_output_sink
+_output_sink = None
+
+
+def parse_s3_uri(uri):
+    """
+    Splits an s3://bucket/prefix URI into the bucket and a key prefix ending in '/' (or empty).
+    """
+    if not uri or not uri.startswith("s3://"):
+        raise ValueError(f"Not an S3 URI: {uri}")
+    bucket_name, _, prefix = uri[len("s3://"):].partition("/")
+    if not bucket_name:
+        raise ValueError(f"Not an S3 URI: {uri}")
+    prefix = prefix.strip("/")
+    return bucket_name, prefix + "/" if prefix else ""
+
+
+def _content_md5(data):
+    return base64.b64encode(hashlib.md5(data).digest()).decode()
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class S3OutputSink:
+    """
+    Uploads pipeline outputs to an S3 prefix. Every request carries a Content-MD5 header, so S3 rejects
+    corrupted uploads, and every object a sha256 metadata entry that reruns compare local files against.
+
+    Args:
+        output_uri: Target as s3://bucket/prefix.
+        settings: Overrides for OUTPUT_SETTINGS.
+    """
+
+    def __init__(self, output_uri, settings=None):
+        self.bucket_name, self.prefix = parse_s3_uri(output_uri)
+        self.settings = {**OUTPUT_SETTINGS, **(settings or {})}
+        concurrency = self.settings["concurrency"]
+        # Each file thread may run its own part uploads, so leave room for both in the pool
+        self.s3 = create_s3_client(2 * concurrency, self.settings["endpoint_url"])
+        self.file_executor = ThreadPoolExecutor(concurrency)
+        self.part_executor = ThreadPoolExecutor(concurrency)
+        self.pid = os.getpid()
+        # Keys found under each listed folder of the target, plus the ones uploaded since
+        self.listed = {}
+        self.lock = threading.Lock()
+
+    def key_for(self, path):
+        """
+        Returns the key of a local output path, relative to the working directory. Paths of shard
+        sub-queries map to the query's own keys (see output_key_path).
+        """
+        return self.prefix + output_key_path(os.path.normpath(path).replace(os.sep, "/").lstrip("/"))
+
+    def exists(self, path):
+        """
+        Checks whether the output for a local path was uploaded. The first check in a folder lists the
+        folder once, so checking every image of a zip costs one listing rather than a request per image.
+        """
+        key = self.key_for(path)
+        folder = key.rpartition("/")[0] + "/"
+        with self.lock:
+            keys = self.listed.get(folder)
+        if keys is None:
+            keys = set()
+            paginator = self.s3.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=folder, Delimiter='/'):
+                keys.update(obj['Key'] for obj in page.get('Contents', []))
+            with self.lock:
+                keys = self.listed.setdefault(folder, keys)
+        return key in keys
+
+    def _remember(self, key):
+        with self.lock:
+            keys = self.listed.get(key.rpartition("/")[0] + "/")
+            if keys is not None:
+                keys.add(key)
+
+    def put(self, path, data):
+        """
+        Uploads the output for a local path from memory in a single request.
+        """
+        key = self.key_for(path)
+        with metric_span("upload"):
+            self.s3.put_object(Bucket=self.bucket_name, Key=key, Body=bytes(data), ContentMD5=_content_md5(data),
+                               Metadata={"sha256": hashlib.sha256(data).hexdigest()})
+        count_metric("bytes_uploaded", len(data))
+        self._remember(key)
+
+    def remote_sha256(self, key):
+        """
+        Returns the sha256 recorded on an uploaded object, or None if the key doesn't exist.
+        """
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.s3.head_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return response.get('Metadata', {}).get('sha256', '')
+
+    def upload_file(self, path):
+        """
+        Uploads a local file unless the target already holds the same content. Files larger than the
+        multipart threshold are uploaded as concurrent parts read straight from the file.
+
+        Returns:
+            bool: True if the file was uploaded, False if it was skipped.
+        """
+        key = self.key_for(path)
+        size = os.path.getsize(path)
+        digest = _file_sha256(path)
+        if self.remote_sha256(key) == digest:
+            count_metric("uploads_skipped")
+            return False
+
+        part_size = self.settings["part_size"]
+        if size <= self.settings["multipart_threshold"]:
+            with open(path, 'rb') as f:
+                self.put(path, f.read())
+            return True
+
+        with metric_span("upload"):
+            upload_id = self.s3.create_multipart_upload(Bucket=self.bucket_name, Key=key,
+                                                        Metadata={"sha256": digest})['UploadId']
+            fd = os.open(path, os.O_RDONLY)
+
+            def upload_part(part_number, offset):
+                data = os.pread(fd, part_size, offset)
+                response = self.s3.upload_part(Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                                               PartNumber=part_number, Body=data, ContentMD5=_content_md5(data))
+                return {"PartNumber": part_number, "ETag": response['ETag']}
+
+            try:
+                # Parts are read when their upload starts, so at most `concurrency` parts are in memory
+                parts = [future.result() for future in
+                         [self.part_executor.submit(upload_part, number, offset)
+                          for number, offset in enumerate(range(0, size, part_size), start=1)]]
+                self.s3.complete_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                                                  MultipartUpload={"Parts": parts})
+            except BaseException:
+                # Incomplete uploads are billed until aborted
+                self.s3.abort_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id)
+                raise
+            finally:
+                os.close(fd)
+        count_metric("bytes_uploaded", size)
+        self._remember(key)
+        return True
+
+    def upload_folder(self, folder):
+        """
+        Uploads the files under a local folder concurrently, skipping unchanged ones.
+
+        Returns:
+            tuple: Numbers of files uploaded and skipped.
+        """
+        paths = [os.path.join(root, name) for root, _, files in os.walk(folder) for name in files]
+        uploaded = sum(self.file_executor.map(self.upload_file, paths))
+        return uploaded, len(paths) - uploaded
+
+
+# Shard path segment of output paths, dropped from output keys so shards upload to the query's own keys
+_SHARD_SEGMENT = re.compile(r'(^|/)shards/[^/]+/(?=combined/)')
+
+
+def output_key_path(path):
+    """
+    Returns the path an output is stored under in the output sink: outputs of a shard sub-query map to
+    the same keys as in a single-node run.
+    """
+    return _SHARD_SEGMENT.sub(r'\1', path)
+
+
+def configure_output_sink(output_uri=None, settings=None):
+    """
+    Sets the output URI of the following pipeline runs. Called before the pipeline starts, so that its
+    worker processes receive it (see query_worker_initializer); each process creates its own client on first
+    upload.
+
+    Args:
+        output_uri: Target as s3://bucket/prefix, or None to write outputs locally.
+        settings: Overrides for OUTPUT_SETTINGS.
+    """
+    global _output_config, _output_sink
+    if output_uri:
+        parse_s3_uri(output_uri)
+    _output_config = (output_uri, settings) if output_uri else None
+    _output_sink = None
+
+
+def output_sink_config():
+    """
+    Returns:
+        tuple: The output URI and settings of this process (see configure_output_sink), or None to write
+        outputs locally.
+    """
+    return _output_config
+
+
+def get_output_sink():
+    """
+    Returns this process's S3OutputSink, or None if outputs are written locally.
+    """
+    global _output_sink
+    if _output_config is None:
+        return None
+    # Clients must not be shared across forks: a sink inherited from the parent is replaced
+    if _output_sink is None or _output_sink.pid != os.getpid():
+        _output_sink = S3OutputSink(*_output_config)
+    return _output_sink
+
+
+def output_exists(path):
+    """
+    Checks whether an output was already written, locally or to the output sink.
+    """
+    sink = get_output_sink()
+    return sink.exists(path) if sink else os.path.exists(path)
+
+
+def upload_outputs(query_id):
+    """
+    Uploads the consolidated outputs of a query to the output sink, if one is configured. The images
+    were uploaded as they were redacted.
+    """
+    sink = get_output_sink()
+    if sink is None:
+        return
+    uploaded, skipped = sink.upload_folder(os.path.join(query_id, "combined"))
+    logging.info(f"Uploaded {uploaded} output files to s3://{sink.bucket_name}/{sink.prefix} "
+                 f"({skipped} unchanged).")
+
+
+class S3RangeFile(io.RawIOBase):
+    """
+    Read-only, seekable view of an S3 object that fetches only the blocks that are read, so zipfile can
+    read the central directory and selected members of a remote archive without downloading all of it.
+
+    Args:
+        bucket_name: Name of the S3 bucket.
+        obj: S3Object of the archive.
+        worker: Download state (default: this process's).
+        block_size: Granularity of the ranged GETs.
+    """
+
+    def __init__(self, bucket_name, obj, worker=None, block_size=256 * 1024):
+        super().__init__()
+        self.bucket_name, self.key, self.size, self.etag = bucket_name, obj.key, obj.size, obj.etag
+        self.worker = worker or get_download_worker()
+        self.block_size = block_size
+        self.blocks = {}
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def _fetch(self, first, last):
+        """
+        Fetches blocks first..last (inclusive) with one ranged GET.
+        """
+        start, end = first * self.block_size, min((last + 1) * self.block_size, self.size)
+        data = bytearray(end - start)
+
+        def write_at(offset, chunk):
+            data[offset - start:offset - start + len(chunk)] = chunk
+
+        with metric_span("download"):
+            body = self.worker["s3"].get_object(Bucket=self.bucket_name, Key=self.key,
+                                                Range=f"bytes={start}-{end - 1}", **_if_match(self.etag))['Body']
+            _read_body(body, write_at, start, self.worker["limiter"])
+        count_metric("bytes_downloaded", len(data))
+        for block in range(first, last + 1):
+            offset = (block - first) * self.block_size
+            self.blocks[block] = bytes(data[offset:offset + self.block_size])
+
+    def _missing_runs(self, start, end):
+        """
+        Returns the runs of consecutive blocks covering bytes start..end-1 that haven't been fetched.
+        """
+        runs = []
+        for block in range(start // self.block_size, (min(end, self.size) - 1) // self.block_size + 1):
+            if block in self.blocks:
+                continue
+            if runs and runs[-1][1] == block - 1:
+                runs[-1][1] = block
+            else:
+                runs.append([block, block])
+        return runs
+
+    def prefetch(self, ranges):
+        """
+        Fetches the blocks of several (start, end) byte ranges concurrently.
+        """
+        runs = []
+        for start, end in sorted(ranges):
+            for run in self._missing_runs(start, end):
+                if runs and runs[-1][1] >= run[0] - 1:
+                    runs[-1][1] = max(runs[-1][1], run[1])
+                else:
+                    runs.append(run)
+        for future in [self.worker["part_executor"].submit(self._fetch, first, last) for first, last in runs]:
+            future.result()
+
+    def readinto(self, buffer):
+        end = min(self.position + len(buffer), self.size)
+        if end <= self.position:
+            return 0
+        for first, last in self._missing_runs(self.position, end):
+            self._fetch(first, last)
+
+        written = 0
+        while self.position < end:
+            block, offset = divmod(self.position, self.block_size)
+            chunk = self.blocks[block][offset:offset + end - self.position]
+            buffer[written:written + len(chunk)] = chunk
+            written += len(chunk)
+            self.position += len(chunk)
+        return written
@@ -0,0 +1,27 @@
+import argparse
+
+import pytest
+
+pytest.importorskip("boto3")
+pytest.importorskip("cv2")
+benchmark = pytest.importorskip("benchmark")
+
+
+def _memory_args(**overrides):
+    defaults = dict(scales=[500, 4000], panelists=20, processors=1, batch_size=25, memory_limit_mb=0, timeout=120,
+                    tolerance=0.25)
+    return argparse.Namespace(**{**defaults, **overrides})
+
+
+def test_driver_memory_stays_flat():
+    result = benchmark.bench_memory(_memory_args())
+
+    assert [run["objects"] for run in result["runs"]] == [500, 4000]
+    assert all(run["batches"] > 0 for run in result["runs"])
+    assert result["flat"], result
+
+
+def test_failed_stand_in_raises_instead_of_hanging():
+    # Spreading objects over no panelists fails the stand-in's process before it serves anything
+    with pytest.raises(RuntimeError):
+        benchmark.bench_memory(_memory_args(scales=[500], panelists=0, timeout=30))
@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+import catalog
+import outputs
+
+QUERY_ID = "query"
+HEADER = "timestamp,session_id,app,start_time,duration\n"
+ROWS = {
+    "p1": ["1714644000000,1,chrome,2024-05-02T10:00:00,30\n",
+           "1714644060000,2,,2024-05-02T10:01:00,45.5\n",
+           "1714644120000,7,maps,2024-05-02T10:02:00,\n"],
+    "p2": ["1714730400000,12,chrome,2024-05-03T10:00:00,10\n",
+           "1714730460000,x,maps,2024-05-03T10:01:00,31\n"],
+}
+PREDICATES = [
+    ("duration", ">", 30),
+    ("duration", "==", 30.0),
+    ("duration", "in", [10, 31]),
+    ("app", "==", "chrome"),
+    ("app", "!=", "chrome"),
+    ("app", "in", ["maps"]),
+    ("start_time", ">=", "2024-05-02T10:01:00"),
+    ("session_id", ">", 5),
+]
+
+
+@pytest.fixture(autouse=True)
+def consolidated_outputs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for panelist, rows in ROWS.items():
+        folder = os.path.join(QUERY_ID, "combined", "panelists", panelist, "metadata")
+        os.makedirs(folder)
+        with open(os.path.join(folder, "session_data-consolidated.csv"), "w") as f:
+            f.write(HEADER + "".join(rows))
+
+
+def _apps(frame):
+    frame = frame.select("panelist", "timestamp")
+    return sorted((row.panelist, str(row.timestamp)) for chunk in frame for row in chunk.itertuples())
+
+
+def test_catalog_lists_outputs():
+    catalog.write_catalog(QUERY_ID)
+    listed = catalog.Catalog(QUERY_ID)
+
+    assert listed.prefixes() == ["session_data"]
+    assert listed.panelists() == ["p1", "p2"]
+    assert listed.columns("session_data") == HEADER.strip().split(",")
+    with pytest.raises(ValueError):
+        listed.frame("screenshot_data")
+
+
+def test_csv_frames_filter_rows():
+    pytest.importorskip("pandas")
+    frame = catalog.Catalog(QUERY_ID).frame("session_data")
+
+    assert _apps(frame.where("duration", ">", 30)) == [("p1", "1714644060000"), ("p2", "1714730460000")]
+    assert _apps(frame.where("app", "!=", "chrome")) == [("p1", "1714644120000"), ("p2", "1714730460000")]
+    assert _apps(frame.select("app").where("session_id", "in", [1, 12])) == [("p1", "1714644000000"),
+                                                                             ("p2", "1714730400000")]
+
+
+@pytest.mark.parametrize("predicate", PREDICATES, ids=lambda predicate: " ".join(map(str, predicate)))
+def test_columnar_frames_filter_like_csv_frames(predicate):
+    pytest.importorskip("pandas")
+    pytest.importorskip("pyarrow")
+    catalog.write_catalog(QUERY_ID)
+    expected = _apps(catalog.Catalog(QUERY_ID).frame("session_data").where(*predicate))
+
+    outputs.write_columnar_outputs(QUERY_ID, "parquet")
+    catalog.write_catalog(QUERY_ID)
+    frame = catalog.Catalog(QUERY_ID).frame("session_data")
+
+    assert {entry["format"] for entry in frame.entries} == {"parquet"}
+    assert _apps(frame.where(*predicate)) == expected
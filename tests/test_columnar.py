@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+import outputs
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+
+QUERY_ID = "query"
+
+
+def _write_csv(panelist, prefix, content):
+    folder = os.path.join(QUERY_ID, "combined", "panelists", panelist, "metadata")
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"{prefix}-consolidated.csv")
+    with open(path, "w") as f:
+        f.write(content)
+    return path
+
+
+def test_columns_that_dont_fit_their_type_fall_back(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    _write_csv("p1", "session_data", "timestamp,start_time,duration\n1714608000000,1,10\n1714608001000,2,11\n")
+    path = _write_csv("p2", "session_data",
+                      "timestamp,start_time,duration\n2024-05-02T10:00:00,3,1.5\n2024-05-02T11:00:00,4,\n")
+
+    outputs.write_columnar_outputs(QUERY_ID, "parquet")
+
+    table = pq.read_table(os.path.splitext(path)[0] + ".parquet")
+    assert table.schema.field("timestamp").type == pa.string()
+    assert table.schema.field("start_time").type == pa.int64()
+    assert table.schema.field("duration").type == pa.float64()
+    assert table.column("duration").to_pylist() == [1.5, None]
+    assert os.path.isdir(os.path.join(QUERY_ID, "combined", "datasets", "session_data", "panelist=p2"))
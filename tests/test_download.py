@@ -0,0 +1,91 @@
+import os
+
+import pytest
+
+pytest.importorskip("boto3")
+from botocore.exceptions import ClientError
+
+import listing
+import query
+import s3io
+from local_s3 import LocalS3Server
+
+BUCKET = "screenlake-test"
+PREFIX = "academia/tenant/t/panel/p/V_1/panelist/"
+
+
+@pytest.fixture
+def server():
+    with LocalS3Server() as server:
+        yield server
+
+
+@pytest.fixture
+def worker(server):
+    return s3io.init_download_worker({"concurrency": 4, "part_size": 64 * 1024,
+                                     "multipart_threshold": 128 * 1024,
+                                     "endpoint_url": server.endpoint_url})
+
+
+def _listing(server):
+    s3 = s3io.create_s3_client(endpoint_url=server.endpoint_url)
+    return sorted(listing.list_s3_objects(s3, BUCKET, PREFIX))
+
+
+def test_large_objects_are_fetched_as_ranged_gets(server, worker):
+    data = os.urandom(300 * 1024)
+    server.put(BUCKET, PREFIX + "0001/large.zip", data)
+    obj, = _listing(server)
+
+    assert s3io.read_s3_object(BUCKET, obj.key, obj.size, worker, obj.etag) == data
+    # Sorted by start offset: as text, "bytes=65536-..." would sort after "bytes=262144-..."
+    ranges = sorted((byte_range for _, _, byte_range in server.requests), key=lambda r: int(r[6:].split("-")[0]))
+    assert len(ranges) == 5
+    assert ranges[0] == "bytes=0-65535" and ranges[-1] == f"bytes={4 * 65536}-{len(data) - 1}"
+
+
+def test_small_objects_are_fetched_with_one_get(server, worker):
+    server.put(BUCKET, PREFIX + "0001/small.zip", b"small")
+    obj, = _listing(server)
+
+    assert s3io.read_s3_object(BUCKET, obj.key, obj.size, worker, obj.etag) == b"small"
+    assert server.requests == [("GET", obj.key, None)]
+
+
+def test_throttled_gets_are_retried(server, worker, tmp_path):
+    data = os.urandom(1000)
+    server.put(BUCKET, PREFIX + "0001/retry.zip", data)
+    obj, = _listing(server)
+    server.fail_requests(2)
+
+    path = str(tmp_path / "retry.zip")
+    s3io.download_s3_object(BUCKET, obj.key, obj.size, path, worker, obj.etag)
+    with open(path, "rb") as f:
+        assert f.read() == data
+    assert len(server.requests) == 3
+
+
+def test_object_replaced_after_listing_fails_without_partial_file(server, worker, tmp_path):
+    server.put(BUCKET, PREFIX + "0001/changed.zip", os.urandom(300 * 1024))
+    obj, = _listing(server)
+    server.put(BUCKET, obj.key, os.urandom(300 * 1024))
+
+    path = str(tmp_path / "changed.zip")
+    with pytest.raises(ClientError) as error:
+        s3io.download_s3_object(BUCKET, obj.key, obj.size, path, worker, obj.etag)
+    assert error.value.response["Error"]["Code"] in ("PreconditionFailed", "412")
+    assert os.listdir(tmp_path) == []
+
+
+def test_download_batch_writes_each_object(server, worker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    objects = {PREFIX + f"{i % 2:04d}/{i:04d}.zip": os.urandom(2000 + i) for i in range(6)}
+    for key, data in objects.items():
+        server.put(BUCKET, key, data)
+
+    downloaded = query.download_batch(_listing(server), "q", BUCKET)
+
+    assert len(downloaded) == 6
+    for obj, path in downloaded:
+        with open(path, "rb") as f:
+            assert f.read() == objects[obj.key]
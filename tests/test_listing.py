@@ -0,0 +1,61 @@
+from datetime import datetime, timezone
+
+import listing
+
+BUCKET = "screenlake-test"
+PATH = "academia/tenant/t/panel/p/V_1/panelist/"
+MODIFIED = datetime(2024, 5, 2, tzinfo=timezone.utc)
+
+
+class FakeS3:
+    """
+    In-process stand-in for the list_objects_v2 call of a boto3 client.
+    """
+
+    def __init__(self, keys):
+        self.keys = sorted(keys)
+
+    def list_objects_v2(self, Bucket, Prefix, Delimiter=None, ContinuationToken=None):
+        contents, prefixes = [], []
+        for key in self.keys:
+            if not key.startswith(Prefix):
+                continue
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                common = Prefix + rest[:rest.index(Delimiter) + 1]
+                if common not in prefixes:
+                    prefixes.append(common)
+            else:
+                contents.append({"Key": key, "Size": 1, "LastModified": MODIFIED, "ETag": '"etag"'})
+        return {"Contents": contents, "CommonPrefixes": [{"Prefix": prefix} for prefix in prefixes]}
+
+
+def _listed(keys, **kwargs):
+    s3 = FakeS3(keys)
+    return sorted(obj.key for obj in listing.list_s3_objects(
+        s3, BUCKET, PATH, datetime(2024, 5, 1), datetime(2024, 5, 31), **kwargs))
+
+
+def test_panelists_with_date_like_ids_are_listed():
+    keys = [PATH + "20270115-4b2c-4d6e-9f00-1a2b3c4d5e6f/2024-05-02.zip",
+            PATH + "2027-01-15_study/2024-05-02.zip",
+            PATH + "1893456000/2024-05-02.zip",
+            PATH + "1893456000123/2024-05-02.zip",
+            PATH + "a1b2c3d4/2024-05-02.zip"]
+    assert _listed(keys) == sorted(keys)
+    # Only the declared partition level is pruned, and only on whole dates
+    assert _listed(keys, date_levels=(2,)) == sorted(keys)
+
+
+def test_date_partitions_after_the_range_are_skipped_at_declared_levels():
+    kept = [PATH + "20270115-aaaa/2024-05-02/a.zip", PATH + "p/date=2024-05-30/b.zip", PATH + "p/20240501/c.zip"]
+    skipped = [PATH + "p/2024-06-02/d.zip", PATH + "p/date=2024-07-01/e.zip", PATH + "p/20240601/f.zip"]
+    assert _listed(kept + skipped, date_levels=(2,)) == sorted(kept)
+    assert _listed(kept + skipped) == sorted(kept + skipped)
+
+
+def test_partition_date_requires_a_whole_date():
+    assert listing.partition_date("2024-05-01/") == datetime(2024, 5, 1, tzinfo=timezone.utc)
+    assert listing.partition_date("date=20240501") == datetime(2024, 5, 1, tzinfo=timezone.utc)
+    assert listing.partition_date("20270115-4b2c/") is None
+    assert listing.partition_date("1893456000/") is None
@@ -0,0 +1,172 @@
+import os
+import zipfile
+from datetime import datetime
+
+import pytest
+
+import consolidatecsvs
+import manifest
+import outputs
+import query
+import queryconfig
+from listing import S3Object
+
+QUERY_ID = "query"
+OUTPUT = os.path.join(QUERY_ID, "combined", "panelists", "p1", "metadata", "session_data-consolidated.csv")
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.fixture(autouse=True)
+def query_folder(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(query, "_consolidated_outputs", set())
+    yield
+    for key in [key for key in manifest._manifest_connections if key[1].startswith(QUERY_ID)]:
+        manifest._manifest_connections.pop(key).close()
+
+
+def _zip(n, header=b"id,value\n", rows=None):
+    obj = S3Object(f"p1/{n}.zip", 1, 0, f"etag{n}")
+    rows = rows if rows is not None else f"{n},v{n}\n".encode()
+    return obj, "p1", [("session_data_1.csv", header + rows)]
+
+
+def _consolidate(item):
+    query.consolidate_panelist_csvs(item, QUERY_ID, append_existing=True)
+
+
+def _new_run(monkeypatch):
+    monkeypatch.setattr(query, "_consolidated_outputs", set())
+
+
+def _interrupt_commit(monkeypatch):
+    def mark_manifest(query_id, obj, stage, outputs=None):
+        if stage == "consolidated":
+            raise Interrupted()
+    monkeypatch.setattr(query, "mark_manifest", mark_manifest)
+
+
+def _read():
+    with open(OUTPUT, "rb") as f:
+        return f.read()
+
+
+def test_pending_skips_consolidated_objects():
+    first, second = _zip(1)[0], _zip(2)[0]
+    manifest.mark_manifest(QUERY_ID, first, "consolidated")
+    changed = first._replace(etag="changed")
+
+    pending = list(manifest.manifest_pending(QUERY_ID, [first, second, changed]))
+
+    assert pending == [second, changed]
+    assert manifest.manifest_counts(QUERY_ID)["consolidated"] == 1
+
+
+def test_rows_appended_before_an_interrupted_commit_are_not_duplicated(monkeypatch):
+    _consolidate(_zip(1))
+
+    _new_run(monkeypatch)
+    with monkeypatch.context() as m:
+        _interrupt_commit(m)
+        with pytest.raises(Interrupted):
+            _consolidate(_zip(2))
+    assert _read() == b"id,value\n1,v1\n2,v2\n"
+
+    _new_run(monkeypatch)
+    item = _zip(2)
+    assert list(manifest.manifest_pending(QUERY_ID, [_zip(1)[0], item[0]])) == [item[0]]
+    _consolidate(item)
+
+    assert _read() == b"id,value\n1,v1\n2,v2\n"
+
+
+def test_widened_rewrite_is_renamed_only_after_the_commit(monkeypatch):
+    _consolidate(_zip(1))
+
+    _new_run(monkeypatch)
+    with monkeypatch.context() as m:
+        _interrupt_commit(m)
+        with pytest.raises(Interrupted):
+            _consolidate(_zip(2, header=b"id,value,extra\n", rows=b"2,v2,x\n"))
+    assert _read() == b"id,value\n1,v1\n"
+
+    _new_run(monkeypatch)
+    _consolidate(_zip(2, header=b"id,value,extra\n", rows=b"2,v2,x\n"))
+
+    assert _read() == b"id,value,extra\n1,v1,\n2,v2,x\n"
+    assert not os.path.exists(OUTPUT + ".tmp")
+
+
+def test_committed_rewrite_is_rolled_forward(monkeypatch):
+    _consolidate(_zip(1))
+
+    _new_run(monkeypatch)
+    with monkeypatch.context() as m:
+        m.setattr(os, "replace", lambda src, dst: (_ for _ in ()).throw(Interrupted()))
+        with pytest.raises(Interrupted):
+            _consolidate(_zip(2, header=b"id,value,extra\n", rows=b"2,v2,x\n"))
+
+    _new_run(monkeypatch)
+    _consolidate(_zip(3, header=b"id,value,extra\n", rows=b"3,v3,y\n"))
+
+    assert _read() == b"id,value,extra\n1,v1,\n2,v2,x\n3,v3,y\n"
+
+
+def test_interrupted_append_after_a_deduplicating_sort_is_restored(monkeypatch):
+    header = b"timestamp,value\n"
+    _consolidate(_zip(1, header=header, rows=b"2000,b\n1000,a\n2000,b\n"))
+    outputs.sort_outputs(QUERY_ID)
+    sorted_csv = _read()
+    assert sorted_csv == b"timestamp,value\n1000,a\n2000,b\n"
+
+    _new_run(monkeypatch)
+    with monkeypatch.context() as m:
+        _interrupt_commit(m)
+        with pytest.raises(Interrupted):
+            _consolidate(_zip(2, header=header, rows=b"3000,c\n"))
+
+    _new_run(monkeypatch)
+    _consolidate(_zip(2, header=header, rows=b"3000,c\n"))
+
+    assert _read() == sorted_csv + b"3000,c\n"
+
+
+def test_zips_with_csvs_of_the_same_name_are_both_consolidated():
+    folder = os.path.join(QUERY_ID, "zipped", "panelists", "p1")
+    os.makedirs(folder)
+    for n in (1, 2):
+        with zipfile.ZipFile(os.path.join(folder, f"{n}.zip"), "w") as zip_ref:
+            zip_ref.writestr("session_data_1.csv", f"id,value\n{n},v{n}\n")
+
+    for n in (1, 2):
+        for item in query.unzip_panelist_zip((None, os.path.join(folder, f"{n}.zip")), QUERY_ID):
+            query.consolidate_panelist_csvs(item, QUERY_ID)
+
+    assert _read() == b"id,value\n1,v1\n2,v2\n"
+
+
+def test_rerun_moves_the_end_date_forward():
+    query_config = queryconfig.new_query_config("bucket", "path/", datetime(2024, 5, 1), datetime(2024, 5, 31))
+    query_config["status"] = "completed"
+    queryconfig.save_query_config(query_config)
+
+    rerun = queryconfig.rerun_query_config(query_config["queryId"], datetime(2024, 6, 30))
+
+    assert rerun["queryId"] == query_config["queryId"]
+    assert rerun["endDate"] == datetime(2024, 6, 30).isoformat()
+    assert queryconfig.load_query_config(query_config["queryId"])["endDate"] == rerun["endDate"]
+    with pytest.raises(ValueError):
+        queryconfig.rerun_query_config(query_config["queryId"], datetime(2024, 6, 1))
+
+
+def test_rerun_from_the_command_line():
+    query_config = queryconfig.new_query_config("bucket", "path/", datetime(2024, 5, 1), datetime(2024, 5, 31))
+    args = consolidatecsvs.parse_args(["--rerun", query_config["queryId"], "--end-date", "2024-07-01"])
+
+    configs = list(consolidatecsvs.query_configs_from_args(args))
+
+    assert [config["queryId"] for config in configs] == [query_config["queryId"]]
+    assert configs[0]["endDate"].startswith("2024-07-01")
@@ -0,0 +1,71 @@
+import functools
+import multiprocessing
+import signal
+from datetime import datetime
+
+import pytest
+
+import metrics
+import pipeline
+import query
+import queryconfig
+import redact
+
+
+def _emit(item):
+    metrics.count_metric("images")
+    # None is a legitimate output and must not stop the next stage
+    return [None, item, redact.image_output_path(f"{item}.png")]
+
+
+def _record(item, path):
+    with open(path, "a") as f:
+        f.write(f"{item!r}\n")
+
+
+@pytest.fixture(params=["fork", "spawn"])
+def start_method(request):
+    if request.param not in multiprocessing.get_all_start_methods():
+        pytest.skip(f"{request.param} isn't available on this platform")
+    previous = multiprocessing.get_start_method(allow_none=True)
+    multiprocessing.set_start_method(request.param, force=True)
+    yield request.param
+    multiprocessing.set_start_method(previous, force=True)
+
+
+def test_pipeline_passes_none_outputs_and_run_state(start_method, tmp_path):
+    metrics.init_metrics()
+    redact.configure_encoder({"format": "jpeg"})
+    output = tmp_path / "items.txt"
+    stages = [{"name": "emit", "workers": 2, "target": _emit},
+              {"name": "record", "workers": 2, "target": functools.partial(_record, path=str(output))}]
+
+    summary = pipeline.run_pipeline(range(10), stages, report_interval=60,
+                                    initializer=query.query_worker_initializer())
+
+    lines = output.read_text().splitlines()
+    assert summary["record"]["processed"] == 30
+    assert lines.count("None") == 10
+    # Encode settings and the metrics array reach spawned workers as well as forked ones
+    assert sorted(line for line in lines if line.endswith(".jpg'")) == sorted(f"'{i}.jpg'" for i in range(10))
+    assert metrics.metrics_snapshot()["counters"]["images"] == 10
+    redact.configure_encoder()
+
+
+def test_batch_objects_follows_a_callable_size():
+    sizes = iter([2, 3, 1, 10])
+    assert list(pipeline.batch_objects(range(8), lambda: next(sizes))) == [[0, 1], [2, 3, 4], [5], [6, 7]]
+
+
+def test_query_with_failed_items_is_partial(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # run_query installs a SIGTERM handler, which the test process should keep out of
+    monkeypatch.setattr(signal, "signal", lambda signum, handler: None)
+    query_config = queryconfig.new_query_config("bucket", "path/", datetime(2024, 5, 1), datetime(2024, 5, 31))
+    monkeypatch.setattr(query, "run_query_pipeline", lambda *args, **kwargs: {
+        "download": {"processed": 3, "failed": 1}, "consolidate": {"processed": 2, "failed": 0}})
+
+    with pytest.raises(RuntimeError, match="download: 1"):
+        query.run_query(query_config, s3=object(), objects=[])
+
+    assert queryconfig.load_query_config(query_config["queryId"])["status"] == "partial"
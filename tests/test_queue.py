@@ -0,0 +1,84 @@
+import os
+import time
+from datetime import datetime
+
+import pytest
+
+import catalog
+import queryconfig
+import workqueue
+from listing import S3Object
+from workqueue import WorkQueue
+
+SETTINGS = {"lease_seconds": 5, "heartbeat_seconds": 0.05, "max_attempts": 3, "poll_seconds": 0.05}
+
+
+@pytest.fixture
+def query_config(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return queryconfig.new_query_config("bucket", "path/", datetime(2024, 5, 1), datetime(2024, 5, 31))
+
+
+def _queue(query_config, shards=("p1", "p2")):
+    queue = WorkQueue(workqueue.queue_path(query_config["queryId"]))
+    queue.add_objects((name, S3Object(f"{name}/1.zip", 1, 0.0, "etag")) for name in shards)
+    queue.publish()
+    return queue
+
+
+def test_reduce_is_leased_only_after_every_shard_is_done(query_config):
+    queue = _queue(query_config)
+
+    first = queue.lease("a", 60, 3)
+    second = queue.lease("b", 60, 3)
+    assert [first[1], second[1]] == ["p1", "p2"]
+    assert queue.lease("c", 60, 3) is None
+
+    assert queue.complete(first[0], "a")
+    queue.release(second[0], "b", "boom", max_attempts=3)
+    retried = queue.lease("c", 60, 3)
+    assert retried[1] == "p2"
+    assert queue.complete(retried[0], "c")
+
+    assert queue.lease("a", 60, 3)[1:] == (workqueue.REDUCE_SHARD, "reduce")
+    assert queue.shard_objects(first[0]) == [S3Object("p1/1.zip", 1, 0.0, "etag")]
+
+
+def test_expired_leases_are_taken_over_and_fail_after_max_attempts(query_config):
+    queue = _queue(query_config, shards=("p1",))
+
+    for attempt in range(2):
+        shard = queue.lease(f"worker{attempt}", -1, 2)
+        assert shard[1] == "p1"
+    assert not queue.complete(shard[0], "worker0")
+
+    assert queue.lease("worker2", 60, 2) is None
+    assert queue.failed() == [("p1", "lease expired")]
+
+
+def test_reduce_without_shard_outputs_completes(query_config):
+    workqueue.reduce_shards(query_config)
+
+    assert query_config["status"] == "completed"
+    assert os.path.exists(os.path.join(query_config["queryId"], "combined", catalog.CATALOG_FILE))
+
+
+def test_shard_stops_when_its_lease_is_lost(query_config, monkeypatch):
+    queue = _queue(query_config, shards=("p1",))
+    runs = []
+
+    def run_query(shard_config, s3=None, metrics_path=None, objects=None, finalize=True):
+        runs.append(shard_config["queryId"])
+        if len(runs) > 1:
+            return
+        # Another worker takes the shard over, briefly; this worker must stop instead of finishing it
+        with queue.transaction() as conn:
+            conn.execute("UPDATE shards SET owner = 'thief', lease_expires = ? WHERE name = 'p1'", (time.time() + 0.2,))
+        time.sleep(5)
+        runs.append("finished")
+
+    monkeypatch.setattr(workqueue, "run_query", run_query)
+    workqueue.work_query(query_config["queryId"], s3=object(), settings=SETTINGS)
+
+    assert runs == [os.path.join(query_config["queryId"], "shards", "p1")] * 2
+    assert queue.counts() == {("map", "done"): 1, ("reduce", "done"): 1}
@@ -0,0 +1,97 @@
+import pytest
+
+import consolidatecsvs
+import queryconfig
+import redact
+
+np = pytest.importorskip("numpy")
+
+FACE = (40, 30, 20, 20)
+
+
+@pytest.fixture
+def detector(monkeypatch):
+    """
+    Stand-in detector that finds a face wherever the FACE region isn't black, recording its calls.
+    """
+    calls = []
+
+    def detect_faces_batch(images, detection_settings=None):
+        calls.append(len(images))
+        x, y, w, h = FACE
+        return [[FACE] if image[y:y + h, x:x + w].any() else [] for image in images]
+
+    monkeypatch.setattr(redact, "detect_faces_batch", detect_faces_batch)
+    return calls
+
+
+def _frame(face=False):
+    image = np.zeros((120, 160, 3), dtype=np.uint8)
+    image[100:110, 10:150] = 200  # Unchanged status bar
+    if face:
+        x, y, w, h = FACE
+        image[y:y + h, x:x + w] = 180
+    return image
+
+
+def test_cache_is_disabled_by_default():
+    assert redact.redaction_cache("p1") is None
+
+
+def test_identical_frames_reuse_cached_boxes(detector):
+    cache = redact.FaceBoxCache(8)
+
+    first = redact.detect_image_faces([_frame(face=True)], cache=cache)
+    second = redact.detect_image_faces([_frame(face=True)], cache=cache)
+
+    assert first == second == [[FACE]]
+    assert detector == [1]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_face_appearing_on_an_unchanged_frame_is_detected(detector):
+    cache = redact.FaceBoxCache(8)
+
+    assert redact.detect_image_faces([_frame()], cache=cache) == [[]]
+    assert redact.detect_image_faces([_frame(face=True)], cache=cache) == [[FACE]]
+    assert detector == [1, 1]
+
+
+def test_face_appearing_within_a_batch_is_detected(detector):
+    cache = redact.FaceBoxCache(8)
+
+    results = redact.detect_image_faces([_frame(), _frame(), _frame(face=True)], cache=cache)
+
+    assert results == [[], [], [FACE]]
+    assert detector == [2]
+
+
+def test_failed_detection_is_not_cached(detector, monkeypatch):
+    cache = redact.FaceBoxCache(8)
+    with monkeypatch.context() as m:
+        m.setattr(redact, "detect_faces_batch", lambda images, detection_settings=None: 1 / 0)
+        with pytest.raises(ZeroDivisionError):
+            redact.detect_image_faces([_frame(face=True)], cache=cache)
+
+    assert redact.detect_image_faces([_frame(face=True)], cache=cache) == [[FACE]]
+    assert detector == [1]
+
+
+def test_cache_size_is_a_query_setting():
+    args = consolidatecsvs.parse_args(["--path", "path/", "--redaction-cache-size", "4"])
+    settings = queryconfig.query_detection_settings({"redactionCacheSize": args.redactionCacheSize})
+
+    assert redact.redaction_cache("cache_size", settings).max_entries == 4
+
+
+def test_only_detector_results_pass_images_through(detector, monkeypatch):
+    cv2 = pytest.importorskip("cv2")
+    saved = []
+    monkeypatch.setattr(redact, "save_image",
+                        lambda path, image, original=None: saved.append((path, original)) or True)
+    encoded = cv2.imencode(".png", _frame())[1].tobytes()
+    cache = redact.FaceBoxCache(8)
+
+    redact.redact_image_batch([(encoded, "a.png"), (encoded, "b.png")], cache=cache)
+
+    assert saved == [("a.png", encoded), ("b.png", None)]
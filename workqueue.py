@@ -0,0 +1,417 @@
+import contextlib
+import logging
+import os
+import signal
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from listing import S3Object, query_s3_objects_in_date_range
+from metrics import init_metrics, metric_span
+from outputs import CSV_PREFIXES, panelist_from_key, write_consolidated_csv
+from pipeline import batch_objects
+from query import finalize_query_outputs, run_query
+from queryconfig import load_query_config, save_query_config
+from s3io import configure_output_sink, create_s3_client
+
+
+# Distributed runs
+# A distributed query is split into shards that workers on several nodes process through a work queue in
+# query_id/queue.sqlite on a shared volume. The coordinator lists the objects once and assigns them to
+# shards by panelist or by key hash. Each worker leases a shard, renews the lease with heartbeats while it
+# runs the shard as a sub-query in query_id/shards/<shard>, and marks it done; the leases of dead workers
+# expire and are taken over. Once every shard is done, one worker leases the reduce step, which merges the
+# shards' consolidated CSVs and images into query_id/combined and finalizes the query's outputs.
+
+# Default work queue settings
+QUEUE_SETTINGS = {
+    "lease_seconds": 300,     # A shard whose lease isn't renewed for this long is handed to another worker
+    "heartbeat_seconds": 60,  # Interval of lease renewals
+    "max_attempts": 3,        # Leases of a shard before it is marked failed
+    "poll_seconds": 10,       # Wait between lease attempts while other workers hold the remaining shards
+}
+
+# Name of the reduce step in the work queue
+REDUCE_SHARD = "reduce"
+
+def shard_name(obj, shard_by="panelist", num_shards=16):
+    """
+    Returns the shard an object is assigned to.
+
+    Args:
+        obj: S3Object.
+        shard_by: 'panelist' for one shard per panelist, or 'hash' for num_shards shards by key hash.
+        num_shards: Number of shards when sharding by hash.
+    """
+    if shard_by == "hash":
+        return f"{zlib.crc32(obj.key.encode('utf-8')) % num_shards:05d}"
+    return panelist_from_key(obj.key)
+
+
+class WorkQueue:
+    """
+    SQLite work queue of the shards of a distributed query. A connection is opened per operation, so
+    the queue can be shared by threads and by processes on several nodes. The database uses the default
+    rollback journal, as WAL needs shared memory that network file systems don't provide.
+
+    Args:
+        path: Path of the queue database.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS shards (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, "
+                         "kind TEXT NOT NULL DEFAULT 'map', state TEXT NOT NULL DEFAULT 'listing', owner TEXT, "
+                         "lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0, error TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS shard_objects (shard_id INTEGER NOT NULL, key TEXT NOT NULL, "
+                         "size INTEGER, mtime REAL, etag TEXT, PRIMARY KEY (shard_id, key))")
+
+    @contextlib.contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Runs statements in a write transaction, taking the database lock up front.
+        """
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def add_objects(self, assignments):
+        """
+        Adds (shard name, S3Object) assignments. The shards stay hidden from workers until publish.
+        """
+        with self.transaction() as conn:
+            for name, obj in assignments:
+                conn.execute("INSERT OR IGNORE INTO shards (name) VALUES (?)", (name,))
+                conn.execute("INSERT OR REPLACE INTO shard_objects SELECT id, ?, ?, ?, ? FROM shards WHERE name = ?",
+                             (obj.key, obj.size, obj.mtime, obj.etag, name))
+
+    def publish(self):
+        """
+        Makes the listed shards and the reduce step available to workers.
+
+        Returns:
+            int: Number of shards.
+        """
+        with self.transaction() as conn:
+            conn.execute("UPDATE shards SET state = 'pending' WHERE state = 'listing'")
+            conn.execute("INSERT OR IGNORE INTO shards (name, kind, state) VALUES (?, 'reduce', 'pending')",
+                         (REDUCE_SHARD,))
+            return conn.execute("SELECT COUNT(*) FROM shards WHERE kind = 'map'").fetchone()[0]
+
+    def lease(self, owner, lease_seconds, max_attempts):
+        """
+        Leases a pending shard, or one whose lease expired. The reduce step is only handed out once
+        every shard is done.
+
+        Returns:
+            tuple: (id, name, kind) of the leased shard, or None if there is nothing to lease now.
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            # Expired leases that used up their attempts belonged to workers that died on the shard
+            conn.execute("UPDATE shards SET state = 'failed', error = 'lease expired' "
+                         "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?", (now, max_attempts))
+            row = conn.execute(
+                "SELECT id, name, kind FROM shards WHERE (state = 'pending' OR (state = 'leased' AND lease_expires < ?)) "
+                "AND (kind = 'map' OR NOT EXISTS (SELECT 1 FROM shards WHERE kind = 'map' AND state != 'done')) "
+                "ORDER BY kind = 'reduce', id LIMIT 1", (now,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE shards SET state = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1 "
+                             "WHERE id = ?", (owner, now + lease_seconds, row[0]))
+        return row
+
+    def renew(self, shard_id, owner, lease_seconds):
+        """
+        Extends a lease.
+
+        Returns:
+            bool: False if the lease was lost to another worker.
+        """
+        with self.transaction() as conn:
+            return conn.execute("UPDATE shards SET lease_expires = ? WHERE id = ? AND owner = ? AND state = 'leased'",
+                                (time.time() + lease_seconds, shard_id, owner)).rowcount == 1
+
+    def complete(self, shard_id, owner):
+        """
+        Marks a leased shard as done.
+
+        Returns:
+            bool: False if the lease was lost to another worker, which then redoes the shard.
+        """
+        with self.transaction() as conn:
+            return conn.execute("UPDATE shards SET state = 'done', error = NULL WHERE id = ? AND owner = ? "
+                                "AND state = 'leased'", (shard_id, owner)).rowcount == 1
+
+    def release(self, shard_id, owner, error=None, max_attempts=None):
+        """
+        Returns a leased shard to the queue, or marks it failed once it used up max_attempts leases.
+        """
+        with self.transaction() as conn:
+            conn.execute("UPDATE shards SET state = CASE WHEN ? IS NOT NULL AND attempts >= ? THEN 'failed' "
+                         "ELSE 'pending' END, owner = NULL, lease_expires = NULL, error = ? "
+                         "WHERE id = ? AND owner = ? AND state = 'leased'",
+                         (max_attempts, max_attempts, error, shard_id, owner))
+
+    def shard_objects(self, shard_id):
+        """
+        Returns the S3Objects of a shard in key order.
+        """
+        with self.connect() as conn:
+            return [S3Object(*row) for row in conn.execute(
+                "SELECT key, size, mtime, etag FROM shard_objects WHERE shard_id = ? ORDER BY key", (shard_id,))]
+
+    def counts(self):
+        """
+        Returns:
+            dict: Number of shards per (kind, state).
+        """
+        with self.connect() as conn:
+            return {(kind, state): count for kind, state, count in
+                    conn.execute("SELECT kind, state, COUNT(*) FROM shards GROUP BY kind, state")}
+
+    def failed(self):
+        """
+        Returns:
+            list: (name, error) of the failed shards.
+        """
+        with self.connect() as conn:
+            return conn.execute("SELECT name, error FROM shards WHERE state = 'failed' ORDER BY id").fetchall()
+
+
+def queue_path(query_id):
+    return os.path.join(query_id, "queue.sqlite")
+
+
+def enqueue_query(query_config, s3=None):
+    """
+    Lists the objects of a distributed query and places them in its work queue, sharded by the
+    query's shardBy and numShards settings. Workers then process the query with work_query.
+
+    Args:
+        query_config: The query configuration.
+        s3: Boto3 S3 client used for listing; a default client is created if omitted.
+    """
+    if s3 is None:
+        s3 = create_s3_client()
+
+    query_id = query_config["queryId"]
+    shard_by, num_shards = query_config.get("shardBy", "panelist"), query_config.get("numShards", 16)
+    start_date = datetime.fromisoformat(query_config["startDate"])
+    end_date = datetime.fromisoformat(query_config["endDate"])
+    queue = WorkQueue(queue_path(query_id))
+
+    objects = query_s3_objects_in_date_range(s3, query_config["bucketName"], query_config["path"], start_date, end_date,
+                                             query_config.get("dateLevels"))
+    count = 0
+    for chunk in batch_objects(objects, 500):
+        queue.add_objects((shard_name(obj, shard_by, num_shards), obj) for obj in chunk)
+        count += len(chunk)
+    shards = queue.publish()
+
+    query_config["status"] = "queued"
+    query_config["numFilesToDownload"] = count
+    save_query_config(query_config)
+    logging.info(f"Queued {count} objects of query {query_id} in {shards} shards. Start workers on the shared "
+                 f"volume with: python consolidatecsvs.py --work {query_id}")
+
+
+def shard_query_config(query_config, name):
+    """
+    Returns the configuration of a shard's sub-query in query_id/shards/<name>, creating it on first use.
+    A shard taken over from a dead worker resumes from the sub-query's checkpoint and manifest.
+    """
+    shard_id = os.path.join(query_config["queryId"], "shards", name)
+    if os.path.exists(os.path.join(shard_id, "query_config.json")):
+        return load_query_config(shard_id)
+
+    shard_config = dict(query_config, queryId=shard_id, numFilesToDownload=0, numFilesDownloaded=0,
+                        numFilesConsolidated=0, lastBatchBeginId="", status="created")
+    for folder in ([] if shard_config["streaming"] else ["zipped", "unzipped"]):
+        os.makedirs(os.path.join(shard_id, folder), exist_ok=True)
+    os.makedirs(shard_id, exist_ok=True)
+    save_query_config(shard_config)
+    return shard_config
+
+
+class LeaseLost(BaseException):
+    """
+    Raised in a worker's main thread when its shard lease is lost to another worker. Like
+    KeyboardInterrupt it isn't an Exception, so it stops the shard's pipeline wherever it is running.
+    """
+
+
+def _raise_lease_lost(signum, frame):
+    raise LeaseLost()
+
+
+@contextlib.contextmanager
+def lease_heartbeat(queue, shard_id, owner, settings):
+    """
+    Renews a shard's lease in a background thread while the block runs. If the lease is lost to another
+    worker, the block is aborted with LeaseLost (when run in the main thread), so that two workers
+    never keep writing to the same shard.
+
+    Yields:
+        threading.Event: Set if the lease was lost to another worker.
+    """
+    lost, stopped = threading.Event(), threading.Event()
+    # Signal handlers can only be installed, and only run, in the main thread
+    abort = threading.current_thread() is threading.main_thread()
+    if abort:
+        previous_handler = signal.signal(signal.SIGUSR1, _raise_lease_lost)
+
+    def renew():
+        while not stopped.wait(settings["heartbeat_seconds"]):
+            try:
+                if not queue.renew(shard_id, owner, settings["lease_seconds"]):
+                    lost.set()
+                    if abort:
+                        signal.pthread_kill(threading.main_thread().ident, signal.SIGUSR1)
+                    return
+            except sqlite3.Error as e:
+                # The lease survives a missed heartbeat or two; it expires only after lease_seconds
+                logging.warning(f"Could not renew the lease of shard {shard_id}: {e}")
+
+    thread = threading.Thread(target=renew, daemon=True)
+    thread.start()
+    try:
+        yield lost
+    finally:
+        stopped.set()
+        thread.join()
+        if abort:
+            signal.signal(signal.SIGUSR1, previous_handler)
+
+
+def _move_tree(source, destination):
+    """
+    Moves the files of a folder into another folder, merging their subfolders.
+    """
+    for root, _, files in os.walk(source):
+        target = os.path.join(destination, os.path.relpath(root, source))
+        os.makedirs(target, exist_ok=True)
+        for name in files:
+            os.replace(os.path.join(root, name), os.path.join(target, name))
+
+
+def reduce_shards(query_config):
+    """
+    Merges the consolidated CSVs and images of a distributed query's shards into query_id/combined,
+    then finalizes the query's outputs (see finalize_query_outputs).
+
+    Args:
+        query_config: The query configuration.
+    """
+    query_id = query_config["queryId"]
+    shards_folder = os.path.join(query_id, "shards")
+    init_metrics()
+    configure_output_sink(query_config.get("outputUri"))
+    # No shard produced any output, e.g. when the listing was empty
+    shards = sorted(os.listdir(shards_folder)) if os.path.isdir(shards_folder) else []
+    sources = {}
+    for shard in shards:
+        panelists_folder = os.path.join(shards_folder, shard, "combined", "panelists")
+        if not os.path.isdir(panelists_folder):
+            continue
+        for panelist in sorted(os.listdir(panelists_folder)):
+            images = os.path.join(panelists_folder, panelist, "images")
+            if os.path.isdir(images):
+                _move_tree(images, os.path.join(query_id, "combined", "panelists", panelist, "images"))
+            for prefix in CSV_PREFIXES:
+                csv_path = os.path.join(panelists_folder, panelist, "metadata", f"{prefix}-consolidated.csv")
+                if os.path.exists(csv_path):
+                    sources.setdefault((panelist, prefix), []).append(csv_path)
+
+    for (panelist, prefix), paths in sources.items():
+        output_path = os.path.join(query_id, "combined", "panelists", panelist, "metadata", f"{prefix}-consolidated.csv")
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with metric_span("consolidate"):
+            write_consolidated_csv(output_path, paths)
+    logging.info(f"Merged {len(sources)} consolidated CSVs of {len(shards)} shards into "
+                 f"{os.path.join(query_id, 'combined')}.")
+
+    finalize_query_outputs(query_config)
+    query_config["status"] = "completed"
+    save_query_config(query_config)
+
+
+def work_query(query_id, s3=None, metrics_path=None, settings=None):
+    """
+    Works on a distributed query until its queue is drained: leases shards and runs each as a sub-query,
+    then runs the reduce step if no other worker has. Any number of workers can run on any node that
+    mounts the query folder.
+
+    Args:
+        query_id: Unique identifier of a query queued with enqueue_query.
+        s3: Boto3 S3 client used for listing; a default client is created if omitted.
+        metrics_path: .jsonl or .prom file to export metrics to (default: each shard's metrics.jsonl).
+        settings: Overrides for QUEUE_SETTINGS.
+
+    Raises:
+        RuntimeError: If shards failed on all their attempts.
+    """
+    settings = {**QUEUE_SETTINGS, **(settings or {})}
+    query_config = load_query_config(query_id)
+    if not os.path.exists(queue_path(query_id)):
+        raise ValueError(f"Query '{query_id}' has no work queue; queue it with --distributed first")
+    queue = WorkQueue(queue_path(query_id))
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    if s3 is None:
+        s3 = create_s3_client()
+
+    while True:
+        shard = queue.lease(owner, settings["lease_seconds"], settings["max_attempts"])
+        if shard is None:
+            counts = queue.counts()
+            open_maps = counts.get(("map", "pending"), 0) + counts.get(("map", "leased"), 0)
+            open_reduce = counts.get(("reduce", "pending"), 0) + counts.get(("reduce", "leased"), 0)
+            if not open_maps and (not open_reduce or counts.get(("map", "failed"))):
+                break
+            time.sleep(settings["poll_seconds"])
+            continue
+
+        shard_id, name, kind = shard
+        logging.info(f"Leased shard {name} of query {query_id}.")
+        try:
+            with lease_heartbeat(queue, shard_id, owner, settings) as lost:
+                if kind == "reduce":
+                    reduce_shards(query_config)
+                else:
+                    run_query(shard_query_config(query_config, name), s3, metrics_path,
+                              objects=queue.shard_objects(shard_id), finalize=False)
+        except LeaseLost:
+            logging.warning(f"Lost the lease of shard {name}; stopped it for the worker that took it over.")
+            continue
+        except Exception as e:
+            logging.error(f"Shard {name} of query {query_id} failed: {e}")
+            queue.release(shard_id, owner, str(e), settings["max_attempts"])
+            continue
+        except BaseException:
+            # Interrupted: hand the shard back right away instead of waiting for the lease to expire
+            queue.release(shard_id, owner)
+            raise
+
+        if lost.is_set() or not queue.complete(shard_id, owner):
+            logging.warning(f"Lost the lease of shard {name}; the worker that took it over redoes it.")
+
+    failed = queue.failed()
+    if failed:
+        raise RuntimeError(f"Shards of query {query_id} failed: "
+                           + ", ".join(f"{name} ({error})" for name, error in failed))